@@ -0,0 +1,118 @@
+"""
+複数の入力シートを一つのプロセスで続けて処理するバッチのモジュール。
+
+設定情報、テンプレートのキャッシュ、変換バックエンドと帳票出力のワーカーは契約の間で共有する
+"""
+
+from app import jikkin_sheet
+from app.chohyo_gen import ChohyoGenerator, Renderer
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Iterable, List, Optional
+import glob
+import os
+import time
+
+logger = getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ContractResult:
+    """
+    入力シート一つ分の処理結果
+    """
+    input_file_path: str
+    elapsed: float  # 秒
+    products: int = 0  # 商品の列の数
+    error: Optional[Exception] = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
+
+def is_lock_file(path: str) -> bool:
+    """
+    Excel、LibreOfficeで開いている間に作られるロックファイルかどうか
+    """
+    name = os.path.basename(path)
+    return name.startswith('~$') or name.startswith('.~lock.')
+
+
+def expand_inputs(args: Iterable[str]) -> List[str]:
+    """
+    引数に指定された入力シートのパス、フォルダ、ワイルドカードを入力シートのパスのリストにする。
+    フォルダの場合は直下の.xlsxをすべて処理する。同じファイルは一度だけ処理する
+    """
+    paths: List[str] = []
+    for arg in args:
+        if os.path.isdir(arg):
+            matched = sorted(glob.glob(os.path.join(glob.escape(arg), '*.xlsx')))
+        elif glob.has_magic(arg):  # type: ignore[attr-defined]
+            matched = sorted(glob.glob(arg))
+        else:
+            matched = [arg]
+
+        for path in matched:
+            path = os.path.normpath(path)
+            if not is_lock_file(path) and path not in paths:
+                paths.append(path)
+
+    if not paths:
+        raise RuntimeError(f'処理する入力シートが見つかりません。({", ".join(args)})')
+    return paths
+
+
+def run_batch(generator: ChohyoGenerator,
+              input_file_paths: List[str],
+              jikkin_calculation: str = 'excel',
+              render_workers: int = 1,
+              incremental: bool = True) -> List[ContractResult]:
+    """
+    入力シートを順に処理する。失敗した入力シートがあっても残りの処理を続ける
+    """
+    results = []
+    with Renderer(generator, render_workers) as renderer:
+        for i, path in enumerate(input_file_paths):
+            logger.info('')
+            logger.info(f'=== [{i + 1}/{len(input_file_paths)}] {path} ===')
+            logger.info('')
+
+            started = time.perf_counter()
+            products = 0
+            try:
+                product_inputs = jikkin_sheet.read_input_sheet(path)
+                products = len(product_inputs)
+                generator.gen_all_doc(
+                    product_inputs, jikkin_calculation, incremental=incremental, renderer=renderer)
+            except Exception as e:
+                logger.error(f'{path}の処理に失敗しました: {e}', exc_info=True)
+                results.append(ContractResult(path, time.perf_counter() - started, products, e))
+            else:
+                results.append(ContractResult(path, time.perf_counter() - started, products))
+
+    return results
+
+
+def logging_summary(results: List[ContractResult]):
+    """
+    契約ごとの処理時間と失敗の一覧を表示する
+    """
+    failures = [r for r in results if not r.succeeded]
+
+    logger.info('')
+    logger.info('--- バッチ処理の結果 ---')
+    logger.info('--------------------------------------------------')
+    logger.info('\t状態\t時間\t商品数\tファイル名')
+    for r in results:
+        logger.info(f'\t{"成功" if r.succeeded else "失敗"}\t{r.elapsed:.2f}秒\t{r.products}\t{r.input_file_path}')
+    logger.info('--------------------------------------------------')
+    logger.info(f'  {len(results)}件中 成功{len(results) - len(failures)}件 失敗{len(failures)}件'
+                f' 合計{sum(r.elapsed for r in results):.2f}秒')
+
+    if failures:
+        logger.info('')
+        logger.info('  失敗した入力シート')
+        for r in failures:
+            logger.info(f'    {r.input_file_path}: {r.error}')
+    logger.info('')
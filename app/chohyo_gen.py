@@ -3,37 +3,43 @@
 """
 
 
-from app import docx_helper, replace
+from app import converter, docx_helper, file_watch, manifest, replace
 from app import time_helper, jikkin_sheet
 from app import xl_helper
 from app.config import Config
 from app.model import JointGuarantor, Product, ProductInput
+from app.pipeline import Pipeline, TaskResult
+from app.schedule import Schedule
 from app.time_helper import strftime
+from concurrent.futures import ProcessPoolExecutor
 from copy import copy
 from dataclasses import dataclass
 from docx import Document
 from logging import getLogger, INFO
+from logging.handlers import QueueHandler
 from openpyxl.cell.cell import Cell
 from openpyxl.styles.borders import Border, Side
 from openpyxl.styles.fills import PatternFill
 from openpyxl.worksheet.worksheet import Worksheet
-from os import times
-from typing import Any, ChainMap, Iterable, List, Optional, Tuple, cast
-import win32print
-import win32api
-import win32com.client as win32
+from typing import Any, Callable, ChainMap, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union, cast
 
 from collections import ChainMap
 
+import dataclasses
 import functools
 import itertools
+import logging
 import more_itertools
+import multiprocessing
+import multiprocessing.util
 import openpyxl
 import os
 import platform
+import queue
 import re
 import subprocess
-import sys
+import threading
+import time
 import copy
 
 logger = getLogger(__name__)
@@ -45,68 +51,38 @@ before_ext = re.compile(r'(?=\.(docx|xlsx))')
 chacot_flg = [0, 0, 0, 0]
 
 
-def word_to_pdf_2_pages_per_sheet(input_file, output_file):
-    word = win32.gencache.EnsureDispatch('Word.Application')
-    word.Visible = False
-    word.DisplayAlerts = False
-
-    # デフォルトプリンタ名を取得
-    default_printer = win32print.GetDefaultPrinter()
-
-    input_file = os.path.abspath(input_file)
-    output_file = os.path.abspath(output_file)
-
-    # Word文書を開く
-    doc = word.Documents.Open(input_file)
-
-    if "【集約印刷】" in input_file:
-        # 1枚に2ページ単位で印刷する設定
-        word.ActivePrinter = default_printer
-        word.PrintOut(
-            OutputFileName=output_file,
-            Item=win32.constants.wdPrintDocumentContent,
-            Copies=1,
-            Pages="1-2",
-            Collate=True,
-            Background=False,
-            PrintToFile=True,
-            Range=win32.constants.wdPrintAllDocument,
-            ManualDuplexPrint=False,
-            PrintZoomColumn=2,
-            PrintZoomRow=1,
-            PrintZoomPaperWidth=0,
-            PrintZoomPaperHeight=0
-            )
-    else:
-        # 通常のPDF化を行う
-        doc.SaveAs(output_file, FileFormat=win32.constants.wdFormatPDF)
+def chacot_flags(product_inputs: Iterable[ProductInput]) -> List[int]:
+    """
+    Chacotを含む入力データかどうかをチェックする。
 
-    # Word文書を閉じる
-    doc.Close(SaveChanges=False)
-    word.Quit()
+    [Chacotを含むか, Chacotの列の数, 最後のChacotの列の添字 - 1, 最後のChacotの列の添字]。
+    出力ジョブの実行中は`chacot_flg`に入れておき、金消で物件目録の表をコピーするかどうかに使う
+    """
+    flags = [0, 0, 0, 0]
+    for idx, product_input in enumerate(product_inputs):
+        if 'Chacot' in product_input.name:
+            flags[0] = 1
+            flags[1] += 1
+            flags[2] = idx - 1
+            flags[3] = idx
+    return flags
 
 
-def excel_to_pdf(excel_path, pdf_path):
+def word_to_pdf_2_pages_per_sheet(input_file, output_file):
     """
-    ExcelからPDFに変換する関数
+    WordからPDFに変換する関数。ファイル名に【集約印刷】を含む場合は1枚に2ページずつ印刷する
     """
+    converter.get().word_to_pdf(input_file, output_file)
 
-    excel = win32.gencache.EnsureDispatch('Excel.Application')
-    # excel = win32.Dispatch("Excel.Application")
-    excel.Visible = False
-    excel.DisplayAlerts = False
-    # xlTypePDF定数を取得
-    xlTypePDF = win32.constants.xlTypePDF
 
+def excel_to_pdf(excel_path, pdf_path):
+    """
+    ExcelからPDFに変換する関数
+    """
     try:
-        file = excel.Workbooks.Open(os.path.abspath(excel_path))
-        file.Worksheets(1).Select()
-        file.ActiveSheet.ExportAsFixedFormat(xlTypePDF, os.path.abspath(pdf_path))
+        converter.get().excel_to_pdf(excel_path, pdf_path)
     except Exception as e:
-        print(f"Failed to convert {excel_path} to PDF: {e}")
-    finally:
-        file.Close()
-        excel.Application.Quit()
+        logger.error(f"Failed to convert {excel_path} to PDF: {e}")
 
 
 def logging_output(ipt: str, opt: str, level=INFO):
@@ -116,6 +92,221 @@ def logging_output(ipt: str, opt: str, level=INFO):
     logger.log(level, f'  出力{ipt}    ->    {opt}')
 
 
+class RenderJob(NamedTuple):
+    """
+    帳票の出力処理ひとつ分。プロセスプールに渡せるように、商品はproductsの添字で指す
+    """
+    method: str  # ChohyoGeneratorのメソッド名
+    index: Optional[int] = None  # 商品の添字
+    form_no: Optional[int] = None  # 様式番号
+
+
+# 集計帳票のジョブの表示名
+aggregate_job_names = {
+    '_gen_gokei': '請求書合計',
+    '_gen_kashitsuke_gokei': '貸付金額合計',
+    '_gen_rentaihosho': '連帯保証書',
+    '_gen_shinkokusho': '申告書',
+}
+
+# 集計帳票のジョブが出力する様式番号
+aggregate_job_forms = {
+    '_gen_gokei': (17, ),
+    '_gen_kashitsuke_gokei': (18, ),
+    '_gen_rentaihosho': (15, 16),
+    '_gen_shinkokusho': (3, ),
+}
+
+
+class OutputTarget(NamedTuple):
+    """
+    出力する帳票ひとつ分
+    """
+    index: Optional[int]  # 商品の添字。請求書合計などすべての商品から作る帳票はNone
+    form_no: int  # 様式番号
+    guarantor: Optional[int] = None  # 連帯保証人ごとの帳票の場合は連帯保証人の添字
+
+
+def job_outputs(job: RenderJob) -> List[Tuple[Optional[int], int]]:
+    """
+    ジョブが出力する帳票の(商品の添字, 様式番号)
+    """
+    if job.form_no is not None:
+        return [(job.index, job.form_no)]
+    # 連帯保証書と申告書は先頭の商品から作る
+    index = 0 if job.method in {'_gen_rentaihosho', '_gen_shinkokusho'} else None
+    return [(index, form_no) for form_no in aggregate_job_forms[job.method]]
+
+# プロセスプールのワーカーが使う帳票生成器。ワーカーの起動時に一度だけ受け取る
+_worker_generator: Optional['ChohyoGenerator'] = None
+_worker_logs: 'queue.SimpleQueue[logging.LogRecord]' = queue.SimpleQueue()
+
+
+def _init_render_worker(generator: 'ChohyoGenerator', level: int):
+    global _worker_generator
+    _worker_generator = generator
+
+    # ログは親プロセスがジョブごとにまとめて出力するので、ワーカーでは溜めておくだけにする
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(_worker_logs)]
+    root.setLevel(level)
+
+    # ワーカーの終了時にはatexitが呼ばれないので、起動したWordなどはここで終了する
+    multiprocessing.util.Finalize(None, converter.close, exitpriority=10)
+
+
+def _run_render_job(roots: Tuple[str, str], flags: List[int], build_manifest: Optional[manifest.Manifest],
+                    products: List[Product], job: RenderJob) \
+        -> Tuple[List[logging.LogRecord], Dict[str, Optional[str]], Optional[Exception]]:
+    """
+    ワーカーでジョブを実行し、その間のログ、マニフェストに記録した出力、失敗した場合は例外を返す。
+
+    ワーカーは複数の契約で使い回すので、契約ごとの状態(テンプレートと出力先のフォルダ、
+    chacot_flg、マニフェスト)はジョブと一緒に受け取る
+    """
+    assert _worker_generator is not None
+    chacot_flg[:] = flags
+    manifest.activate(build_manifest)
+
+    generator = _worker_generator
+    if (generator.template_root_path, generator.output_root_path) != roots:
+        generator = dataclasses.replace(generator, template_root_path=roots[0], output_root_path=roots[1])
+
+    error = None
+    try:
+        generator._gen_job(products, job)
+    except Exception as e:
+        logger.debug(f'{job}の出力に失敗しました', exc_info=True)
+        error = e
+
+    records = []
+    while not _worker_logs.empty():
+        records.append(_worker_logs.get())
+
+    build_manifest = manifest.active()
+    return records, build_manifest.take_updates() if build_manifest is not None else {}, error
+
+
+def _handle_records(records: Iterable[logging.LogRecord]):
+    for record in records:
+        logging.getLogger(record.name).handle(record)
+
+
+class _OrderedLogs:
+    """
+    ワーカーで実行したジョブのログを、直列に出力した場合と同じくジョブを登録した順に出力する。
+    先に終わったジョブのログは、それより前のジョブのログを出力するまで溜めておく
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[int, List[logging.LogRecord]] = {}
+        self._count = 0
+        self._next = 0
+
+    def writer(self) -> Callable[[List[logging.LogRecord]], None]:
+        """
+        次に登録するジョブのログの出力先
+        """
+        with self._lock:
+            seq = self._count
+            self._count += 1
+        return functools.partial(self._put, seq)
+
+    def _put(self, seq: int, records: List[logging.LogRecord]):
+        with self._lock:
+            self._pending[seq] = records
+            while self._next in self._pending:
+                _handle_records(self._pending.pop(self._next))
+                self._next += 1
+
+    def flush(self):
+        """
+        失敗などで実行されなかったジョブを飛ばし、溜めているログをすべて出力する
+        """
+        with self._lock:
+            for seq in sorted(self._pending):
+                _handle_records(self._pending[seq])
+            self._pending.clear()
+            self._next = self._count
+
+
+class Renderer:
+    """
+    帳票の出力ジョブを実行する。workersが2以上の場合はプロセスプールで実行する。
+
+    プロセスプールは最初のジョブで起動する。ワーカーのログはジョブが終わったときに
+    まとめて出力するので、ジョブ同士のログが混ざることはない。
+    `ChohyoGenerator.gen_all_doc`に渡すと、複数の契約でワーカーを使い回せる
+    """
+
+    def __init__(self, generator: 'ChohyoGenerator', workers: int):
+        self._generator = generator
+        self._workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def render(self, generator: 'ChohyoGenerator', job: RenderJob, flags: Sequence[int], count: int,
+               indices: Tuple[int, ...], *products: Product,
+               logs: Optional[Callable[[List[logging.LogRecord]], None]] = None):
+        """
+        generatorのjobを実行する。flagsには契約の`chacot_flags`を、productsにはindicesの列の商品を渡す。
+        ワーカーには必要な商品だけを送り、残りの列はNoneにしておく。
+        logsを指定した場合は、ワーカーのログをそこに渡す(`_OrderedLogs.writer`)。
+
+        ワーカーの帳票生成器は起動時のものなので、設定情報は同じものを使う。
+        テンプレートと出力先のフォルダはgeneratorのものを使う
+        """
+        subset: List[Optional[Product]] = [None] * count
+        for idx, product in zip(indices, products):
+            subset[idx] = product
+
+        if self._workers <= 1:
+            chacot_flg[:] = flags
+            generator._gen_job(cast(List[Product], subset), job)
+            return
+
+        with self._lock:
+            if self._executor is None:
+                # Windowsと同じ起動方法にそろえ、変換バックエンドなどを親プロセスから引き継がないようにする
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self._workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_render_worker,
+                    initargs=(self._generator, logging.getLogger().getEffectiveLevel()))
+            executor = self._executor
+
+        records, updates, error = executor.submit(
+            _run_render_job, (generator.template_root_path, generator.output_root_path),
+            list(flags), manifest.active(), subset, job).result()
+        if logs is not None:
+            logs(records)
+        else:
+            with self._lock:
+                _handle_records(records)
+        build_manifest = manifest.active()
+        if build_manifest is not None:
+            build_manifest.merge(updates)
+        if error is not None:
+            raise error
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                self._executor = None
+
+    def __enter__(self) -> 'Renderer':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 @dataclass(frozen=True)
 class ChohyoGenerator:
     """
@@ -128,127 +319,193 @@ class ChohyoGenerator:
     template_root_path: str
     output_root_path: str
 
-    def _wait_all_updates(self, file_iterable: Iterable[str], throttle_sec: float = 1):
+    def _wait_all_updates(self, watch: file_watch.SaveWatch):
         """
-        すべてのファイルが更新されることを確認するためのロジック及び表示。
+        すべてのファイルが上書き保存されて閉じられるまで待ち、ファイルごとの状態を表示する。
         excelの計算をpythonで実行できないので実装してある。
 
-
-        FIXME: 開発で使ったマシン上では、開いたタイミングでst_mtimeが更新されてしまった
-        つまり上書き保存すると2回st_mtimeが変わるはずなのでそれらを変数に持てばこの関数も
-        意図通りに動くはず
+        状態はファイルの保存やロックファイルの作成・削除の通知を受けるたびに表示し直す
+        (`file_watch.SaveWatch`を参照)
         """
 
-        files = list(file_iterable)
-
-        def updated(fpath: str):
-            """
-            上書き保存がされていたらTrue
-            """
-            stat = os.stat(fpath)
-            return stat.st_ctime != stat.st_mtime
-
-        def refresh():
-            return [[fpath, updated(fpath)] for fpath in files]
-
-        state = refresh()
-
-        while any(not updated for _, updated in state):
+        def show(state: Dict[str, str]):
             logger.info('すべてのファイルをExcelで開き、上書き保存を実行してください')
             logger.info('--------------------------------------------------')
             logger.info('\t状態\tファイル名')
-            for fpath, valid in state:
-                logger.info(f'\t{"確認済" if  valid else "未確認"}\t{fpath}')
+            for fpath, status in state.items():
+                logger.info(f'\t{status}\t{fpath}')
             logger.info('--------------------------------------------------')
 
-            while state == (new_state := refresh()):
-                times.sleep(throttle_sec)
-
-            state = new_state
+        watch.wait(show)
+        logger.info('すべてのファイルの上書き保存を確認しました。')
+        logger.info('')
 
-    def gen_all_doc(self, product_inputs: List[ProductInput]):
+    def gen_all_doc(self, product_inputs: List[ProductInput], jikkin_calculation: str = 'excel', render_workers: int = 1,
+                    incremental: bool = True, only: Optional[Iterable[OutputTarget]] = None,
+                    renderer: Optional[Renderer] = None):
         """
         帳票出力を行う
+
+        jikkin_calculationは実金シートの計算方法(`jikkin_sheet.output_jikkin_sheet`を参照)。
+        excel以外の場合は、Excelで開いて上書き保存する手順を省略する。
+
+        処理は`pipeline.Pipeline`のジョブとして組み立てる。render_workersが2以上の場合は
+        依存が解決したジョブを並列に実行し、帳票はその数のプロセスで出力する。
+        最後に全体の時間を決めているジョブの連なり(クリティカルパス)を表示する。
+
+        出力した帳票は出力先のフォルダのマニフェスト(`manifest.Manifest`)に記録する。
+        incrementalがTrueの場合は、前回と同じ入力から出力済みの帳票は出力しない。
+        onlyを指定した場合は、実金シート以外はその帳票を出力するジョブだけを実行する
+        (`keyword_index.affected_outputs`を参照)
+
+        rendererを指定した場合はrender_workersの代わりにそのワーカーを使い、終了はしない。
+        複数の契約を続けて出力する場合に、ワーカーと変換バックエンドの起動を一度にするために使う
         """
 
         assert len(product_inputs) >= 1
 
-        def jikkin_path(product_input: ProductInput) -> Tuple[str, str]:
-
-            if not isinstance(product_input, ProductInput):
-                raise TypeError()
-            form_no, filename = more_itertools.first_true(
-                self.config.get_product_doc_info(product_input).items(),
-                default=(None, None),
-                pred=lambda x: (x[0] in {7, 8, 9} and x[1] is not None)
-            )
-            if filename is None:
-                raise RuntimeError(
-                    f'{product_input.name}に対して有効な実金テンプレートが見つかりません。設定情報が正しく設定されていることをご確認ください。')
-
-            template_path, output_path = self.path_info(
-                product_input, form_no)
-            output_path = before_ext.sub(
-                '_' + '_'.join([
-                    time_helper.strftime(
-                        product_input.contract_date, r'%Y%m%d'
-                    ),
-                    product_input.customer_name.strip(),
-                    product_input.product_kv['ファイル名用住所'],
-                    product_input.name.strip()
-                ]),
-                output_path,
-                1)
+        # すべての商品の連帯保証人が等しくなるべき。
+        if not all(p.joint_guarantors == product_inputs[0].joint_guarantors for p in product_inputs):
+            raise RuntimeError('連帯保証人欄に不正があります。連帯保証人に関する項目はすべての列で同じ値を指定してください')
 
-            return (template_path, output_path)
+        # Chacotを含む入力データかどうか。契約ごとに求め、出力ジョブに渡す
+        flags = chacot_flags(product_inputs)
+        chacot_flg[:] = flags
 
-        logger.info('--- 実金シートの生成 ---')
-        logger.info('')
-        builders = []
-        for idx, product_input in enumerate(product_inputs):
+        def output_jikkin(idx: int, product_input: ProductInput) -> jikkin_sheet.ProductBuilder:
             builder = jikkin_sheet.output_jikkin_sheet(
                 product_input,
-                *jikkin_path(product_input),
-                self.config
+                *self.jikkin_path(product_input),
+                self.config,
+                jikkin_calculation
             )
             logger.info(
                 f'  {idx + 1}列目 {product_input.name} -> {builder.src_jikkin_path}')
-            builders.append(builder)
-        logger.info('')
+            return builder
+
+        def calculate(*builders: jikkin_sheet.ProductBuilder) -> bool:
+            """
+            実金シートを計算する。戻り値は、実金シートが上書き保存されたことを確認するかどうか。
+            変更なしで出力し直さなかった実金シートは計算せず、前回保存された値を使う
+            """
+            logger.info('')
+            logger.info('--- 計算処理 ---')
+            logger.info('')
+            if jikkin_calculation not in {'excel', 'recalculate'}:
+                logger.info('  実金シートの計算はPythonで行いました。Excelでの上書き保存は不要です。')
+                logger.info('')
+                return True
+
+            skipped = [b for b in builders if not b.written]
+            if skipped:
+                logger.info('  以下のファイルは変更がないため、前回保存された値を使います。')
+                logger.info('')
+                for b in skipped:
+                    logger.info(f'    {b.src_jikkin_path}')
+                logger.info('')
+            builders = tuple(b for b in builders if b.written)
+            if not builders:
+                return False
+
+            if jikkin_calculation == 'recalculate':
+                logger.info('  実金シートを変換バックエンドで再計算して保存します。')
+                logger.info('')
+                for b in builders:
+                    converter.get().recalculate(b.src_jikkin_path)
+                    manifest.confirm(b.src_jikkin_path)
+                return False
 
-        logger.info('--- 計算処理 ---')
+            logger.info(
+                '  以下のファイルをExcelアプリケーションで開きます。出力が正しいことを確認し、必ず上書き保存してください。')
+            logger.info('')
+            for b in builders:
+                logger.info(f'    {b.src_jikkin_path}')
+            logger.info('')
+
+            # 開く前の状態と比べて保存を確認するので、開く前に監視を始める
+            watch = file_watch.SaveWatch.of(b.src_jikkin_path for b in builders)
+
+            # excelを開く
+            for b in builders:
+                if platform.system() == 'Windows':
+                    # windowsで確認したところ、excelをセーブして閉じるまで
+                    # この呼出はブロックしてくれたので
+                    subprocess.run(f'"{b.src_jikkin_path}"', shell=True)
+                # macでの処理
+                elif platform.system() == 'Darwin':
+                    subprocess.Popen(["open", "-a", "LibreOffice",  f'{b.src_jikkin_path}',])
+
+            self._wait_all_updates(watch)
+            manifest.confirm(*(b.src_jikkin_path for b in builders))
+            # 保存は監視で確認済み
+            return False
+
+        # NOTE: 実金シートの生成 -> 計算処理 -> 商品の読み込み -> 帳票の出力 の順に依存する。
+        # 帳票の出力はそれぞれが使う商品にだけ依存するので、読み込みが終わった商品の
+        # 帳票から出力を始める
+        pipeline = Pipeline()
+        jikkin_jobs = [
+            pipeline.add(f'実金シート {idx + 1}列目', functools.partial(output_jikkin, idx, product_input))
+            for idx, product_input in enumerate(product_inputs)]
+        calculate_job = pipeline.add('計算処理', calculate, jikkin_jobs)
+        product_jobs = [
+            pipeline.add(f'商品 {idx + 1}列目', lambda builder, check_saved: builder.run(check_saved), (jikkin_job, calculate_job))
+            for idx, jikkin_job in enumerate(jikkin_jobs)]
+
+        owns_renderer = renderer is None
+        if renderer is None:
+            renderer = Renderer(self, render_workers)
+        targets = None if only is None else {(t.index, t.form_no) for t in only}
+        # ワーカーのログは、先に終わったジョブがあっても_render_jobsの順に出力する
+        ordered_logs = _OrderedLogs()
+        for job, indices in self._render_jobs(product_inputs):
+            if targets is not None and targets.isdisjoint(job_outputs(job)):
+                continue
+            pipeline.add(
+                self._job_name(product_inputs, job),
+                functools.partial(renderer.render, self, job, flags, len(product_inputs), indices,
+                                  logs=ordered_logs.writer()),
+                [product_jobs[idx] for idx in indices])
+
+        logger.info('--- 実金シートの生成 ---')
         logger.info('')
-        logger.info(
-            '  以下のファイルをExcelアプリケーションで開きます。出力が正しいことを確認し、必ず上書き保存してください。')
+        build_manifest = manifest.Manifest.load(self.output_root_path)
+        if not incremental:
+            build_manifest.entries.clear()
+        manifest.activate(build_manifest)
+
+        results: Dict[str, TaskResult] = {}
+        started = time.perf_counter()
+        try:
+            for result in pipeline.run(renderer.workers):
+                logger.debug(f'  {result.name}: {result.elapsed:.2f}秒')
+                results[result.name] = result
+        finally:
+            ordered_logs.flush()
+            if owns_renderer:
+                renderer.close()
+            manifest.activate(None)
+            build_manifest.save()
+
+        critical_path = pipeline.critical_path(results)
         logger.info('')
-        for b in builders:
-            logger.info(f'    {b.src_jikkin_path}')
+        logger.info(f'--- 処理時間 {time.perf_counter() - started:.2f}秒 ---')
         logger.info('')
+        logger.info(f'  クリティカルパス {sum(r.elapsed for r in critical_path):.2f}秒')
+        for result in critical_path:
+            logger.info(f'    {result.elapsed:7.2f}秒  {result.name}')
 
-        # excelを開く
-        for b in builders:
-            if platform.system() == 'Windows':
-                # windowsで確認したところ、excelをセーブして閉じるまで
-                # この呼出はブロックしてくれたので
-                subprocess.run(f'"{b.src_jikkin_path}"', shell=True)
-            # macでの処理
-            elif platform.system() == 'Darwin':
-                subprocess.Popen(["open", "-a", "LibreOffice",  f'{b.src_jikkin_path}',])
-
-        logger.info('開いているすべてのExcelファイルを保存した後、Enterキーを押してください。')
-        sys.stdin.flush()
-        input()
-
-        products = [builder.run() for builder in builders]
-
-        # シートごとの出力
+    def _render_jobs(self, product_inputs: List[ProductInput]) -> List[Tuple[RenderJob, Tuple[int, ...]]]:
+        """
+        帳票の出力ジョブと、それぞれが使う商品の添字の一覧
+        """
 
         # NOTE: 合計を出力する条件が難しいのでコメントでも残しておく。
         # 合計の出力は請求書が2枚以上発行される場合であるが、2054,9054については
         # 直前の列とセットでドキュメントを出力するため、単純にproductsの長さを測るだけ
         # では請求書の合計枚数と一致しない場合がある。
 
-        def count_product(products: Iterable[Product]) -> int:
+        def count_product(products: Iterable[ProductInput]) -> int:
             """
             2054, 9054を考慮した実際の商品の数を計算する
             """
@@ -261,164 +518,194 @@ class ChohyoGenerator:
                 0
             )
 
-        if (count_product(products) >= 2):
-            self._gen_gokei(products)
-        if (len(products[0].joint_guarantors) > 0 and count_product(products) >= 2):
-            self._gen_kashitsuke_gokei(products)
-
-        # すべての商品の連帯保証人が等しくなるべき。
-        if not all(p.joint_guarantors == products[0].joint_guarantors for p in products):
-            raise RuntimeError('連帯保証人欄に不正があります。連帯保証人に関する項目はすべての列で同じ値を指定してください')
+        every = tuple(range(len(product_inputs)))
+        jobs: List[Tuple[RenderJob, Tuple[int, ...]]] = []
 
-        self._gen_rentaihosho(products)
-        self._gen_shinkokusho(products[0])
+        # 請求書合計などの集計帳票はすべての商品が揃ってから出力する
+        if (count_product(product_inputs) >= 2):
+            jobs.append((RenderJob('_gen_gokei'), every))
+        if (len(product_inputs[0].joint_guarantors) > 0 and count_product(product_inputs) >= 2):
+            jobs.append((RenderJob('_gen_kashitsuke_gokei'), every))
 
-        """
-        chacoを含む入力データかどうかをチェックする
-        """
-        def check_chacot(product_inputs:ProductInput):
-            for idx, product_input in enumerate(product_inputs):
-                if 'Chacot' in product_input.name:
-                    chacot_flg[0] = 1
-                    chacot_flg[1] += 1 
-                    chacot_flg[2] = idx -1
-                    chacot_flg[3] = idx
-                    
-        check_chacot(product_inputs)
+        jobs.append((RenderJob('_gen_rentaihosho'), (0, )))
+        jobs.append((RenderJob('_gen_shinkokusho', 0), (0, )))
 
         # 商品ごとの出力
-        for product, next_product in more_itertools.pairwise(itertools.chain(products, (None, ))):
-            for form_no, *_ in self.config.get_product_doc_info(product).items():
+        for idx, product_input in enumerate(product_inputs):
+            next_input = product_inputs[idx + 1] if idx + 1 < len(product_inputs) else None
+            for form_no, *_ in self.config.get_product_doc_info(product_input).items():
 
                 assert type(form_no) == int
 
-                src, dest = self.path_info(product.product_input, form_no)
-
-                # NOTE: form_noごとに文書を作成する。特殊な処理が必要なものについては
-                # self._gen_???? のような命名で専用の出力処理を作成してある。
-                # 特殊な処理が必要ない場合はこのifの分岐の最後でデフォルトの置換ロジックを
-                # 呼び出すような実装になっている。なので、特殊な出力をする(self._gen_????)
-                # をした場合はcontinue文を実行して後続のデフォルトの置換ロジックまで計算が
-                # 走らないようにする必要がある。
-
-                if form_no in output_root_form_no:
-                    # 直下に出力するものについては商品ごとの出力をする必要がないのでcontinue
+                # 直下に出力するものと実金シートは商品ごとのジョブにしない
+                if form_no in output_root_form_no or form_no in {7, 8, 9}:
                     continue
 
-                elif form_no == 1:  # 請求書
-                    # 70n and (2054 or 9054) は、2054 or 9054の請求書を作成し、70n分は出力しない
-                    if next_product is not None and next_product.name in {'2054', '9054'}:
-                        if product.name == '70N':
-                            # 作成しているのはproductのではなく、next_productであることに注意
-                            self._gen_bill(next_product, product)
-                            continue
-                        else:
-                            RuntimeError('2054, 9054の直前の列は70Nである必要があります')
-                    elif product.name in {'2054', '9054'}:
-                        continue  # 2054, 9054は直前のループによって作成されているため、スキップ
-                    else:
-                        self._gen_bill(product)
-                        continue
-
-                elif form_no == 2:  # 依頼書
-                    self._gen_iraisho(product)
-                    continue
+                if form_no in {1, 11, 12} and product_input.name == '70N' \
+                        and next_input is not None and next_input.name in {'2054', '9054'}:
+                    # 2054, 9054の請求書とDEEDは直前の70Nとセットで出力する
+                    indices: Tuple[int, ...] = (idx, idx + 1)
+                elif form_no == 19:
+                    # 金消Chacotには前の列の商品の物件目録も出力する
+                    indices = tuple(range(idx + 1))
+                else:
+                    indices = (idx, )
 
-                elif form_no == 3:  # 申告書
-                    # 申告書は契約者と連帯保証人ごとに出力するのでスキップ
-                    continue
+                jobs.append((RenderJob('_gen_product_doc', idx, form_no), indices))
 
-                elif form_no == 4:  # 金消
-                    self._gen_kinsho(product)
-                    continue
+        return jobs
 
-                elif form_no in {5, 6, 24, 25}:  # 事前説明書
-                    self._gen_jizen(product)
-                    continue
+    @staticmethod
+    def _job_name(product_inputs: List[ProductInput], job: RenderJob) -> str:
+        if job.form_no is None:
+            return aggregate_job_names.get(job.method, job.method)
+        assert job.index is not None
+        return f'様式{job.form_no} {job.index + 1}列目 {product_inputs[job.index].name}'
 
-                elif form_no in {7, 8, 9}:  # 実金シート
-                    continue
+    def _gen_job(self, products: List[Product], job: RenderJob):
+        """
+        ジョブひとつ分の帳票を出力する
+        """
+        method = getattr(self, job.method)
+        if job.form_no is not None:
+            method(products, job.index, job.form_no)
+        elif job.index is not None:
+            method(products[job.index])
+        else:
+            method(products)
+
+    def _gen_product_doc(self, products: List[Product], index: int, form_no: int):
+        """
+        index列目の商品の、様式番号form_noの帳票を出力する
+        """
+        product = products[index]
+        next_product = products[index + 1] if index + 1 < len(products) else None
 
-                elif form_no == 10:  # 大阪シート
-                    self._gen_osaka(product)
-                    continue
+        src, dest = self.path_info(product.product_input, form_no)
 
-                elif form_no in {11, 12}:  # DEED
-                    # 70n and (2054 or 9054) は2054 or 9054のdeedの書類を作成し、70n分は出力しない
-                    if next_product is not None and next_product.name in {'2054', '9054'}:
-                        if product.name == '70N':
-                            # 作成しているのはproductのではなく、next_productであることに注意
-                            self._gen_deed(next_product, product)
-                            continue
-                        else:
-                            RuntimeError('2054, 9054の直前の列は70Nである必要があります')
-                    elif product.name in {'2054', '9054'}:
-                        continue  # 2054, 9054は直前のループによって作成されているため、スキップ
-                    else:
-                        self._gen_deed(product)
-                        continue
-
-                elif form_no in {13, 14}:  # note
-                    # 後続のデフォルトの置換ロジックを用いるため、他の分岐とは違いcontinue
-                    # しない
-                    dest = before_ext.sub('_' + '_'.join([
-                        time_helper.strftime(product.contract_date, r'%Y%m%d'),
-                        product.customer_name,
-                        product.product_input.product_kv['ファイル名用住所'],
-                        product.name
-                    ]), dest, 1
-                    )
-                elif form_no == 19:  # 金消Chacot
-                    self._gen_kinsho_chacot(products, product)
-                    continue
+        # NOTE: form_noごとに文書を作成する。特殊な処理が必要なものについては
+        # self._gen_???? のような命名で専用の出力処理を作成してある。
+        # 特殊な処理が必要ない場合はこのifの分岐の最後でデフォルトの置換ロジックを
+        # 呼び出すような実装になっている。なので、特殊な出力をする(self._gen_????)
+        # をした場合はreturnして後続のデフォルトの置換ロジックまで計算が
+        # 走らないようにする必要がある。
+
+        if form_no in output_root_form_no:
+            # 直下に出力するものについては商品ごとの出力をする必要がないのでスキップ
+            return
+
+        elif form_no == 1:  # 請求書
+            # 70n and (2054 or 9054) は、2054 or 9054の請求書を作成し、70n分は出力しない
+            if next_product is not None and next_product.name in {'2054', '9054'}:
+                if product.name == '70N':
+                    # 作成しているのはproductのではなく、next_productであることに注意
+                    self._gen_bill(next_product, product)
+                    return
+                else:
+                    RuntimeError('2054, 9054の直前の列は70Nである必要があります')
+            elif product.name in {'2054', '9054'}:
+                return  # 2054, 9054は直前の列の出力で作成されているため、スキップ
+            else:
+                self._gen_bill(product)
+                return
+
+        elif form_no == 2:  # 依頼書
+            self._gen_iraisho(product)
+            return
+
+        elif form_no == 3:  # 申告書
+            # 申告書は契約者と連帯保証人ごとに出力するのでスキップ
+            return
+
+        elif form_no == 4:  # 金消
+            self._gen_kinsho(product)
+            return
+
+        elif form_no in {5, 6, 24, 25}:  # 事前説明書
+            self._gen_jizen(product)
+            return
+
+        elif form_no in {7, 8, 9}:  # 実金シート
+            return
+
+        elif form_no == 10:  # 大阪シート
+            self._gen_osaka(product)
+            return
+
+        elif form_no in {11, 12}:  # DEED
+            # 70n and (2054 or 9054) は2054 or 9054のdeedの書類を作成し、70n分は出力しない
+            if next_product is not None and next_product.name in {'2054', '9054'}:
+                if product.name == '70N':
+                    # 作成しているのはproductのではなく、next_productであることに注意
+                    self._gen_deed(next_product, product)
+                    return
+                else:
+                    RuntimeError('2054, 9054の直前の列は70Nである必要があります')
+            elif product.name in {'2054', '9054'}:
+                return  # 2054, 9054は直前の列の出力で作成されているため、スキップ
+            else:
+                self._gen_deed(product)
+                return
 
-                elif form_no in {20, 21}:
-                    src, dest = self.path_info(product.product_input, form_no)
-                    if product.product_input.product_kv['担保物件所有者区分（Ｃｈａｃｏｔ）'] == '別':
-                        src = before_ext.sub(
-                            f'{"別"}',
-                            src,
-                            count=1) 
-                    dest = before_ext.sub('_' + '_'.join([
-                        time_helper.strftime(product.contract_date, r'%Y%m%d'),
-                        product.customer_name,
-                        product.product_input.product_kv['ファイル名用住所'],
-                        product.name
-                    ]), dest, 1
-                    )
-                elif form_no == 23:
-                    if not (product.product_input.product_kv['担保物件所有者区分（Ｃｈａｃｏｔ）'] == '別' and product.state == 'GA'):
-                        continue
-                    dest = before_ext.sub('_' + '_'.join([
-                        time_helper.strftime(product.contract_date, r'%Y%m%d'),
-                        product.customer_name,
-                        product.product_input.product_kv['ファイル名用住所'],
-                        product.name
-                    ]), dest, 1
-                    )
+        elif form_no in {13, 14}:  # note
+            # 後続のデフォルトの置換ロジックを用いるため、他の分岐とは違いreturn
+            # しない
+            dest = before_ext.sub('_' + '_'.join([
+                time_helper.strftime(product.contract_date, r'%Y%m%d'),
+                product.customer_name,
+                product.product_input.product_kv['ファイル名用住所'],
+                product.name
+            ]), dest, 1
+            )
+        elif form_no == 19:  # 金消Chacot
+            self._gen_kinsho_chacot(products, product)
+            return
+
+        elif form_no in {20, 21}:
+            src, dest = self.path_info(product.product_input, form_no)
+            if product.product_input.product_kv['担保物件所有者区分（Ｃｈａｃｏｔ）'] == '別':
+                src = before_ext.sub(
+                    f'{"別"}',
+                    src,
+                    count=1) 
+            dest = before_ext.sub('_' + '_'.join([
+                time_helper.strftime(product.contract_date, r'%Y%m%d'),
+                product.customer_name,
+                product.product_input.product_kv['ファイル名用住所'],
+                product.name
+            ]), dest, 1
+            )
+        elif form_no == 23:
+            if not (product.product_input.product_kv['担保物件所有者区分（Ｃｈａｃｏｔ）'] == '別' and product.state == 'GA'):
+                return
+            dest = before_ext.sub('_' + '_'.join([
+                time_helper.strftime(product.contract_date, r'%Y%m%d'),
+                product.customer_name,
+                product.product_input.product_kv['ファイル名用住所'],
+                product.name
+            ]), dest, 1
+            )
 
-                elif form_no == 26:  # 依頼書chacot
-                    self._gen_iraisho_chacot(product)
-                    continue
-                else:
-                    dest = before_ext.sub('_' + '_'.join([
-                        time_helper.strftime(product.contract_date, r'%Y%m%d'),
-                        product.customer_name,
-                        product.product_input.product_kv['ファイル名用住所'],
-                        product.name
-                    ]), dest, 1
-                    )
-
-                os.makedirs(os.path.dirname(dest), exist_ok=True)
-                replace.replace(
-                    src, dest, ChainMap(
-                        self.config.get_kv_for_product(
-                            product.name, form_no, product.state),
-                        product.table_kv, product.product_input
-                    ))
-                word_to_pdf_2_pages_per_sheet(dest, os.path.splitext(dest)[0] + ".pdf")
+        elif form_no == 26:  # 依頼書chacot
+            self._gen_iraisho_chacot(product)
+            return
+        else:
+            dest = before_ext.sub('_' + '_'.join([
+                time_helper.strftime(product.contract_date, r'%Y%m%d'),
+                product.customer_name,
+                product.product_input.product_kv['ファイル名用住所'],
+                product.name
+            ]), dest, 1
+            )
 
-                logging_output(src, dest)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if manifest.output_document(
+                src, dest, ChainMap(
+                    self.config.get_kv_for_product(
+                        product.name, form_no, product.state),
+                    product.table_kv, product.product_input
+                ), word_to_pdf_2_pages_per_sheet):
+            logging_output(src, dest)
 
     def _gen_gokei(self, products: List[Product]):
         """
@@ -441,6 +728,7 @@ class ChohyoGenerator:
 
         # 各商品の行のスタイル
         style_src_cells = ws['A3:B3'][0]
+        styles = xl_helper.StyleInterner()
 
         # 2054,9054の直前にある70Nを取り除いた商品のリスト
         filtered_product = functools.reduce(
@@ -456,7 +744,7 @@ class ChohyoGenerator:
             if row[0].row >= 5:
                 for current, below in zip(*ws.iter_rows(row[0].row, row[0].row + 1, 1, 2)):
                     below.value = current.value
-                    xl_helper.copy_style(current, below)
+                    styles.copy(current, below)
             key_address_for_property_address = 'Ｐｒｏｐｅｒｔｙ　Ａｄｄ'
             key_total_billing_yen = '請求額合計（円）'
             row[0].value = product.product_input.get(
@@ -472,8 +760,7 @@ class ChohyoGenerator:
 
             # 4行目以降スタイルのコピペ
             if row[0].row >= 4:
-                for s, d in zip(style_src_cells, row):
-                    xl_helper.copy_style(s, d)
+                styles.copy_rows(style_src_cells, [row])
 
         ws.cell(row[0].row + 1, 2).value = f"=SUM(B3:B{row[0].row})"
 
@@ -482,12 +769,11 @@ class ChohyoGenerator:
              products[0].customer_name,
              ]), dest, 1)
         os.makedirs(os.path.dirname(dest), exist_ok=True)
-        wb.save(dest)
-        replace.replace(dest, dest, ChainMap(
-            products[0].table_kv,
-            products[0].product_input.product_kv,
-            self.config.get_kv_for_product(products[0].name, form_no, products[0].state)))
-        logging_output(src, dest)
+        if manifest.output_document(wb, dest, ChainMap(
+                products[0].table_kv,
+                products[0].product_input.product_kv,
+                self.config.get_kv_for_product(products[0].name, form_no, products[0].state))):
+            logging_output(src, dest)
 
         return wb
 
@@ -515,21 +801,15 @@ class ChohyoGenerator:
         key = '連帯保証人住所'
         keyword = f'{replace.keyword_quoter}{key}{replace.keyword_quoter}'
 
-        table = more_itertools.first_true(
-            docx.tables,
-            pred=lambda table: any(
-                keyword in run.text
-                for run in docx_helper.run_in_table(table))
-        )
+        table = docx_helper.first_table_containing(docx, keyword)
 
-        for joint_guarantor, run in zip(
+        for joint_guarantor, node in zip(
             itertools.chain(product.joint_guarantors,
                             itertools.repeat(JointGuarantor())),
-            (run for run in docx_helper.run_in_table(table)
-             if keyword in run.text)
+            docx_helper.text_nodes(table._tbl, keyword)
         ):
-            run.text = replace.replace_template_string(
-                run.text,
+            node.text = replace.replace_template_string(
+                node.text,
                 {key:  joint_guarantor.address},
                 src)
 
@@ -538,16 +818,13 @@ class ChohyoGenerator:
         row_height = 2
         for row in table.rows[row_height * (max(1, len(product.joint_guarantors)) + 1):]:
             table._tbl.remove(row._tr)
-
-        docx.save(dest)
-        replace.replace(dest, dest, ChainMap(
-            product.table_kv,
-            product.product_input,
-            self.config.get_kv_for_product(
-                product.name, form_no, product.state)
-        ))
-        word_to_pdf_2_pages_per_sheet(dest, os.path.splitext(dest)[0] + ".pdf")
-        logging_output(src, dest)
+        if manifest.output_document(docx, dest, ChainMap(
+                product.table_kv,
+                product.product_input,
+                self.config.get_kv_for_product(
+                    product.name, form_no, product.state)
+            ), word_to_pdf_2_pages_per_sheet):
+            logging_output(src, dest)
 
     def _gen_iraisho_chacot(self, product: Product):
         """
@@ -573,21 +850,15 @@ class ChohyoGenerator:
         key = '連帯保証人住所'
         keyword = f'{replace.keyword_quoter}{key}{replace.keyword_quoter}'
 
-        table = more_itertools.first_true(
-            docx.tables,
-            pred=lambda table: any(
-                keyword in run.text
-                for run in docx_helper.run_in_table(table))
-        )
+        table = docx_helper.first_table_containing(docx, keyword)
 
-        for joint_guarantor, run in zip(
+        for joint_guarantor, node in zip(
             itertools.chain(product.joint_guarantors,
                             itertools.repeat(JointGuarantor())),
-            (run for run in docx_helper.run_in_table(table)
-             if keyword in run.text)
+            docx_helper.text_nodes(table._tbl, keyword)
         ):
-            run.text = replace.replace_template_string(
-                run.text,
+            node.text = replace.replace_template_string(
+                node.text,
                 {key:  joint_guarantor.address},
                 src)
 
@@ -596,16 +867,13 @@ class ChohyoGenerator:
         row_height = 2
         for row in table.rows[row_height * (max(1, len(product.joint_guarantors)) + 1):]:
             table._tbl.remove(row._tr)
-
-        docx.save(dest)
-        replace.replace(dest, dest, ChainMap(
-            product.table_kv,
-            product.product_input,
-            self.config.get_kv_for_product(
-                product.name, form_no, product.state)
-        ))
-        word_to_pdf_2_pages_per_sheet(dest, os.path.splitext(dest)[0] + ".pdf")
-        logging_output(src, dest)
+        if manifest.output_document(docx, dest, ChainMap(
+                product.table_kv,
+                product.product_input,
+                self.config.get_kv_for_product(
+                    product.name, form_no, product.state)
+            ), word_to_pdf_2_pages_per_sheet):
+            logging_output(src, dest)
 
     def _gen_kashitsuke_gokei(self, products: List[Product]):
         """
@@ -628,6 +896,7 @@ class ChohyoGenerator:
 
         # 各商品の行のスタイル
         style_src_cells = ws['A2:E2'][0]
+        styles = xl_helper.StyleInterner()
 
         for row_idx, item_idx, product, row in zip(
                 itertools.count(2),
@@ -650,8 +919,7 @@ class ChohyoGenerator:
 
             # 3行目以降スタイルのコピペ
             if row_idx >= 3:
-                for s, d in zip(style_src_cells, row):
-                    xl_helper.copy_style(s, d)
+                styles.copy_rows(style_src_cells, [row])
 
         ws.cell(row_idx + 1, 1).value = None
         ws.cell(row_idx + 1, 2).value = None
@@ -665,14 +933,13 @@ class ChohyoGenerator:
             copy.copy(ws.cell(row_idx, 4).alignment)
 
         os.makedirs(os.path.dirname(dest), exist_ok=True)
-        wb.save(dest)
-        replace.replace(dest, dest, ChainMap(
-            product.table_kv,
-            product.product_input,
-            self.config.get_kv_for_product(
-                product.name, form_no, product.state)
-        ))
-        logging_output(src, dest)
+        if manifest.output_document(wb, dest, ChainMap(
+                product.table_kv,
+                product.product_input,
+                self.config.get_kv_for_product(
+                    product.name, form_no, product.state)
+            )):
+            logging_output(src, dest)
 
         return wb
 
@@ -715,10 +982,9 @@ class ChohyoGenerator:
             )
 
             docx = Document(src)
-            product_name_masters = [run for run in docx_helper.all_runs(
-                docx) if key_product_name_master in run.text]
-            bills = [run for run in docx_helper.all_runs(
-                docx) if key_bill_yen in run.text]
+            product_name_masters = list(docx_helper.all_text_nodes(
+                docx, key_product_name_master))
+            bills = list(docx_helper.all_text_nodes(docx, key_bill_yen))
 
             values = {
                 key_product_name_master + "１": all_product_70n_kv[key_product_name_master],
@@ -727,14 +993,13 @@ class ChohyoGenerator:
                 key_bill_yen + "２": product.product_input[key_bill_yen]
             }
 
-            for run in itertools.chain(product_name_masters, bills):
+            for node in itertools.chain(product_name_masters, bills):
 
-                if key_product_name_master in run.text or key_bill_yen in run.text:
-                    run.text = replace.replace_template_string(
-                        run.text, values, src)
+                if key_product_name_master in node.text or key_bill_yen in node.text:
+                    node.text = replace.replace_template_string(
+                        node.text, values, src)
 
-            docx.save(dest)
-            new_src = dest
+            new_src = docx
 
 
 
@@ -758,14 +1023,13 @@ class ChohyoGenerator:
 
 
 
-        replace.replace(new_src, dest, ChainMap(
-            product.table_kv,
-            product.product_input,
-            self.config.get_kv_for_product(
-                product.name, form_no, product.state)
-        ))
-        word_to_pdf_2_pages_per_sheet(dest, os.path.splitext(dest)[0] + ".pdf")
-        logging_output(src, dest)
+        if manifest.output_document(new_src, dest, ChainMap(
+                product.table_kv,
+                product.product_input,
+                self.config.get_kv_for_product(
+                    product.name, form_no, product.state)
+            ), word_to_pdf_2_pages_per_sheet):
+            logging_output(src, dest)
 
     def _gen_osaka(self, product: Product):
         """
@@ -799,9 +1063,12 @@ class ChohyoGenerator:
                 f"=G{idx-1} - E{idx}"
             )
 
-        src_wb = openpyxl.load_workbook(product.jikkin_path, data_only=True)
-
-        jikkin_sheet = cast(Worksheet, src_wb['実金'])
+        if product.schedule is not None:
+            # Pythonで計算した場合は、実金シートを読み込み直さずに計算結果を使う
+            jikkin_sheet: Union[Worksheet, Schedule] = product.schedule
+        else:
+            src_wb = openpyxl.load_workbook(product.jikkin_path, data_only=True)
+            jikkin_sheet = cast(Worksheet, src_wb['実金'])
 
         osaka_sheet_wb = openpyxl.load_workbook(src)
         osaka_sheet = cast(Worksheet, osaka_sheet_wb['Sheet1'])
@@ -818,6 +1085,7 @@ class ChohyoGenerator:
 
         osaka_sheet['G9'].value = product.table_kv['貸付元本額（￥）']
 
+        styles = xl_helper.StyleInterner()
         for jikkin_row, osaka_row in zipped_jikkin_osaka:
             if '合計' in str(jikkin_row[0].value):
                 osaka_row[1].value = '合計'
@@ -844,7 +1112,7 @@ class ChohyoGenerator:
                 values = gen_row(jikkin_row)(osaka_row[0].row)
                 for value, cell, style_src_cell in zip(values, osaka_row, zipped_jikkin_osaka[0][1]):
                     cell.value = value
-                    xl_helper.copy_style(style_src_cell, cell)
+                    styles.copy(style_src_cell, cell)
 
         #スタイルが1000行分適用されるため不要行の削除
         for osaka_row in reversed(range(max_rows, 1000)):
@@ -852,18 +1120,13 @@ class ChohyoGenerator:
             osaka_sheet.delete_rows(osaka_row)
 
         os.makedirs(os.path.dirname(dest), exist_ok=True)
-        osaka_sheet_wb.save(dest)
-        replace.replace(dest, dest, ChainMap(
-            product.table_kv,
-            product.product_input,
-            self.config.get_kv_for_product(
-                product.name, form_no, product.state)
-        ))
-        logging_output(src, dest)
-
-        # ExcelファイルをPDFに変換
-        pdf_dest = os.path.splitext(dest)[0] + '.pdf'
-        excel_to_pdf(dest, pdf_dest)
+        if manifest.output_document(osaka_sheet_wb, dest, ChainMap(
+                product.table_kv,
+                product.product_input,
+                self.config.get_kv_for_product(
+                    product.name, form_no, product.state)
+            ), excel_to_pdf):
+            logging_output(src, dest)
 
     def _gen_shinkokusho(self, product: Product):
         """
@@ -883,16 +1146,15 @@ class ChohyoGenerator:
             )
 
             os.makedirs(os.path.dirname(dest), exist_ok=True)
-            replace.replace(src, dest, ChainMap(
-                {'郵便番号': joint_guarantor.postal_code,
-                    '顧客住所': joint_guarantor.address},
-                product.table_kv,
-                product.product_input,
-                self.config.get_kv_for_product(
-                    product.name, form_no, product.state)
-            ))
-            word_to_pdf_2_pages_per_sheet(dest, os.path.splitext(dest)[0] + ".pdf")
-            logging_output(src, dest)
+            if manifest.output_document(src, dest, ChainMap(
+                    {'郵便番号': joint_guarantor.postal_code,
+                        '顧客住所': joint_guarantor.address},
+                    product.table_kv,
+                    product.product_input,
+                    self.config.get_kv_for_product(
+                        product.name, form_no, product.state)
+                ), word_to_pdf_2_pages_per_sheet):
+                logging_output(src, dest)
 
         # 個人契約者向けに出力
         if product.is_personal:
@@ -904,14 +1166,13 @@ class ChohyoGenerator:
                  ]), dest, 1
             )
             os.makedirs(os.path.dirname(dest), exist_ok=True)
-            replace.replace(src, dest, ChainMap(
-                product.table_kv,
-                product.product_input,
-                self.config.get_kv_for_product(
-                    product.name, form_no, product.state)
-            ))
-            word_to_pdf_2_pages_per_sheet(dest, os.path.splitext(dest)[0] + ".pdf")
-            logging_output(src, dest)
+            if manifest.output_document(src, dest, ChainMap(
+                    product.table_kv,
+                    product.product_input,
+                    self.config.get_kv_for_product(
+                        product.name, form_no, product.state)
+                ), word_to_pdf_2_pages_per_sheet):
+                logging_output(src, dest)
 
     def _gen_jizen(self, product: Product):
         """
@@ -948,23 +1209,17 @@ class ChohyoGenerator:
         key = '連帯保証人住所'
         keyword = f'{replace.keyword_quoter}{key}{replace.keyword_quoter}'
 
-        table = more_itertools.first_true(
-            docx.tables,
-            pred=lambda table: any(
-                keyword in run.text
-                for run in docx_helper.run_in_table(table))
-        )
+        table = docx_helper.first_table_containing(docx, keyword)
 
-        for joint_guarantor, run in zip(
+        for joint_guarantor, node in zip(
             itertools.chain(
                 product.joint_guarantors,
                 itertools.repeat(JointGuarantor())
             ),
-            (run for run in docx_helper.run_in_table(table)
-             if keyword in run.text)
+            docx_helper.text_nodes(table._tbl, keyword)
         ):
-            run.text = replace.replace_template_string(
-                run.text,
+            node.text = replace.replace_template_string(
+                node.text,
                 {key: joint_guarantor.address},
                 src)
 
@@ -974,17 +1229,15 @@ class ChohyoGenerator:
         for row in table.rows[row_height * (max(1, len(product.joint_guarantors)) + 1):]:
             table._tbl.remove(row._tr)
 
-        docx.save(dest)
-        new_src = dest
+        new_src = docx
 
-        replace.replace(new_src, dest, ChainMap(
-            product.table_kv,
-            product.product_input,
-            self.config.get_kv_for_product(
-                product.name, form_no, product.state)
-        ))
-        word_to_pdf_2_pages_per_sheet(dest, os.path.splitext(dest)[0] + ".pdf")
-        logging_output(src, dest)
+        if manifest.output_document(new_src, dest, ChainMap(
+                product.table_kv,
+                product.product_input,
+                self.config.get_kv_for_product(
+                    product.name, form_no, product.state)
+            ), word_to_pdf_2_pages_per_sheet):
+            logging_output(src, dest)
 
     def _gen_deed(self, product: Product, product_70n: Optional[Product] = None):
         """
@@ -1022,23 +1275,21 @@ class ChohyoGenerator:
                 "最終弁済日２": product.product_input['最終弁済日']
             }
 
-            for run in docx_helper.all_runs(docx):
+            for node in docx_helper.all_text_nodes(docx, replace.keyword_quoter):
 
-                if "金消契約日" in run.text or "最終弁済日" in run.text:
-                    run.text = replace.replace_template_string(
-                        run.text, values, src)
+                if "金消契約日" in node.text or "最終弁済日" in node.text:
+                    node.text = replace.replace_template_string(
+                        node.text, values, src)
 
-            docx.save(dest)
-            new_src = dest
+            new_src = docx
 
-        replace.replace(new_src, dest, ChainMap(
-            product.table_kv,
-            product.product_input,
-            self.config.get_kv_for_product(
-                product.name, form_no, product.state)
-        ))
-        word_to_pdf_2_pages_per_sheet(dest, os.path.splitext(dest)[0] + ".pdf")
-        logging_output(src, dest)
+        if manifest.output_document(new_src, dest, ChainMap(
+                product.table_kv,
+                product.product_input,
+                self.config.get_kv_for_product(
+                    product.name, form_no, product.state)
+            ), word_to_pdf_2_pages_per_sheet):
+            logging_output(src, dest)
 
     def _gen_rentaihosho(self, products: Iterable[Product]):
         """
@@ -1061,10 +1312,10 @@ class ChohyoGenerator:
                         joint_guarantor.name
                         ]
                     ), dst, 1)
-                replace.replace(
-                    input_file_path=src,
-                    output_file_path=output_file_path,
-                    replace_dict=ChainMap(
+                manifest.output_document(
+                    src,
+                    output_file_path,
+                    ChainMap(
                         {  # product_input は未加工のsplit前のものが入っているので、こちらでうわがき
                             "連帯保証人名": joint_guarantor.name,
                             "連帯保証人住所": joint_guarantor.address,
@@ -1073,8 +1324,7 @@ class ChohyoGenerator:
                         product.table_kv,
                         self.config.get_kv_for_product(
                             product.name, form_no, product.state)
-                    ))
-                word_to_pdf_2_pages_per_sheet(output_file_path, os.path.splitext(output_file_path)[0] + ".pdf")
+                    ), word_to_pdf_2_pages_per_sheet)
 
     def _gen_kinsho(self, product: Product):
         form_no = 4
@@ -1091,32 +1341,28 @@ class ChohyoGenerator:
             src,
             1)
         docx = Document(src)
-        table = more_itertools.first_true(docx.tables,  pred=lambda table: any(
-            template_key in run.text for run in docx_helper.run_in_table(table)))
+        table = docx_helper.first_table_containing(docx, template_key)
 
-        table_runs = [run
-                      for run in docx_helper.run_in_table(table)
-                      if template_key in run.text
-                      ]
+        table_nodes = list(docx_helper.text_nodes(table._tbl, template_key))
 
         # 連帯保証人住所を出現順に置換する。
-        for joint_guarantor, run in zip(
+        for joint_guarantor, node in zip(
             itertools.chain(
                 product.joint_guarantors,
                 itertools.repeat(JointGuarantor())),
-            table_runs,
+            table_nodes,
         ):
 
-            if run is None:
+            if node is None:
                 raise RuntimeError(
                     f'{src}に含まれている{key}のテーブルの数が足りません。テンプレート側のテーブルの行数を増やしてから再度実行してください。')
             if joint_guarantor is not None:
-                run.text = replace.replace_template_string(
-                    run.text,
+                node.text = replace.replace_template_string(
+                    node.text,
                     {key: joint_guarantor.address},
                     src)
             else:
-                run.text = ''  # タグを消す。
+                node.text = ''  # タグを消す。
 
         # 余ったtableの行を削除
         # 連帯保証人は最低1行残す
@@ -1139,14 +1385,12 @@ class ChohyoGenerator:
 
         )
         os.makedirs(os.path.dirname(dest), exist_ok=True)
-        docx.save(dest)
-        replace.replace(dest, dest, ChainMap(
-            kinsho_kv,
-            product.table_kv,
-            product.product_input
-        ))
-        word_to_pdf_2_pages_per_sheet(dest, os.path.splitext(dest)[0] + ".pdf")
-        logging_output(src, dest)
+        if manifest.output_document(docx, dest, ChainMap(
+                kinsho_kv,
+                product.table_kv,
+                product.product_input
+            ), word_to_pdf_2_pages_per_sheet):
+            logging_output(src, dest)
 
     def _gen_kinsho_chacot(self, products, product: Product):
         form_no = 19
@@ -1169,32 +1413,28 @@ class ChohyoGenerator:
                 src,
                 count=1) 
         docx = Document(src)
-        table = more_itertools.first_true(docx.tables,  pred=lambda table: any(
-            template_key in run.text for run in docx_helper.run_in_table(table)))
+        table = docx_helper.first_table_containing(docx, template_key)
 
-        table_runs = [run
-                      for run in docx_helper.run_in_table(table)
-                      if template_key in run.text
-                      ]
+        table_nodes = list(docx_helper.text_nodes(table._tbl, template_key))
 
         # 連帯保証人住所を出現順に置換する。
-        for joint_guarantor, run in zip(
+        for joint_guarantor, node in zip(
             itertools.chain(
                 product.joint_guarantors,
                 itertools.repeat(JointGuarantor())),
-            table_runs,
+            table_nodes,
         ):
 
-            if run is None:
+            if node is None:
                 raise RuntimeError(
                     f'{src}に含まれている{key}のテーブルの数が足りません。テンプレート側のテーブルの行数を増やしてから再度実行してください。')
             if joint_guarantor is not None:
-                run.text = replace.replace_template_string(
-                    run.text,
+                node.text = replace.replace_template_string(
+                    node.text,
                     {key: joint_guarantor.address},
                     src)
             else:
-                run.text = ''  # タグを消す。
+                node.text = ''  # タグを消す。
         
         """
         表のコピーを行う
@@ -1249,16 +1489,13 @@ class ChohyoGenerator:
             for cell in table._cells:
                 if '＜別紙＞ 物件目録-●物件番号●（本件不動産）' in cell.text:
                     products[cnt].product_input.product_kv['物件番号'] = str(cnt + 1)
-                    for run in docx_helper.run_in_table(table):
-                        if isinstance(run.text, str):
-                            replaced_str = replace.replace_template_string(
-                                run.text, ChainMap(
-                                    kinsho_kv,
-                                    products[cnt].table_kv,
-                                    products[cnt].product_input
-                                ), dest)
-                            if run.text is not replaced_str:
-                                run.text = replaced_str
+                    for paragraph in docx_helper.paragraph_in_table(table):
+                        replace.replace_paragraph(
+                            paragraph, ChainMap(
+                                kinsho_kv,
+                                products[cnt].table_kv,
+                                products[cnt].product_input
+                            ), dest)
                     cnt += 1
 
         if cnt == 0:
@@ -1266,16 +1503,45 @@ class ChohyoGenerator:
 
         product.product_input.product_kv['物件番号'] = str(cnt + 1)
         os.makedirs(os.path.dirname(dest), exist_ok=True)
-        docx.save(dest)
-        replace.replace(dest, dest, ChainMap(
-            kinsho_kv,
-            product.table_kv,
-            product.product_input
-        ))
-        word_to_pdf_2_pages_per_sheet(dest, os.path.splitext(dest)[0] + ".pdf")
-        logging_output(src, dest)
+        if manifest.output_document(docx, dest, ChainMap(
+                kinsho_kv,
+                product.table_kv,
+                product.product_input
+            ), word_to_pdf_2_pages_per_sheet):
+            logging_output(src, dest)
+
 
 
+    def jikkin_path(self, product_input: ProductInput) -> Tuple[str, str]:
+        """
+        商品の実金シートの(テンプレートのパス, 出力先のパス)を返す
+        """
+        if not isinstance(product_input, ProductInput):
+            raise TypeError()
+        form_no, filename = more_itertools.first_true(
+            self.config.get_product_doc_info(product_input).items(),
+            default=(None, None),
+            pred=lambda x: (x[0] in {7, 8, 9} and x[1] is not None)
+        )
+        if filename is None:
+            raise RuntimeError(
+                f'{product_input.name}に対して有効な実金テンプレートが見つかりません。設定情報が正しく設定されていることをご確認ください。')
+
+        template_path, output_path = self.path_info(
+            product_input, form_no)
+        output_path = before_ext.sub(
+            '_' + '_'.join([
+                time_helper.strftime(
+                    product_input.contract_date, r'%Y%m%d'
+                ),
+                product_input.customer_name.strip(),
+                product_input.product_kv['ファイル名用住所'],
+                product_input.name.strip()
+            ]),
+            output_path,
+            1)
+
+        return (template_path, output_path)
 
     def path_info(self, product_input: ProductInput, form_no: int) -> Tuple[str, str]:
         """
@@ -4,17 +4,20 @@
 
 from app.model import Product, ProductInput
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import date, datetime, time, timedelta
 from logging import getLogger
-from more_itertools import first_true
 from openpyxl.cell.cell import Cell
 from openpyxl.reader.excel import load_workbook
 from openpyxl.workbook.workbook import Workbook
 from openpyxl.worksheet._read_only import ReadOnlyWorksheet
+from types import MappingProxyType
 from typing import Any, Callable, Dict, List, Mapping, NamedTuple, Optional, Tuple, Union, cast
+import hashlib
 import itertools
-import more_itertools
+import json
+import os
 import re
+import tempfile
 
 logger = getLogger(__name__)
 
@@ -84,6 +87,44 @@ class Config:
         self.__keywords_rep_by_product = keywords_rep_by_product
         self.__global = keywords_global
 
+        # 読み込み時に索引を作っておき、設定情報の行数によらず一定の時間で引けるようにする
+
+        # 商品区分 -> 出力様式一覧の行 (設定情報の順)
+        self.__mapping_by_product: Dict[str, List[Tuple[ConfigValue, ...]]] = {}
+        # (商品区分, 様式番号) -> 出力様式一覧の最初の行
+        self.__mapping_by_product_form: Dict[Tuple[str, int], Tuple[ConfigValue, ...]] = {}
+        # 商品区分 -> 実金シートの様式番号
+        self.__jikkin_form_no: Dict[str, int] = {}
+        for record in mapping:
+            product_name, form_no, _, file_name = record
+            self.__mapping_by_product.setdefault(product_name, []).append(record)
+            self.__mapping_by_product_form.setdefault((product_name, form_no), record)
+            if form_no in range(7, 10) and file_name is None:
+                self.__jikkin_form_no.setdefault(product_name, form_no)
+
+        # (商品区分, 様式番号) -> [(項目名, 内容)]
+        self.__rep_by_product: Dict[Tuple[str, int], List[Tuple[str, Any]]] = {}
+        for product_record in keywords_rep_by_product:
+            self.__rep_by_product.setdefault(
+                (product_record.name, product_record.form_no), []
+            ).append((product_record.key, product_record.value))
+
+        # (様式番号, 州名) -> [(項目名, 内容)]
+        self.__rep_by_state: Dict[Tuple[int, str], List[Tuple[str, Any]]] = {}
+        for state_record in keywords_rep_by_states:
+            self.__rep_by_state.setdefault(
+                (state_record.form_no, state_record.state), []
+            ).append((state_record.key, state_record.value))
+
+        # (商品区分, 様式番号, 州名) -> 置換キーワード
+        self.__kv_for_product: Dict[Tuple[str, int, str], Mapping[str, Any]] = {}
+
+    def __reduce__(self):
+        # プロセスプールのワーカーには設定情報の行だけを渡し、索引はワーカーで作り直す。
+        # 置換キーワードのキャッシュ(MappingProxyType)はpickleできないので渡さない
+        return (Config, (self.__mapping, self.__keywords_rep_by_state,
+                         self.__keywords_rep_by_product, self.__global))
+
     def __specialize_filename(self, template_filename: str, form_no: int, state: str, fiance: bool) -> str:
         """
         設定情報から取得したテンプレートファイル名を州ごとに別名に変更するなどの特殊化を行う
@@ -130,14 +171,22 @@ class Config:
 
         return template_filename
 
-    def get_kv_for_product(self, product_name: str, form_no: int, product_state: str) -> Dict[str, Any]:
-        keywords = {k: v for k, v in itertools.chain(
-            ((record.key, record.value) for record in self.__keywords_rep_by_product
-             if record.name == product_name and record.form_no == form_no),
-            ((record.key, record.value) for record in self.__keywords_rep_by_state
-             if record.form_no == form_no and record.state == product_state),
-            self.__global
-        )}
+    def get_kv_for_product(self, product_name: str, form_no: int, product_state: str) -> Mapping[str, Any]:
+        """
+        商品区分、様式番号、州名に対応する置換キーワードを返す。
+        同じ項目名がある場合は、商品による差し替え、州による差し替え、マスタの順に後のものが優先される。
+
+        結果は組み合わせごとに一度だけ作って使い回すので、変更できないMappingを返す
+        """
+        key = (product_name, form_no, product_state)
+        keywords = self.__kv_for_product.get(key)
+        if keywords is None:
+            keywords = MappingProxyType({k: v for k, v in itertools.chain(
+                self.__rep_by_product.get((product_name, form_no), ()),
+                self.__rep_by_state.get((form_no, product_state), ()),
+                self.__global
+            )})
+            self.__kv_for_product[key] = keywords
 
         return keywords
 
@@ -146,19 +195,15 @@ class Config:
         商品情報から様式区分とテンプレート名の組を返す
         """
         value = {form_no: self.__specialize_filename(file_name, form_no, product.state, product.fiance is not None)
-                 for product_name, form_no, _, file_name in self.__mapping
-                 if product_name == product.name
+                 for _, form_no, _, file_name in self.__mapping_by_product.get(product.name, ())
                  if file_name is not None
                  }
 
         return value
 
     def get_template_filename(self, product: Product, form_no: int) -> str:
-        _, _, _, template_filename = first_true(
-            self.__mapping,
-            default=(None, None, None, None),
-            pred=lambda record: record[0] == product.name and record[1] == form_no,
-        )
+        _, _, _, template_filename = self.__mapping_by_product_form.get(
+            (product.name, form_no), (None, None, None, None))
 
         if template_filename is None:
             raise RuntimeError(
@@ -168,14 +213,7 @@ class Config:
 
     def get_jikkin_sheet_form_no(self, product_name: str) -> int:
 
-        _, form_no, *_ = more_itertools.first_true(
-            self.__mapping,
-            (None,) * 4,
-            pred=lambda tp: all((
-                tp[0] == product_name,
-                tp[1] in range(7, 10),
-                tp[3] is None))
-        )
+        form_no = self.__jikkin_form_no.get(product_name)
         if form_no == None:
             raise RuntimeError(
                 f'{product_name}に該当する実金シートの様式区分が存在しません。設定情報を確認してください')
@@ -187,8 +225,21 @@ def load_config_from_workbook(config_xlsx_path: str) -> Config:
     """
     設定情報.xlxsをもとに設定情報オブジェクトを構築する
     """
+    return Config(*read_config_records(config_xlsx_path))
+
+
+ConfigRecords = Tuple[List[Tuple[ConfigValue, ...]],
+                      List[RepByStateRecord],
+                      List[RepByProductRecord],
+                      List[Tuple[str, ...]]]
+
+
+def read_config_records(config_xlsx_path: str) -> ConfigRecords:
+    """
+    設定情報.xlsxの各シートを読み取り専用モードで上から順に読み、Configの材料となるレコードを返す
+    """
 
-    wb = load_workbook(config_xlsx_path, data_only=True)
+    wb = load_workbook(config_xlsx_path, read_only=True, data_only=True)
     output_mapping_sheet = cast(ReadOnlyWorksheet, wb['出力様式一覧'])
     sheet_replace_by_state = cast(ReadOnlyWorksheet, wb["州による文章差し替え"])
     sheeet_replace_by_product = cast(ReadOnlyWorksheet, wb['商品による文書差し替え'])
@@ -198,30 +249,185 @@ def load_config_from_workbook(config_xlsx_path: str) -> Config:
         ls[idx] = f(ls[idx])
         return ls
 
-    # 商品区分, 様式番号, 様式名, テンプレートファイル名
-    mapping = [
-        tuple(update_at([cell_normalize(cell) for cell in row], 0, str))
-        for row in output_mapping_sheet[f'B2:E{output_mapping_sheet.max_row}']
-        if any(cell.value is not None for cell in row)
-    ]
-
-    # 様式番号, 様式名, 項目名, アメリカ州, 内容
-    replace_by_states = [
-        RepByStateRecord(*(cell_normalize(cell) for cell in row))
-        for row in sheet_replace_by_state[f'B2:F{sheet_replace_by_state.max_row}']
-        if any(cell.value is not None for cell in row)
-    ]
-
-    # 商品区分, 様式番号, 様式名, 項目名, 内容
-    replace_by_product = [
-        RepByProductRecord(
-            *update_at([cell_normalize(cell) for cell in row], 0, str))
-        for row in sheeet_replace_by_product[f'B2:F{sheeet_replace_by_product.max_row}']
-        if any(cell.value is not None for cell in row)
-    ]
-
-    # 項目名, 内容
-    global_mapping = [tuple(map(cell_normalize, row))
-                      for row in sheeet_global[f'B2:C{sheeet_global.max_row}']]
-
-    return Config(mapping, replace_by_states, replace_by_product, global_mapping)
+    def rows(ws: ReadOnlyWorksheet, min_col: int, max_col: int):
+        # 読み取り専用モードではブックに保存された範囲(dimension)までしか読まないが、
+        # 実際のセルより小さいことがあるので範囲を消してすべての行を読む。書式だけの空行は呼び出し側で除く
+        ws.reset_dimensions()
+        return ws.iter_rows(min_row=2, min_col=min_col, max_col=max_col)
+
+    try:
+        # 商品区分, 様式番号, 様式名, テンプレートファイル名
+        mapping = [
+            tuple(update_at([cell_normalize(cell) for cell in row], 0, str))
+            for row in rows(output_mapping_sheet, 2, 5)
+            if any(cell.value is not None for cell in row)
+        ]
+
+        # 様式番号, 様式名, 項目名, アメリカ州, 内容
+        replace_by_states = [
+            RepByStateRecord(*(cell_normalize(cell) for cell in row))
+            for row in rows(sheet_replace_by_state, 2, 6)
+            if any(cell.value is not None for cell in row)
+        ]
+
+        # 商品区分, 様式番号, 様式名, 項目名, 内容
+        replace_by_product = [
+            RepByProductRecord(
+                *update_at([cell_normalize(cell) for cell in row], 0, str))
+            for row in rows(sheeet_replace_by_product, 2, 6)
+            if any(cell.value is not None for cell in row)
+        ]
+
+        # 項目名, 内容
+        # 読み取り専用モードでは書式だけの空行も返ってくるので、他のシートと同じく空行は除く
+        global_mapping = [tuple(map(cell_normalize, row))
+                          for row in rows(sheeet_global, 2, 3)
+                          if any(cell.value is not None for cell in row)]
+    finally:
+        wb.close()
+
+    return (mapping, replace_by_states, replace_by_product, global_mapping)
+
+
+# スナップショットの形式を変えた場合はこの値を変更すること
+snapshot_version = 2
+
+
+def snapshot_path(config_xlsx_path: str, snapshot_dir: str) -> str:
+    """
+    設定情報.xlsxに対応するスナップショットのパスを返す
+    """
+    name = hashlib.sha1(os.path.abspath(
+        config_xlsx_path).encode('utf-8')).hexdigest()
+    return os.path.join(snapshot_dir, f'config_{name}.json')
+
+
+def default_snapshot_dir() -> str:
+    """
+    スナップショットを保存する既定のフォルダ。一時フォルダは他のユーザーと共有されることがあるので、
+    ユーザーごとに分ける
+    """
+    user = str(os.getuid()) if hasattr(os, 'getuid') else ''
+    return os.path.join(tempfile.gettempdir(), f'ibnet_contract-{user}' if user else 'ibnet_contract')
+
+
+def _private_snapshot_dir(snapshot_dir: str) -> bool:
+    """
+    snapshot_dirを自分だけが書き込めるフォルダとして作る。
+    他のユーザーが作ったフォルダや、他のユーザーも書き込めるフォルダの場合はFalse
+    """
+    os.makedirs(snapshot_dir, mode=0o700, exist_ok=True)
+    if not hasattr(os, 'getuid'):
+        # Windowsの一時フォルダはユーザーごとに分かれている
+        return True
+    stat = os.stat(snapshot_dir)
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+
+def _encode_value(value: Any) -> Any:
+    # JSONにない日時の値は、型の名前とISO形式の文字列にする
+    if isinstance(value, datetime):
+        return {'datetime': value.isoformat()}
+    if isinstance(value, date):
+        return {'date': value.isoformat()}
+    if isinstance(value, time):
+        return {'time': value.isoformat()}
+    if isinstance(value, timedelta):
+        return {'timedelta': value.total_seconds()}
+    raise TypeError(f'{type(value).__name__}の値はスナップショットに保存できません')
+
+
+def _decode_value(obj: Dict[str, Any]) -> Any:
+    if 'datetime' in obj:
+        return datetime.fromisoformat(obj['datetime'])
+    if 'date' in obj:
+        return date.fromisoformat(obj['date'])
+    if 'time' in obj:
+        return time.fromisoformat(obj['time'])
+    if 'timedelta' in obj:
+        return timedelta(seconds=obj['timedelta'])
+    return obj
+
+
+def _records_from_json(records: List[List[List[Any]]]) -> ConfigRecords:
+    mapping, replace_by_states, replace_by_product, global_mapping = records
+    return ([tuple(r) for r in mapping],
+            [RepByStateRecord(*r) for r in replace_by_states],
+            [RepByProductRecord(*r) for r in replace_by_product],
+            [tuple(r) for r in global_mapping])
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_config(config_xlsx_path: str, snapshot_dir: Optional[str] = None) -> Config:
+    """
+    設定情報.xlsxを読み込む。
+
+    読み込んだレコードはローカルのスナップショット(JSON)に保存しておき、次回以降は設定情報.xlsxの
+    サイズと更新日時が同じであればスナップショットから読み込む。サイズか更新日時が異なる場合でも、
+    中身のハッシュが同じであればスナップショットを使う。
+    スナップショットが使えない場合は設定情報.xlsxを読み込み、スナップショットを作り直す。
+    スナップショットのフォルダが自分だけが書き込めるフォルダでない場合は、スナップショットを使わない
+    """
+    if snapshot_dir is None:
+        snapshot_dir = os.environ.get('CONFIG_CACHE_DIR', default_snapshot_dir())
+
+    try:
+        if not _private_snapshot_dir(snapshot_dir):
+            logger.warning(f'{snapshot_dir}は他のユーザーも書き込めるため、設定情報のスナップショットを使いません')
+            return Config(*read_config_records(config_xlsx_path))
+    except OSError as e:
+        logger.warning(f'設定情報のスナップショットのフォルダ{snapshot_dir}を作成できませんでした: {e}')
+        return Config(*read_config_records(config_xlsx_path))
+
+    path = snapshot_path(config_xlsx_path, snapshot_dir)
+    stat = os.stat(config_xlsx_path)
+
+    snapshot: Optional[Dict[str, Any]] = None
+    try:
+        with open(path, encoding='utf-8') as f:
+            snapshot = json.load(f, object_hook=_decode_value)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f'設定情報のスナップショット{path}を読み込めませんでした: {e}')
+
+    if snapshot is not None and snapshot.get('version') != snapshot_version:
+        snapshot = None
+
+    if snapshot is not None \
+            and snapshot['size'] == stat.st_size \
+            and snapshot['mtime_ns'] == stat.st_mtime_ns:
+        logger.debug(f'設定情報をスナップショット{path}から読み込みます')
+        return Config(*_records_from_json(snapshot['records']))
+
+    sha256 = file_sha256(config_xlsx_path)
+    if snapshot is not None and snapshot['sha256'] == sha256:
+        logger.debug(f'設定情報の内容に変更がないため、スナップショット{path}から読み込みます')
+        records = _records_from_json(snapshot['records'])
+    else:
+        logger.debug(f'{config_xlsx_path}を読み込みます')
+        records = read_config_records(config_xlsx_path)
+
+    try:
+        # 書き込み途中のファイルを読まないように、一時ファイルに書いてから置き換える
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'version': snapshot_version,
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'sha256': sha256,
+                'records': records,
+            }, f, ensure_ascii=False, default=_encode_value)
+        os.replace(tmp_path, path)
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning(f'設定情報のスナップショット{path}を保存できませんでした: {e}')
+
+    return Config(*records)
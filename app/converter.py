@@ -0,0 +1,422 @@
+"""
+帳票のPDF変換と、実金シートの再計算を行うバックエンド
+
+- com: WordとExcelのアプリケーション(Windowsのみ)
+- libreoffice: ヘッドレスで起動したLibreOfficeのプロセス(UNO)
+
+どちらもアプリケーションやプロセスを一度だけ起動し、複数の帳票の変換で使い回す。
+使うバックエンドは環境変数CONVERTER_BACKENDで指定し、`get`で取得する
+"""
+
+from contextlib import contextmanager
+from logging import getLogger
+from typing import Any, Callable, Iterator, List, Optional
+import atexit
+import os
+import pathlib
+import platform
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+logger = getLogger(__name__)
+
+# ファイル名にこの文字列を含むWord文書は、1枚に2ページずつ印刷したPDFにする
+two_pages_per_sheet_marker = '【集約印刷】'
+
+
+class Converter:
+    """
+    変換処理のバックエンドの共通のインターフェース
+    """
+
+    def word_to_pdf(self, input_file: str, output_file: str):
+        """
+        Word文書をPDFに変換する
+        """
+        raise NotImplementedError()
+
+    def excel_to_pdf(self, input_file: str, output_file: str):
+        """
+        Excelブックの最初のシートをPDFに変換する
+        """
+        raise NotImplementedError()
+
+    def recalculate(self, path: str):
+        """
+        Excelブックのすべての数式を再計算し、計算結果とともに同じファイルに保存する
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """
+        起動したアプリケーションやプロセスを終了する
+        """
+
+
+class ComConverter(Converter):
+    """
+    WordとExcelをCOMで操作するバックエンド。
+
+    アプリケーションは最初に使うときに起動し、`close`まで終了せずに使い回す。
+    COMのオブジェクトは起動したスレッドでしか使えないので、変換はロックで直列化する
+    """
+
+    def __init__(self):
+        # pywin32はWindowsにしかないので、このバックエンドを使うときに読み込む
+        import win32com.client
+        import win32print
+        import pywintypes
+        self._win32 = win32com.client
+        self._win32print = win32print
+        self._com_error = pywintypes.com_error
+        self._word: Any = None
+        self._excel: Any = None
+        self._lock = threading.Lock()
+
+    def _application(self, name: str) -> Any:
+        # Dispatchだと起動中のアプリケーションにつながり、並列に出力する別のプロセスと
+        # 同じインスタンスを使ってしまうので、DispatchExで専用のインスタンスを起動する
+        app = self._win32.gencache.EnsureDispatch(self._win32.DispatchEx(name))
+        app.Visible = False
+        app.DisplayAlerts = False
+        return app
+
+    def _with_retry(self, f: Callable[[], None]):
+        # アプリケーションが異常終了していた場合は、起動し直して一度だけやり直す
+        with self._lock:
+            try:
+                f()
+            except self._com_error as e:
+                logger.warning(f'Office のアプリケーションを再起動します: {e}')
+                self._quit()
+                f()
+
+    def word_to_pdf(self, input_file: str, output_file: str):
+        def convert():
+            if self._word is None:
+                self._word = self._application('Word.Application')
+            word = self._word
+            constants = self._win32.constants
+
+            doc = word.Documents.Open(os.path.abspath(input_file))
+            try:
+                if two_pages_per_sheet_marker in input_file:
+                    # 1枚に2ページ単位で印刷する設定
+                    word.ActivePrinter = self._win32print.GetDefaultPrinter()
+                    word.PrintOut(
+                        OutputFileName=os.path.abspath(output_file),
+                        Item=constants.wdPrintDocumentContent,
+                        Copies=1,
+                        Pages="1-2",
+                        Collate=True,
+                        Background=False,
+                        PrintToFile=True,
+                        Range=constants.wdPrintAllDocument,
+                        ManualDuplexPrint=False,
+                        PrintZoomColumn=2,
+                        PrintZoomRow=1,
+                        PrintZoomPaperWidth=0,
+                        PrintZoomPaperHeight=0
+                    )
+                else:
+                    # 通常のPDF化を行う
+                    doc.SaveAs(os.path.abspath(output_file),
+                               FileFormat=constants.wdFormatPDF)
+            finally:
+                doc.Close(SaveChanges=False)
+
+        self._with_retry(convert)
+
+    def _open_workbook(self, path: str) -> Any:
+        if self._excel is None:
+            self._excel = self._application('Excel.Application')
+        return self._excel.Workbooks.Open(os.path.abspath(path))
+
+    def excel_to_pdf(self, input_file: str, output_file: str):
+        def convert():
+            book = self._open_workbook(input_file)
+            try:
+                book.Worksheets(1).Select()
+                book.ActiveSheet.ExportAsFixedFormat(
+                    self._win32.constants.xlTypePDF, os.path.abspath(output_file))
+            finally:
+                book.Close(SaveChanges=False)
+
+        self._with_retry(convert)
+
+    def recalculate(self, path: str):
+        def calculate():
+            book = self._open_workbook(path)
+            try:
+                self._excel.CalculateFull()
+                book.Save()
+            finally:
+                book.Close(SaveChanges=False)
+
+        self._with_retry(calculate)
+
+    def _quit(self):
+        for app in (self._word, self._excel):
+            if app is None:
+                continue
+            try:
+                app.Quit()
+            except self._com_error:
+                pass
+        self._word = None
+        self._excel = None
+
+    def close(self):
+        with self._lock:
+            self._quit()
+
+
+class _Office:
+    """
+    ヘッドレスで起動したLibreOfficeのプロセスひとつと、UNOでの接続
+    """
+
+    def __init__(self, soffice: str, name: str, startup_timeout: float):
+        import uno
+        self._uno = uno
+
+        # 同じプロファイルを複数のプロセスで使うことはできないので、プロセスごとに作る
+        self.profile = tempfile.mkdtemp(prefix=f'{name}_profile_')
+        self.process = subprocess.Popen(
+            [soffice, '--headless', '--invisible', '--nologo', '--nodefault',
+             '--norestore', '--nofirststartwizard', '--nocrashreport',
+             f'-env:UserInstallation={pathlib.Path(self.profile).as_uri()}',
+             f'--accept=pipe,name={name};urp;StarOffice.ComponentContext'],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        local = uno.getComponentContext()
+        resolver = local.ServiceManager.createInstanceWithContext(
+            'com.sun.star.bridge.UnoUrlResolver', local)
+        deadline = time.monotonic() + startup_timeout
+        while True:
+            try:
+                context = resolver.resolve(
+                    f'uno:pipe,name={name};urp;StarOffice.ComponentContext')
+                break
+            except Exception:
+                # 起動が終わるまでは接続できない
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    self.terminate()
+                    raise RuntimeError(
+                        f'LibreOffice({soffice})を起動できませんでした。SOFFICE_PATHを確認してください')
+                time.sleep(0.2)
+
+        self.desktop = context.ServiceManager.createInstanceWithContext(
+            'com.sun.star.frame.Desktop', context)
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def properties(self, **kwargs) -> tuple:
+        values = []
+        for k, v in kwargs.items():
+            p = self._uno.createUnoStruct('com.sun.star.beans.PropertyValue')
+            p.Name = k
+            p.Value = v
+            values.append(p)
+        return tuple(values)
+
+    def store(self, doc: Any, path: str, filter_name: str, filter_data: Optional[dict] = None):
+        """
+        文書をfilter_nameの形式でpathに保存する
+        """
+        properties = self.properties(FilterName=filter_name, Overwrite=True)
+        if not filter_data:
+            doc.storeToURL(self.url(path), properties)
+            return
+        # FilterDataのような入れ子のプロパティはuno.Anyで型を指定し、uno.invokeで渡す必要がある
+        data = self.properties(FilterData=self._uno.Any(
+            '[]com.sun.star.beans.PropertyValue', self.properties(**filter_data)))
+        self._uno.invoke(doc, 'storeToURL', (self.url(path), properties + data))
+
+    def url(self, path: str) -> str:
+        return self._uno.systemPathToFileUrl(os.path.abspath(path))
+
+    @contextmanager
+    def load(self, path: str) -> Iterator[Any]:
+        doc = self.desktop.loadComponentFromURL(
+            self.url(path), '_blank', 0, self.properties(Hidden=True))
+        if doc is None:
+            raise RuntimeError(f'{path}をLibreOfficeで開くことができませんでした')
+        try:
+            yield doc
+        finally:
+            doc.close(True)
+
+    def terminate(self):
+        if self.alive:
+            try:
+                self.desktop.terminate()
+            except Exception:
+                pass
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        shutil.rmtree(self.profile, ignore_errors=True)
+
+
+class LibreOfficeConverter(Converter):
+    """
+    ヘッドレスで起動したLibreOfficeのプロセスをworkers個プールしておき、変換のたびに貸し出す。
+
+    プロセスは使い回し、変換中にプロセスが異常終了した場合は起動し直して
+    max_retries回までやり直す
+    """
+
+    def __init__(self, soffice: str = 'soffice', workers: int = 1,
+                 max_retries: int = 1, startup_timeout: float = 60):
+        if workers < 1:
+            raise RuntimeError('LibreOfficeのプロセス数には1以上を指定してください')
+        try:
+            import uno  # noqa: F401
+        except ImportError:
+            raise RuntimeError(
+                'LibreOfficeを使うにはUNO(python3-uno)が必要です。LibreOfficeに付属のPythonで実行してください')
+        self.soffice = soffice
+        self.max_retries = max_retries
+        self.startup_timeout = startup_timeout
+        self._idle: 'queue.Queue[Optional[_Office]]' = queue.Queue()
+        self._started: List[_Office] = []
+        self._lock = threading.Lock()
+        self._serial = 0
+        # プロセスは最初に必要になったときに起動する
+        for _ in range(workers):
+            self._idle.put(None)
+
+    def _start(self) -> _Office:
+        with self._lock:
+            self._serial += 1
+            name = f'ibnet_contract_{os.getpid()}_{self._serial}'
+        office = _Office(self.soffice, name, self.startup_timeout)
+        with self._lock:
+            self._started.append(office)
+        return office
+
+    def _discard(self, office: _Office):
+        office.terminate()
+        with self._lock:
+            if office in self._started:
+                self._started.remove(office)
+
+    def _run(self, f: Callable[[_Office], None]):
+        office = self._idle.get()
+        try:
+            retries = 0
+            while True:
+                if office is None or not office.alive:
+                    if office is not None:
+                        self._discard(office)
+                    office = self._start()
+                try:
+                    f(office)
+                    return
+                except Exception as e:
+                    # プロセスが生きていて接続も切れていなければ文書の問題なので、やり直さない
+                    if office.alive and not _is_disconnected(e):
+                        raise
+                    self._discard(office)
+                    office = None
+                    if retries >= self.max_retries:
+                        raise RuntimeError(f'LibreOfficeでの変換に失敗しました: {e}')
+                    retries += 1
+                    logger.warning(f'LibreOfficeを再起動します: {e}')
+        finally:
+            self._idle.put(office)
+
+    def word_to_pdf(self, input_file: str, output_file: str):
+        def convert(office: _Office):
+            with office.load(input_file) as doc:
+                filter_data = {}
+                if two_pages_per_sheet_marker in input_file:
+                    # LibreOfficeのPDF出力には1枚に複数ページを割り付ける設定がないので、
+                    # 印刷対象のページだけを出力する
+                    filter_data['PageRange'] = '1-2'
+                office.store(doc, output_file, 'writer_pdf_Export', filter_data)
+
+        self._run(convert)
+
+    def excel_to_pdf(self, input_file: str, output_file: str):
+        def convert(office: _Office):
+            with office.load(input_file) as doc:
+                # 非表示のシートはPDFに出力されないので、最初のシート以外を非表示にする
+                sheets = doc.getSheets()
+                for idx in range(1, sheets.getCount()):
+                    sheets.getByIndex(idx).IsVisible = False
+                office.store(doc, output_file, 'calc_pdf_Export')
+
+        self._run(convert)
+
+    def recalculate(self, path: str):
+        def calculate(office: _Office):
+            with office.load(path) as doc:
+                doc.calculateAll()
+                office.store(doc, path, 'Calc MS Excel 2007 XML')
+
+        self._run(calculate)
+
+    def close(self):
+        with self._lock:
+            started = list(self._started)
+            self._started.clear()
+        for office in started:
+            office.terminate()
+
+
+def _is_disconnected(e: Exception) -> bool:
+    # プロセスが落ちるとUNOのブリッジはDisposedExceptionなどを送出する
+    return type(e).__name__ in {'DisposedException', 'RuntimeException',
+                                'NoConnectException', 'BrokenPipeError'}
+
+
+backends = {
+    'com': lambda: ComConverter(),
+    'libreoffice': lambda: LibreOfficeConverter(
+        os.environ.get('SOFFICE_PATH', 'soffice'),
+        int(os.environ.get('CONVERTER_WORKERS', '1'))),
+}
+
+_converter: Optional[Converter] = None
+_converter_lock = threading.Lock()
+
+
+def default_backend() -> str:
+    return 'com' if platform.system() == 'Windows' else 'libreoffice'
+
+
+def get() -> Converter:
+    """
+    CONVERTER_BACKENDで指定したバックエンドを返す。最初の呼び出しで作成し、以降は使い回す
+    """
+    global _converter
+    with _converter_lock:
+        if _converter is None:
+            name = os.environ.get('CONVERTER_BACKEND', default_backend()).lower()
+            if name not in backends:
+                raise RuntimeError(
+                    f'CONVERTER_BACKENDには {", ".join(backends)} のいずれかを指定してください。({name!r})')
+            _converter = backends[name]()
+        return _converter
+
+
+@atexit.register
+def close():
+    """
+    `get`で作成したバックエンドを閉じる。次に`get`を呼び出したときは作成し直す
+    """
+    global _converter
+    with _converter_lock:
+        if _converter is not None:
+            _converter.close()
+            _converter = None
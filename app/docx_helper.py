@@ -1,10 +1,15 @@
 from docx.document import Document
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.oxml import OxmlElement
+from docx.oxml.ns import nsmap, qn
 from docx.section import Sections
 from docx.table import Table
 from docx.text.paragraph import Paragraph
 from docx.text.run import Run
 from itertools import chain
-from typing import Iterable, List
+from lxml import etree
+from typing import Iterable, Iterator, List, Optional
+import re
 
 
 def run_in_paragraphs(paragraphs: List[Paragraph]) -> Iterable[Run]:
@@ -37,3 +42,114 @@ def run_in_sections(sections: Sections):
 def all_runs(doc: Document):
     return chain(run_in_paragraphs_and_tables(doc),
                  run_in_sections(doc.sections))
+
+
+def paragraph_in_table(table: Table) -> Iterable[Paragraph]:
+    return (p
+            for row in table.rows
+            for cell in row.cells
+            for p in chain(cell.paragraphs, paragraph_in_tables(cell.tables)))
+
+
+def paragraph_in_tables(tables: List[Table]) -> Iterable[Paragraph]:
+    return (p
+            for table in tables
+            for p in paragraph_in_table(table))
+
+
+def paragraph_in_paragraphs_and_tables(obj) -> Iterable[Paragraph]:
+    return chain(obj.paragraphs, paragraph_in_tables(obj.tables))
+
+
+def paragraph_in_sections(sections: Sections) -> Iterable[Paragraph]:
+    return chain(*(chain(paragraph_in_paragraphs_and_tables(section.header),
+                         paragraph_in_paragraphs_and_tables(section.footer))
+                   for section in sections))
+
+
+def all_paragraphs(doc: Document) -> Iterable[Paragraph]:
+    """
+    本文、表のセル(入れ子の表を含む)、各セクションのヘッダーとフッターの段落をすべて返す
+    """
+    return chain(paragraph_in_paragraphs_and_tables(doc),
+                 paragraph_in_sections(doc.sections))
+
+
+# python-docxのプロキシオブジェクトを作らずに、XMLから直接テキストノードを取得するためのXPath
+_w = {'w': nsmap['w']}
+_xpath_text_nodes = etree.XPath('.//w:t', namespaces=_w)
+_xpath_text_nodes_containing = etree.XPath(
+    './/w:t[contains(., $needle)]', namespaces=_w)
+_xpath_tables_containing = etree.XPath(
+    './w:tbl[.//w:t[contains(., $needle)]]', namespaces=_w)
+
+_special_chars = re.compile(r'(\t|\r\n|\n|\r)')
+
+
+class TextNode:
+    """
+    w:t要素の軽量なハンドル。Runなどのプロキシオブジェクトを作らずにテキストを読み書きする
+    """
+    __slots__ = ('element',)
+
+    def __init__(self, element):
+        self.element = element
+
+    @property
+    def text(self) -> str:
+        return self.element.text or ''
+
+    @text.setter
+    def text(self, value: str):
+        # Run.textと同じく、タブと改行はw:tab, w:brとしてw:tの後ろに追加する
+        pieces = _special_chars.split(value)
+        _set_t_text(self.element, pieces[0])
+        anchor = self.element
+        for separator, piece in zip(pieces[1::2], pieces[2::2]):
+            anchor.addnext(OxmlElement('w:tab' if separator == '\t' else 'w:br'))
+            anchor = anchor.getnext()
+            if piece:
+                t = OxmlElement('w:t')
+                _set_t_text(t, piece)
+                anchor.addnext(t)
+                anchor = t
+
+
+def _set_t_text(t, text: str):
+    t.text = text
+    if text != text.strip():
+        t.set(qn('xml:space'), 'preserve')
+
+
+def text_nodes(element, contains: Optional[str] = None) -> Iterator[TextNode]:
+    """
+    element以下のw:tを文書順に返す。containsを指定した場合はその文字列を含むものだけを返す
+    """
+    nodes = _xpath_text_nodes(element) if contains is None \
+        else _xpath_text_nodes_containing(element, needle=contains)
+    return (TextNode(node) for node in nodes)
+
+
+def header_footer_elements(doc: Document) -> List:
+    """
+    文書から参照されているヘッダーとフッターのXML要素を返す
+    """
+    return [rel.target_part.element
+            for rel in doc.part.rels.values()
+            if not rel.is_external and rel.reltype in {RT.HEADER, RT.FOOTER}]
+
+
+def all_text_nodes(doc: Document, contains: Optional[str] = None) -> Iterator[TextNode]:
+    """
+    本文、ヘッダー、フッターに含まれるw:tを返す。`all_runs`のXPath版
+    """
+    return chain(*(text_nodes(element, contains)
+                   for element in [doc.element.body, *header_footer_elements(doc)]))
+
+
+def first_table_containing(doc: Document, text: str) -> Optional[Table]:
+    """
+    本文直下の表のうち、textを含む最初の表を返す
+    """
+    tables = _xpath_tables_containing(doc.element.body, needle=text)
+    return Table(tables[0], doc._body) if tables else None
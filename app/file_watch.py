@@ -0,0 +1,243 @@
+"""
+ファイルの保存を、ファイルシステムの変更通知を待って検知するモジュール。
+
+Linuxではinotify、WindowsではFindFirstChangeNotificationをctypesで使い、
+どちらも使えない場合は一定の間隔でファイルの状態を確認する
+"""
+
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import ctypes
+import ctypes.util
+import os
+import platform
+import select
+import time
+
+logger = getLogger(__name__)
+
+# 変更通知が使えない場合に、ファイルの状態を確認する間隔(秒)
+poll_interval = 1.0
+
+# 変更通知を取りこぼした場合(ネットワークドライブなど)に備えて、通知がなくても状態を確認する間隔(秒)
+rescan_interval = 30.0
+
+saved = '保存済'
+editing = '編集中'
+unsaved = '未確認'
+
+
+def signature(path: str) -> Optional[Tuple[int, int]]:
+    """
+    ファイルの(更新日時, サイズ)。ファイルがない場合はNone
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def lock_files(path: str) -> List[str]:
+    """
+    ファイルを開いている間にExcel、LibreOfficeが作るロックファイルのパス
+    """
+    directory, name = os.path.split(path)
+    return [
+        os.path.join(directory, '~$' + name),
+        os.path.join(directory, f'.~lock.{name}#'),
+    ]
+
+
+def is_open(path: str) -> bool:
+    return any(os.path.exists(lock) for lock in lock_files(path))
+
+
+class _Waiter:
+    """
+    監視しているフォルダのどれかが変更されるか、timeout秒が経つまで待つ
+    """
+
+    def wait(self, timeout: float):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class _PollingWaiter(_Waiter):
+
+    def wait(self, timeout: float):
+        time.sleep(min(timeout, poll_interval))
+
+
+class _InotifyWaiter(_Waiter):
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, directories: Iterable[str]):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+        try:
+            for directory in directories:
+                if libc.inotify_add_watch(self.fd, os.fsencode(directory), self.mask) < 0:
+                    raise OSError(ctypes.get_errno(), 'inotify_add_watch', directory)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def wait(self, timeout: float):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+        # どのファイルが変わったかは呼び出し側で確認し直すので、イベントは読み捨てる
+        try:
+            while os.read(self.fd, 64 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _WindowsWaiter(_Waiter):
+
+    FILE_NOTIFY_CHANGE_FILE_NAME = 0x00000001
+    FILE_NOTIFY_CHANGE_SIZE = 0x00000008
+    FILE_NOTIFY_CHANGE_LAST_WRITE = 0x00000010
+    INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
+    WAIT_TIMEOUT = 0x00000102
+    MAXIMUM_WAIT_OBJECTS = 64
+
+    filter = FILE_NOTIFY_CHANGE_FILE_NAME | FILE_NOTIFY_CHANGE_SIZE | FILE_NOTIFY_CHANGE_LAST_WRITE
+
+    def __init__(self, directories: Iterable[str]):
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)  # type: ignore[attr-defined]
+        kernel32.FindFirstChangeNotificationW.restype = ctypes.c_void_p
+        kernel32.FindFirstChangeNotificationW.argtypes = [ctypes.c_wchar_p, ctypes.c_int, ctypes.c_uint32]
+        kernel32.FindNextChangeNotification.argtypes = [ctypes.c_void_p]
+        kernel32.FindCloseChangeNotification.argtypes = [ctypes.c_void_p]
+        kernel32.WaitForMultipleObjects.restype = ctypes.c_uint32
+        kernel32.WaitForMultipleObjects.argtypes = [
+            ctypes.c_uint32, ctypes.POINTER(ctypes.c_void_p), ctypes.c_int, ctypes.c_uint32]
+        self.kernel32 = kernel32
+
+        directories = list(directories)
+        if len(directories) > self.MAXIMUM_WAIT_OBJECTS:
+            raise OSError(f'監視できるフォルダは{self.MAXIMUM_WAIT_OBJECTS}個までです')
+
+        self.handles: List[int] = []
+        for directory in directories:
+            handle = kernel32.FindFirstChangeNotificationW(directory, False, self.filter)
+            if handle is None or handle == self.INVALID_HANDLE_VALUE:
+                self.close()
+                raise ctypes.WinError(ctypes.get_last_error())  # type: ignore[attr-defined]
+            self.handles.append(handle)
+
+    def wait(self, timeout: float):
+        handles = (ctypes.c_void_p * len(self.handles))(*self.handles)
+        index = self.kernel32.WaitForMultipleObjects(
+            len(self.handles), handles, False, int(timeout * 1000))
+        if index < len(self.handles):
+            self.kernel32.FindNextChangeNotification(self.handles[index])
+        elif index != self.WAIT_TIMEOUT:
+            # 待てない場合は、状態の確認を繰り返さないように一定時間待つ
+            time.sleep(min(timeout, poll_interval))
+
+    def close(self):
+        for handle in self.handles:
+            self.kernel32.FindCloseChangeNotification(handle)
+        self.handles = []
+
+
+def _open_waiter(directories: Iterable[str]) -> _Waiter:
+    directories = sorted({os.path.abspath(d) for d in directories})
+    try:
+        if platform.system() == 'Linux':
+            return _InotifyWaiter(directories)
+        elif platform.system() == 'Windows':
+            return _WindowsWaiter(directories)
+    except (OSError, AttributeError) as e:
+        logger.debug(f'ファイルの変更通知を使えないため、{poll_interval}秒ごとに確認します: {e}')
+    return _PollingWaiter()
+
+
+@dataclass(frozen=True)
+class SaveWatch:
+    """
+    作成した時点からファイルが上書き保存されたかどうかを監視する。
+
+    ファイルの更新日時とサイズが作成した時点から変わり、ロックファイルがない(閉じられている)
+    ファイルを保存済とする。Excelで開く前に作成すること
+    """
+    baseline: Dict[str, Optional[Tuple[int, int]]]
+
+    @classmethod
+    def of(cls, paths: Iterable[str]) -> 'SaveWatch':
+        return cls({path: signature(path) for path in paths})
+
+    def status(self) -> Dict[str, str]:
+        """
+        ファイルのパスごとの状態(保存済、編集中、未確認)
+        """
+        def status_of(path: str) -> str:
+            if is_open(path):
+                return editing
+            elif signature(path) != self.baseline[path]:
+                return saved
+            return unsaved
+
+        return {path: status_of(path) for path in self.baseline}
+
+    def wait(self, on_change: Optional[Callable[[Dict[str, str]], None]] = None) -> Dict[str, str]:
+        """
+        すべてのファイルが保存済になるまで待つ。on_changeには、最初と状態が変わるたびに状態が渡される
+        """
+        directories = {os.path.dirname(os.path.abspath(path)) for path in self.baseline}
+        waiter = _open_waiter(directories)
+        try:
+            state = self.status()
+            if on_change is not None:
+                on_change(state)
+
+            while any(s != saved for s in state.values()):
+                waiter.wait(rescan_interval)
+                new_state = self.status()
+                if new_state != state:
+                    state = new_state
+                    if on_change is not None:
+                        on_change(state)
+            return state
+        finally:
+            waiter.close()
+
+
+def wait_opened_and_closed(path: str):
+    """
+    ファイルがExcelなどで開かれ、閉じられるまで待つ
+    """
+    waiter = _open_waiter([os.path.dirname(os.path.abspath(path))])
+    try:
+        opened = False
+        while True:
+            isopen = is_open(path)
+            if opened and not isopen:
+                return
+            opened = opened or isopen
+            waiter.wait(rescan_interval)
+    finally:
+        waiter.close()
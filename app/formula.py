@@ -0,0 +1,989 @@
+"""
+Excelの数式をPythonで計算するモジュール
+
+openpyxlで読み込んだWorkbookの数式を解析してセルの依存関係のグラフを作り、トポロジカル順に
+計算する。`jikkin_sheet.process_*`が出力する数式と、テンプレートで使われている関数に対応している。
+
+日付はExcelと同じくシリアル値で計算し、表示形式が日付のセルだけ最後にdatetimeに戻す。
+計算結果はExcelで保存したファイルを`data_only=True`で読み込んだときと同じ型にそろえる
+"""
+
+from app import schedule
+from dataclasses import dataclass
+from datetime import date, datetime, time
+from graphlib import CycleError, TopologicalSorter
+from logging import getLogger
+from openpyxl.styles.numbers import is_date_format
+from openpyxl.utils.cell import column_index_from_string
+from openpyxl.utils.datetime import from_excel, to_excel
+from openpyxl.workbook.workbook import Workbook
+from openpyxl.worksheet.worksheet import Worksheet
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Mapping, NamedTuple, Optional, Set, Tuple, cast
+import bisect
+import functools
+import math
+import re
+
+logger = getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ExcelError:
+    """
+    #DIV/0!などのエラー値
+    """
+    code: str
+
+    def __str__(self) -> str:
+        return self.code
+
+
+null_error = ExcelError('#NULL!')
+div0_error = ExcelError('#DIV/0!')
+value_error = ExcelError('#VALUE!')
+ref_error = ExcelError('#REF!')
+name_error = ExcelError('#NAME?')
+num_error = ExcelError('#NUM!')
+na_error = ExcelError('#N/A')
+
+errors = {e.code: e for e in [null_error, div0_error, value_error,
+                              ref_error, name_error, num_error, na_error]}
+
+
+class _Failed(Exception):
+    """
+    計算中にエラー値になったことを呼び出し元のセルまで伝える
+    """
+
+    def __init__(self, error: ExcelError):
+        super().__init__(error.code)
+        self.error = error
+
+
+class Range(NamedTuple):
+    """
+    範囲参照の値。行ごとのセルの値のリスト
+    """
+    rows: List[List[Any]]
+
+    def values(self) -> Iterator[Any]:
+        for row in self.rows:
+            yield from row
+
+
+# ---- 字句解析 ---------------------------------------------------------------
+
+token_pattern = re.compile(r'''
+    \s*(?:
+      (?P<string>"(?:[^"]|"")*")
+    | (?P<error>\#(?:NULL!|DIV/0!|VALUE!|REF!|NAME\?|NUM!|N/A))
+    | (?P<function>(?:_xlfn\.)?[A-Za-z][A-Za-z0-9._]*)\(
+    | (?P<reference>
+        (?:(?:'(?P<quoted_sheet>(?:[^']|'')+)'|(?P<sheet>[^\s'!:,()&=<>+\-*/^"%{}\#$]+))!)?
+        (?P<cell1>\$?[A-Za-z]{1,3}\$?\d+)(?::(?P<cell2>\$?[A-Za-z]{1,3}\$?\d+))?
+        (?![A-Za-z0-9_(.!])
+      )
+    | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    | (?P<boolean>TRUE|FALSE)(?![A-Za-z0-9_.(])
+    | (?P<operator><>|<=|>=|[-+*/^&=<>%])
+    | (?P<punct>[(),])
+    )''', re.VERBOSE)
+
+cell_pattern = re.compile(r'(\$?)([A-Za-z]{1,3})(\$?)(\d+)')
+
+
+class Ref(NamedTuple):
+    """
+    数式中のセル参照。絶対参照でない行・列は数式のあるセルからの相対位置で持つ
+    """
+    sheet: Optional[str]  # 別シートの参照でなければNone
+    row: int
+    col: int
+    row_abs: bool
+    col_abs: bool
+
+    def resolve(self, row: int, col: int) -> Tuple[int, int]:
+        return (self.row if self.row_abs else row + self.row,
+                self.col if self.col_abs else col + self.col)
+
+
+def _cell_ref(sheet: Optional[str], coordinate: str, row: int, col: int) -> Ref:
+    col_abs, col_letter, row_abs, row_number = cast(
+        re.Match, cell_pattern.fullmatch(coordinate)).groups()
+    r = int(row_number)
+    c = column_index_from_string(col_letter.upper())
+    return Ref(sheet,
+               r if row_abs else r - row,
+               c if col_abs else c - col,
+               bool(row_abs), bool(col_abs))
+
+
+# 文字列リテラルを飛ばしてセル番地だけを探す。`relative_key`で使う
+key_pattern = re.compile(
+    r'"(?:[^"]|"")*"|(?<![A-Za-z0-9_.])(\$?)([A-Za-z]{1,3})(\$?)(\d+)(?![A-Za-z0-9_(.!])')
+
+
+def relative_key(formula: str, row: int, col: int) -> str:
+    """
+    相対参照を(row, col)からの位置に書き換えた数式。行ごとにコピーされた数式は同じ文字列になるので、
+    `tokenize`の結果を使い回すためのキーにする
+    """
+    def relative(matched: re.Match) -> str:
+        col_abs, col_letter, row_abs, row_number = matched.groups()
+        if col_letter is None:
+            return matched.group(0)
+        c = col_letter if col_abs else \
+            f'C[{column_index_from_string(col_letter.upper()) - col}]'
+        r = row_number if row_abs else f'R[{int(row_number) - row}]'
+        return f'{col_abs}{c}{row_abs}{r}'
+
+    return key_pattern.sub(relative, formula)
+
+
+def tokenize(formula: str, row: int, col: int) -> Tuple[Tuple[str, Any], ...]:
+    """
+    "="から始まる数式を字句に分ける。セル参照は(row, col)からの相対位置にするので、
+    行ごとにコピーされた数式は同じ字句の列になる
+    """
+    tokens: List[Tuple[str, Any]] = []
+    pos = 1 if formula.startswith('=') else 0
+    while pos < len(formula):
+        matched = token_pattern.match(formula, pos)
+        if matched is None or matched.end() == pos:
+            if formula[pos:].strip() == '':
+                break
+            raise RuntimeError(f'数式を解析できません: {formula}')
+        pos = matched.end()
+        kind = cast(str, matched.lastgroup)
+        text = matched.group(kind)
+
+        if kind == 'string':
+            tokens.append((kind, text[1:-1].replace('""', '"')))
+        elif kind == 'error':
+            tokens.append((kind, errors[text]))
+        elif kind == 'function':
+            tokens.append((kind, text.upper().replace('_XLFN.', '')))
+        elif kind == 'reference':
+            quoted = matched.group('quoted_sheet')
+            sheet = quoted.replace("''", "'") if quoted is not None \
+                else matched.group('sheet')
+            first = _cell_ref(sheet, matched.group('cell1'), row, col)
+            if matched.group('cell2') is None:
+                tokens.append(('ref', first))
+            else:
+                tokens.append(('range', (first, _cell_ref(
+                    sheet, matched.group('cell2'), row, col))))
+        elif kind == 'number':
+            number = float(text)
+            tokens.append((kind, int(number) if number.is_integer() else number))
+        elif kind == 'boolean':
+            tokens.append((kind, text == 'TRUE'))
+        else:
+            tokens.append((kind, text))
+    return tuple(tokens)
+
+
+# ---- 構文解析 ---------------------------------------------------------------
+
+# 二項演算子の優先順位。Excelでは単項マイナスが^より優先される
+binary_precedence = {
+    '=': 1, '<>': 1, '<': 1, '>': 1, '<=': 1, '>=': 1,
+    '&': 2,
+    '+': 3, '-': 3,
+    '*': 4, '/': 4,
+    '^': 5,
+}
+prefix_precedence = 6
+
+
+class _Parser:
+    """
+    字句の列を(種類, ...)のタプルの構文木にする
+    """
+
+    def __init__(self, tokens: Tuple[Tuple[str, Any], ...]):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self) -> Tuple[str, Any]:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else ('end', None)
+
+    def take(self) -> Tuple[str, Any]:
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def expect(self, value: str):
+        kind, text = self.take()
+        if kind != 'punct' or text != value:
+            raise RuntimeError(f'数式の{value!r}がありません')
+
+    def parse(self) -> tuple:
+        node = self.expression(0)
+        if self.peek()[0] != 'end':
+            raise RuntimeError(f'数式の解析できない字句があります: {self.peek()[1]!r}')
+        return node
+
+    def expression(self, min_precedence: int) -> tuple:
+        node = self.prefix()
+        while True:
+            kind, op = self.peek()
+            if kind != 'operator':
+                return node
+            if op == '%':
+                self.take()
+                node = ('percent', node)
+                continue
+            precedence = binary_precedence[op]
+            if precedence < min_precedence:
+                return node
+            self.take()
+            node = ('binary', op, node, self.expression(precedence + 1))
+
+    def prefix(self) -> tuple:
+        kind, value = self.take()
+        if kind == 'operator' and value in {'-', '+'}:
+            operand = self.expression(prefix_precedence)
+            return ('negate', operand) if value == '-' else operand
+        if kind == 'punct' and value == '(':
+            node = self.expression(0)
+            self.expect(')')
+            return node
+        if kind in {'string', 'number', 'boolean', 'error'}:
+            return ('constant', value)
+        if kind in {'ref', 'range'}:
+            return (kind, value)
+        if kind == 'function':
+            return ('function', value, self.arguments())
+        raise RuntimeError(f'数式の解析できない字句があります: {value!r}')
+
+    def arguments(self) -> List[tuple]:
+        args: List[tuple] = []
+        if self.peek() == ('punct', ')'):
+            self.take()
+            return args
+        while True:
+            if self.peek() in {('punct', ','), ('punct', ')')}:
+                # IF(A1,,) のように省略された引数
+                args.append(('constant', None))
+            else:
+                args.append(self.expression(0))
+            kind, value = self.take()
+            if (kind, value) == ('punct', ')'):
+                return args
+            if (kind, value) != ('punct', ','):
+                raise RuntimeError(f'関数の引数を解析できません: {value!r}')
+
+
+# ---- 値の変換 ---------------------------------------------------------------
+
+
+def number(v: Any) -> Any:
+    """
+    数値として使う。空のセルは0、TRUE/FALSEは1/0、数値の文字列は数値にする
+    """
+    if v is None:
+        return 0
+    if isinstance(v, bool):
+        return int(v)
+    if isinstance(v, (int, float)):
+        return v
+    if isinstance(v, ExcelError):
+        raise _Failed(v)
+    if isinstance(v, str):
+        try:
+            return float(v)
+        except ValueError:
+            pass
+    raise _Failed(value_error)
+
+
+def text(v: Any) -> str:
+    """
+    文字列として使う。数値は表示形式によらず標準の表記にする
+    """
+    if v is None:
+        return ''
+    if isinstance(v, bool):
+        return 'TRUE' if v else 'FALSE'
+    if isinstance(v, (int, float)):
+        v = schedule.normalize_number(v)
+        return str(v) if isinstance(v, int) else f'{v:.15g}'
+    if isinstance(v, str):
+        return v
+    if isinstance(v, ExcelError):
+        raise _Failed(v)
+    raise _Failed(value_error)
+
+
+def boolean(v: Any) -> bool:
+    """
+    論理値として使う。数値は0以外がTRUE
+    """
+    if v is None:
+        return False
+    if isinstance(v, bool):
+        return v
+    if isinstance(v, (int, float)):
+        return v != 0
+    if isinstance(v, ExcelError):
+        raise _Failed(v)
+    if isinstance(v, str) and v.upper() in {'TRUE', 'FALSE'}:
+        return v.upper() == 'TRUE'
+    raise _Failed(value_error)
+
+
+def scalar(v: Any) -> Any:
+    # 範囲をセルひとつの値として使うことには対応していない
+    if isinstance(v, Range):
+        raise _Failed(value_error)
+    return v
+
+
+def to_date(v: Any) -> datetime:
+    serial = number(v)
+    if serial < 0:
+        raise _Failed(num_error)
+    return from_excel(math.floor(serial))
+
+
+def to_serial(d: datetime) -> Any:
+    return schedule.normalize_number(to_excel(d))
+
+
+def _type_rank(v: Any) -> int:
+    # Excelの比較では 数値 < 文字列 < 論理値 の順になる
+    if isinstance(v, bool):
+        return 2
+    if isinstance(v, str):
+        return 1
+    return 0
+
+
+def compare(a: Any, b: Any) -> int:
+    """
+    Excelの比較演算子と同じ規則で比較し、-1, 0, 1を返す
+    """
+    for v in (a, b):
+        if isinstance(v, ExcelError):
+            raise _Failed(v)
+    # 空のセルは比較相手の型の空の値として扱う
+    if a is None:
+        a = '' if isinstance(b, str) else False if isinstance(b, bool) else 0
+    if b is None:
+        b = '' if isinstance(a, str) else False if isinstance(a, bool) else 0
+
+    rank_a, rank_b = _type_rank(a), _type_rank(b)
+    if rank_a != rank_b:
+        return -1 if rank_a < rank_b else 1
+    if rank_a == 1:
+        a, b = a.lower(), b.lower()
+    elif rank_a == 0:
+        # 有効桁数15桁で比較するので、0.1+0.2=0.3 はTRUEになる
+        a, b = schedule._significant(a), schedule._significant(b)
+    return (a > b) - (a < b)
+
+
+def _divide(a: Any, b: Any) -> Any:
+    if b == 0:
+        raise _Failed(div0_error)
+    return a / b
+
+
+def _power(a: Any, b: Any) -> Any:
+    try:
+        result = a ** b
+    except (OverflowError, ZeroDivisionError):
+        raise _Failed(num_error)
+    if isinstance(result, complex):
+        raise _Failed(num_error)
+    return result
+
+
+arithmetic_operators: Dict[str, Callable[[Any, Any], Any]] = {
+    '+': lambda a, b: a + b,
+    '-': lambda a, b: a - b,
+    '*': lambda a, b: a * b,
+    '/': _divide,
+    '^': _power,
+}
+
+comparison_operators: Dict[str, Callable[[int], bool]] = {
+    '=': lambda c: c == 0,
+    '<>': lambda c: c != 0,
+    '<': lambda c: c < 0,
+    '>': lambda c: c > 0,
+    '<=': lambda c: c <= 0,
+    '>=': lambda c: c >= 0,
+}
+
+
+# ---- 関数 -------------------------------------------------------------------
+
+# 関数名 -> 引数を計算済みの値で受け取る関数
+functions: Dict[str, Callable[..., Any]] = {}
+
+
+def _function(name: str):
+    def register(f: Callable[..., Any]) -> Callable[..., Any]:
+        functions[name] = f
+        return f
+    return register
+
+
+def _numbers_in(args: Tuple[Any, ...]) -> Iterator[Any]:
+    # 範囲の中の文字列・論理値・空のセルは無視し、直接渡された値は数値に変換する
+    for arg in args:
+        if isinstance(arg, Range):
+            for v in arg.values():
+                if isinstance(v, ExcelError):
+                    raise _Failed(v)
+                if isinstance(v, (int, float)) and not isinstance(v, bool):
+                    yield v
+        else:
+            yield number(arg)
+
+
+@_function('SUM')
+def _sum(*args):
+    return sum(_numbers_in(args))
+
+
+@_function('AND')
+def _and(*args):
+    found = False
+    result = True
+    for arg in args:
+        if isinstance(arg, Range):
+            # 範囲の中の文字列と空のセルは無視する
+            values = [v for v in arg.values()
+                      if v is not None and not isinstance(v, str)]
+        else:
+            values = [arg]
+        for v in values:
+            result = boolean(v) and result
+            found = True
+    if not found:
+        raise _Failed(value_error)
+    return result
+
+
+@_function('ABS')
+def _abs(x):
+    return abs(number(scalar(x)))
+
+
+@_function('INT')
+def _int(x):
+    return schedule.excel_int(number(scalar(x)))
+
+
+@_function('ROUND')
+def _round(x, digits=0):
+    return schedule.excel_round(number(scalar(x)), int(number(scalar(digits))))
+
+
+@_function('ROUNDDOWN')
+def _rounddown(x, digits=0):
+    return schedule.excel_rounddown(number(scalar(x)), int(number(scalar(digits))))
+
+
+@_function('MOD')
+def _mod(n, d):
+    n, d = number(scalar(n)), number(scalar(d))
+    if d == 0:
+        raise _Failed(div0_error)
+    return n - d * math.floor(n / d)
+
+
+@_function('DATE')
+def _date(year, month, day):
+    year = int(number(scalar(year)))
+    if 0 <= year < 1900:
+        year += 1900
+    try:
+        return to_serial(schedule.excel_date(
+            year, int(number(scalar(month))), int(number(scalar(day)))))
+    except (ValueError, OverflowError):
+        raise _Failed(num_error)
+
+
+@_function('YEAR')
+def _year(serial):
+    # シリアル値0は1900年1月0日として扱われる
+    return 1900 if number(scalar(serial)) < 1 else to_date(scalar(serial)).year
+
+
+@_function('MONTH')
+def _month(serial):
+    return 1 if number(scalar(serial)) < 1 else to_date(scalar(serial)).month
+
+
+@_function('TODAY')
+def _today():
+    return to_serial(datetime.combine(date.today(), time()))
+
+
+@_function('EDATE')
+def _edate(start, months):
+    try:
+        return to_serial(schedule.edate(
+            to_date(scalar(start)), int(number(scalar(months)))))
+    except (ValueError, OverflowError):
+        raise _Failed(num_error)
+
+
+@_function('DATEDIF')
+def _datedif(start, end, unit):
+    start, end = to_date(scalar(start)), to_date(scalar(end))
+    unit = text(scalar(unit)).upper()
+    if start > end:
+        raise _Failed(num_error)
+
+    months = (end.year - start.year) * 12 + end.month - start.month \
+        - (1 if end.day < start.day else 0)
+    if unit == 'D':
+        return schedule.datedif_days(start, end)
+    if unit == 'M':
+        return months
+    if unit == 'Y':
+        return months // 12
+    if unit == 'YM':
+        return months % 12
+    if unit == 'MD':
+        return schedule.datedif_days(schedule.edate(start, months), end)
+    if unit == 'YD':
+        return schedule.datedif_days(schedule.edate(start, months // 12 * 12), end)
+    raise _Failed(num_error)
+
+
+@_function('WORKDAY')
+def _workday(start, days, holidays=None):
+    holiday_values = holidays.values() if isinstance(holidays, Range) else [holidays]
+    return to_serial(schedule.workday(
+        to_date(scalar(start)),
+        int(number(scalar(days))),
+        [to_date(v) for v in holiday_values if v is not None]))
+
+
+def _lookup_matches(key: Any, v: Any) -> int:
+    # 型が違う値は比較しない
+    if v is None or _type_rank(v) != _type_rank(key):
+        return -2
+    return compare(v, key)
+
+
+def _approximate_position(key: Any, values: List[Any], descending: bool = False) -> Optional[int]:
+    """
+    昇順(descendingなら降順)に並んでいる値からkey以下(以上)の最後の位置を探す
+    """
+    found = None
+    for idx, v in enumerate(values):
+        c = _lookup_matches(key, v)
+        if c == -2:
+            continue
+        if (c > 0) if not descending else (c < 0):
+            break
+        found = idx
+    return found
+
+
+def _exact_position(key: Any, values: List[Any]) -> Optional[int]:
+    for idx, v in enumerate(values):
+        if _lookup_matches(key, v) == 0:
+            return idx
+    return None
+
+
+@_function('VLOOKUP')
+def _vlookup(key, table, col_index, approximate=True):
+    key = scalar(key)
+    if isinstance(key, ExcelError):
+        raise _Failed(key)
+    if not isinstance(table, Range):
+        raise _Failed(value_error)
+    col = int(number(scalar(col_index)))
+    if col < 1:
+        raise _Failed(value_error)
+    if col > len(table.rows[0]):
+        raise _Failed(ref_error)
+
+    keys = [row[0] for row in table.rows]
+    idx = _approximate_position(key, keys) if boolean(scalar(approximate)) \
+        else _exact_position(key, keys)
+    if idx is None:
+        raise _Failed(na_error)
+    return table.rows[idx][col - 1]
+
+
+@_function('MATCH')
+def _match(key, lookup, match_type=1):
+    key = scalar(key)
+    if isinstance(key, ExcelError):
+        raise _Failed(key)
+    if not isinstance(lookup, Range):
+        raise _Failed(na_error)
+    values = list(lookup.values())
+    match_type = number(scalar(match_type))
+    if match_type == 0:
+        idx = _exact_position(key, values)
+    else:
+        idx = _approximate_position(key, values, descending=match_type < 0)
+    if idx is None:
+        raise _Failed(na_error)
+    return idx + 1
+
+
+@_function('INDEX')
+def _index(table, row_num, col_num=None):
+    if not isinstance(table, Range):
+        raise _Failed(value_error)
+    row_num = int(number(scalar(row_num)))
+    if col_num is None:
+        if len(table.rows) == 1:
+            # 1行の範囲は列番号として扱う
+            row_num, col_num = 1, row_num
+        else:
+            col_num = 1
+    col_num = int(number(scalar(col_num)))
+    if not (1 <= row_num <= len(table.rows) and 1 <= col_num <= len(table.rows[0])):
+        raise _Failed(ref_error)
+    return table.rows[row_num - 1][col_num - 1]
+
+
+@_function('LEFT')
+def _left(s, count=1):
+    count = int(number(scalar(count)))
+    if count < 0:
+        raise _Failed(value_error)
+    return text(scalar(s))[:count]
+
+
+@_function('LENB')
+def _lenb(s):
+    # 日本語版のExcelでは全角文字を2バイトとして数える
+    return len(text(scalar(s)).encode('cp932', errors='replace'))
+
+
+@_function('CHAR')
+def _char(code):
+    code = int(number(scalar(code)))
+    if not 1 <= code <= 255:
+        raise _Failed(value_error)
+    try:
+        return bytes([code]).decode('cp932')
+    except UnicodeDecodeError:
+        raise _Failed(value_error)
+
+
+# ---- 数式のコンパイル ---------------------------------------------------------
+
+# 計算中の値。シート名 -> (行, 列) -> 値
+Values = Dict[str, Dict[Tuple[int, int], Any]]
+
+
+class _Values(dict):
+    """
+    `evaluate`で計算中の値。行ごとに範囲が広がるSUMの途中までの合計も持つ
+    """
+
+    def __init__(self):
+        super().__init__()
+        # (シート名, 列, 開始行) -> (合計した最後の行, 合計)
+        self.running_sums: Dict[Tuple[str, int, int], Tuple[int, Any]] = {}
+
+# コンパイルした数式。(計算中の値, シート名, 行, 列) -> 値
+Compiled = Callable[[Values, str, int, int], Any]
+
+
+def _compile(node: tuple) -> Compiled:
+    kind = node[0]
+
+    if kind == 'constant':
+        value = node[1]
+        return lambda values, sheet, row, col: value
+
+    if kind == 'ref':
+        ref: Ref = node[1]
+
+        def cell(values: Values, sheet: str, row: int, col: int) -> Any:
+            cells = values.get(ref.sheet or sheet)
+            r, c = ref.resolve(row, col)
+            if cells is None or r < 1 or c < 1:
+                return ref_error
+            return cells.get((r, c))
+        return cell
+
+    if kind == 'range':
+        first, last = cast(Tuple[Ref, Ref], node[1])
+
+        def cell_range(values: Values, sheet: str, row: int, col: int) -> Any:
+            cells = values.get(first.sheet or sheet)
+            r1, c1 = first.resolve(row, col)
+            r2, c2 = last.resolve(row, col)
+            if cells is None or min(r1, r2, c1, c2) < 1:
+                return ref_error
+            return Range([[cells.get((r, c)) for c in range(min(c1, c2), max(c1, c2) + 1)]
+                          for r in range(min(r1, r2), max(r1, r2) + 1)])
+        return cell_range
+
+    if kind == 'negate':
+        operand = _compile(node[1])
+        return lambda values, sheet, row, col: -number(scalar(operand(values, sheet, row, col)))
+
+    if kind == 'percent':
+        operand = _compile(node[1])
+        return lambda values, sheet, row, col: number(scalar(operand(values, sheet, row, col))) / 100
+
+    if kind == 'binary':
+        op = node[1]
+        left, right = _compile(node[2]), _compile(node[3])
+        if op == '&':
+            return lambda values, sheet, row, col: \
+                text(scalar(left(values, sheet, row, col))) + \
+                text(scalar(right(values, sheet, row, col)))
+        if op in comparison_operators:
+            test = comparison_operators[op]
+            return lambda values, sheet, row, col: test(compare(
+                scalar(left(values, sheet, row, col)),
+                scalar(right(values, sheet, row, col))))
+        apply = arithmetic_operators[op]
+        return lambda values, sheet, row, col: apply(
+            number(scalar(left(values, sheet, row, col))),
+            number(scalar(right(values, sheet, row, col))))
+
+    if kind == 'function':
+        name, arg_nodes = node[1], node[2]
+        args = [_compile(arg) for arg in arg_nodes]
+
+        if name == 'IF':
+            # 選ばれなかった方の引数は計算しない
+            if not 1 <= len(args) <= 3:
+                raise RuntimeError('IF関数の引数の数が正しくありません')
+            condition = args[0]
+            when_true = args[1] if len(args) > 1 else (lambda *_: True)
+            when_false = args[2] if len(args) > 2 else (lambda *_: False)
+            return lambda values, sheet, row, col: (
+                when_true if boolean(scalar(condition(values, sheet, row, col)))
+                else when_false)(values, sheet, row, col)
+
+        if name == 'SUM' and len(arg_nodes) == 1 and arg_nodes[0][0] == 'range':
+            first, last = arg_nodes[0][1]
+            if first.row_abs and (first.col, first.col_abs) == (last.col, last.col_abs):
+                return _running_sum(first, last, args[0])
+
+        f = functions.get(name)
+        if f is None:
+            raise RuntimeError(f'{name}関数の計算には対応していません')
+        return lambda values, sheet, row, col: f(*(arg(values, sheet, row, col) for arg in args))
+
+    raise RuntimeError(f'数式の解析に失敗しました: {node!r}')
+
+
+def _running_sum(first: Ref, last: Ref, cell_range: Compiled) -> Compiled:
+    """
+    返済予定表の`SUM(L$22:L23)`のように、開始行が固定の1列の範囲のSUM。
+
+    計算済みのセルの値は変わらないので、同じ開始行のSUMの途中までの合計を使い回し、
+    前回から増えた行だけを足す。足す順は範囲の先頭からなので、結果は`_sum`と一致する
+    """
+
+    def running_sum(values: Values, sheet: str, row: int, col: int) -> Any:
+        sums = getattr(values, 'running_sums', None)
+        ref_sheet = first.sheet or sheet
+        cells = values.get(ref_sheet)
+        r1, c = first.resolve(row, col)
+        r2, _ = last.resolve(row, col)
+        if sums is None or cells is None or r2 < r1 or r1 < 1 or c < 1:
+            return _sum(cell_range(values, sheet, row, col))
+
+        key = (ref_sheet, c, r1)
+        done, total = sums.get(key, (r1 - 1, 0))
+        if done > r2:
+            done, total = r1 - 1, 0
+        for r in range(done + 1, r2 + 1):
+            v = cells.get((r, c))
+            if isinstance(v, ExcelError):
+                raise _Failed(v)
+            if isinstance(v, (int, float)) and not isinstance(v, bool):
+                total += v
+        sums[key] = (r2, total)
+        return total
+    return running_sum
+
+
+def _references(node: tuple) -> Iterator[Tuple[Ref, Ref]]:
+    """
+    構文木に含まれるセル参照を(始点, 終点)で列挙する
+    """
+    kind = node[0]
+    if kind == 'ref':
+        yield (node[1], node[1])
+    elif kind == 'range':
+        yield node[1]
+    elif kind in {'negate', 'percent'}:
+        yield from _references(node[1])
+    elif kind == 'binary':
+        yield from _references(node[2])
+        yield from _references(node[3])
+    elif kind == 'function':
+        for arg in node[2]:
+            yield from _references(arg)
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_tokens(tokens: Tuple[Tuple[str, Any], ...]) -> Tuple[Compiled, Tuple[Tuple[Ref, Ref], ...]]:
+    """
+    字句の列をコンパイルし、計算する関数と参照しているセルを返す。
+    相対参照は数式のセルからの位置になっているので、行ごとにコピーされた数式は一度だけコンパイルする
+    """
+    node = _Parser(tokens).parse()
+    return (_compile(node), tuple(_references(node)))
+
+
+# ---- ブックの計算 -------------------------------------------------------------
+
+
+def _formula_text(value: Any) -> Optional[str]:
+    # 配列数式(ArrayFormula)は1セル分の数式として計算する
+    text_value = getattr(value, 'text', value)
+    if isinstance(text_value, str) and text_value.startswith('=') and len(text_value) > 1:
+        return text_value
+    return None
+
+
+def _constant(cell: Any) -> Any:
+    value = cell.value
+    if cell.data_type == 'e' and value in errors:
+        return errors[value]
+    if isinstance(value, (datetime, date, time)):
+        return schedule.normalize_number(to_excel(value))
+    return value
+
+
+def _output(value: Any, number_format: str) -> Any:
+    """
+    計算結果をExcelで保存したファイルを読み込んだときと同じ型にする
+    """
+    if isinstance(value, ExcelError):
+        return value.code
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if is_date_format(number_format):
+            return from_excel(value)
+        return schedule.normalize_number(value)
+    return value
+
+
+def _dependency_graph(formulas: Mapping[Tuple[str, int, int], Tuple[Compiled, Tuple[Tuple[Ref, Ref], ...]]]) \
+        -> Dict[Hashable, Set[Hashable]]:
+    """
+    数式のセル -> 参照している数式のセル のグラフを作る。
+
+    返済予定表の`SUM(L$22:L23)`のように行ごとに広がる範囲をセルごとに展開すると、辺の数が
+    行数の2乗になる。列ごとに数式のある行を並べ、先頭から2のべき乗の長さに区切ったブロックを
+    節として加えておき、範囲はbisectで求めた行をブロックの組み合わせ(O(log n)個)で参照する。
+    ブロックの節のキーは('#block', シート名, 列, 開始位置, 長さ)
+    """
+    rows_by_column: Dict[Tuple[str, int], List[int]] = {}
+    for sheet, row, col in sorted(formulas):
+        rows_by_column.setdefault((sheet, col), []).append(row)
+
+    graph: Dict[Hashable, Set[Hashable]] = {}
+
+    def block(sheet: str, col: int, rows: List[int], start: int, length: int) -> Hashable:
+        if length == 1:
+            return (sheet, rows[start], col)
+        key = ('#block', sheet, col, start, length)
+        if key not in graph:
+            half = length // 2
+            graph[key] = {block(sheet, col, rows, start, half),
+                          block(sheet, col, rows, start + half, half)}
+        return key
+
+    for key, (_, refs) in formulas.items():
+        sheet, row, col = key
+        dependencies = graph.setdefault(key, set())
+        for first, last in refs:
+            ref_sheet = first.sheet or sheet
+            r1, c1 = first.resolve(row, col)
+            r2, c2 = last.resolve(row, col)
+            for c in range(min(c1, c2), max(c1, c2) + 1):
+                rows = rows_by_column.get((ref_sheet, c))
+                if rows is None:
+                    continue
+                i = bisect.bisect_left(rows, min(r1, r2))
+                j = bisect.bisect_right(rows, max(r1, r2))
+                while i < j:
+                    # iから始まる、j以内に収まる最大の2のべき乗の長さのブロック
+                    length = i & -i if i else 1 << (j - i).bit_length() - 1
+                    while i + length > j:
+                        length //= 2
+                    dependencies.add(block(ref_sheet, c, rows, i, length))
+                    i += length
+    return graph
+
+
+def evaluate(wb: Workbook) -> Dict[str, Dict[Tuple[int, int], Any]]:
+    """
+    Workbookのすべての数式を計算し、シート名 -> (行, 列) -> 値 を返す。
+    数式でないセルの値もそのまま含める
+    """
+    values: Values = _Values()
+    # relative_key -> コンパイル済みの数式
+    shapes: Dict[str, Tuple[Compiled, Tuple[Tuple[Ref, Ref], ...]]] = {}
+    formulas: Dict[Tuple[str, int, int], Tuple[Compiled, Tuple[Tuple[Ref, Ref], ...]]] = {}
+    number_formats: Dict[Tuple[str, int, int], str] = {}
+    originals: Dict[Tuple[str, int, int], Any] = {}
+
+    for ws in wb.worksheets:
+        ws = cast(Worksheet, ws)
+        cells = values.setdefault(ws.title, {})
+        # iter_rowsは空のセルまで作ってしまうので、値のあるセルだけを見る
+        for (row, col), cell in ws._cells.items():
+            value = cell.value
+            if value is None:
+                continue
+            formula = _formula_text(value)
+            if formula is None:
+                cells[(row, col)] = _constant(cell)
+                originals[(ws.title, row, col)] = value
+                continue
+            key = relative_key(formula, row, col)
+            compiled = shapes.get(key)
+            if compiled is None:
+                try:
+                    compiled = compile_tokens(tokenize(formula, row, col))
+                except RuntimeError as e:
+                    raise RuntimeError(f'{ws.title}!{cell.coordinate}の数式 {formula} を計算できません: {e}')
+                shapes[key] = compiled
+            formulas[(ws.title, row, col)] = compiled
+            number_formats[(ws.title, row, col)] = cell.number_format
+
+    graph = _dependency_graph(formulas)
+    try:
+        order = list(TopologicalSorter(graph).static_order())
+    except CycleError as e:
+        raise RuntimeError(f'循環参照があるため計算できません: {e.args[1]}')
+
+    for key in order:
+        if key not in formulas:
+            # 範囲をまとめるための節
+            continue
+        sheet, row, col = key
+        compiled, _ = formulas[key]
+        try:
+            value = scalar(compiled(values, sheet, row, col))
+        except _Failed as e:
+            value = e.error
+        # 空のセルだけを参照する数式は0になる
+        values[sheet][(row, col)] = 0 if value is None else value
+
+    return {
+        sheet: {
+            (row, col): originals[(sheet, row, col)]
+            if (sheet, row, col) in originals
+            else _output(value, number_formats[(sheet, row, col)])
+            for (row, col), value in cells.items()
+        }
+        for sheet, cells in values.items()
+    }
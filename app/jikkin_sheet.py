@@ -3,16 +3,20 @@
 """
 
 from app import config
-from app import replace
+from app import formula
+from app import manifest
+from app import schedule
 from app import xl_helper
 from app.model import Product, ProductInput, JikkinKV, TableKV
 from dataclasses import dataclass
 from logging import getLogger
 from openpyxl.cell.cell import Cell
 from openpyxl.styles import PatternFill
+from openpyxl.utils.cell import coordinate_to_tuple, get_column_letter
 from openpyxl.workbook.workbook import Workbook
 from openpyxl.worksheet.worksheet import Worksheet
-from typing import Any, ChainMap, Dict, Iterable, Tuple, cast
+from typing import Any, BinaryIO, Callable, ChainMap, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Union, cast
+import io
 import openpyxl
 import os
 import platform
@@ -31,53 +35,215 @@ def range_to_kv(r: Iterable[Tuple[Cell, ...]]) -> Dict[str, Any]:
 class ProductBuilder:
     product_input: ProductInput
     src_jikkin_path: str
-
-    def run(self) -> Product:
-
-        stat = os.stat(self.src_jikkin_path)
-        if platform.system() == 'Windows':
-            if stat.st_ctime == stat.st_mtime:
-                raise RuntimeError(
-                    f"{self.src_jikkin_path}をExcelから開き、同じ名前で名前をつけて保存を実行してください")
-        # macでの処理
-        elif platform.system() == 'Darwin':
-            if stat.st_birthtime == stat.st_mtime:
-                raise RuntimeError(
-                    f"{self.src_jikkin_path}をExcelから開き、同じ名前で名前をつけて保存を実行してください")
+    jikkin_kv: Optional[JikkinKV] = None  # Pythonで計算した場合の入力シートのkv
+    calculated: Optional[schedule.Schedule] = None  # Pythonで計算した実金シート
+    written: bool = True  # 実金シートを出力し直したかどうか。Falseは変更なしで前回の出力が残っている
+
+    def run(self, check_saved: bool = True) -> Product:
+        """
+        実金シートの計算結果から商品の情報を作る。
+
+        check_savedがTrueの場合は、出力した実金シートがExcelで上書き保存されていることを確認する。
+        出力し直していない実金シートは、前回保存された値をそのまま読み込む
+        """
+
+        if self.calculated is not None:
+            # Pythonで計算済みなので、Excelで保存されるのを待つ必要はない
+            return Product(
+                self.product_input,
+                cast(JikkinKV, self.jikkin_kv),
+                cast(TableKV, table_kv_of(self.calculated.jikkin_type, self.calculated)),
+                self.src_jikkin_path,
+                self.calculated)
+
+        if check_saved and self.written:
+            stat = os.stat(self.src_jikkin_path)
+            if platform.system() == 'Windows':
+                if stat.st_ctime == stat.st_mtime:
+                    raise RuntimeError(
+                        f"{self.src_jikkin_path}をExcelから開き、同じ名前で名前をつけて保存を実行してください")
+            # macでの処理
+            elif platform.system() == 'Darwin':
+                if stat.st_birthtime == stat.st_mtime:
+                    raise RuntimeError(
+                        f"{self.src_jikkin_path}をExcelから開き、同じ名前で名前をつけて保存を実行してください")
 
         p_kv, t_kv = jikkin_to_kv(self.src_jikkin_path)
 
         return Product(self.product_input, p_kv, t_kv, self.src_jikkin_path)
 
 
-def output_jikkin_sheet(product_input: ProductInput, template_path: str, output_path: str, config: config.Config) -> ProductBuilder:
-
+def fill_jikkin_workbook(product_input: ProductInput, template_path: str, write_table: bool = True) -> Workbook:
+    """
+    実金シートのテンプレートを読み込み、入力シートに商品の値を書き込んで返済予定表の表を作る。
+    write_tableがFalseの場合は入力シートだけを書き込む
+    """
     wb = openpyxl.load_workbook(template_path)
     for k, v in zip(*wb['入力シート'].iter_cols(0, 2)):
         if k.value is None:
             continue
         v.value = product_input.get(k.value)
 
-    write_table_to(wb)
+    if write_table:
+        write_table_to(wb)
+    return wb
+
+
+def output_jikkin_sheet(product_input: ProductInput, template_path: str, output_path: str, config: config.Config, calculation: str = 'excel') -> ProductBuilder:
+    """
+    実金シートを出力する。
 
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    wb.save(output_path)
+    calculationで実金シートの計算方法を指定する。
+    - excel: Excelで開いて上書き保存してもらい、`ProductBuilder.run`で保存された値を読み込む
+    - python: 返済予定表を`schedule.calculate`で計算する
+    - formula: 実金シートの数式を`formula.evaluate`でそのまま計算する
+    - recalculate: 出力後に`converter`のバックエンドで再計算して保存する(`ProductBuilder.run`で読み込む)
+
+    python, formulaでは、Excelで上書き保存しなくても`ProductBuilder.run`で商品の情報を取得できる。
+    formula以外では、テンプレートをopenpyxlで保存し直さずに`stream_jikkin_sheet`で出力する
+    """
+
+    calculated = None
+    jikkin_kv = None
+    # シート名 -> (行, 列) -> 計算結果。出力するファイルに計算済みの値として書き込む
+    values: Dict[str, Mapping[Tuple[int, int], Any]] = {}
+    t = jikkin_type(product_input.product_kv['商品区分'])
+    source = None
+    if calculation == 'formula':
+        # 数式をそのまま計算するので、openpyxlで読み込んだワークブックから出力する
+        wb = fill_jikkin_workbook(product_input, template_path)
+        values = formula.evaluate(wb)
+        calculated, jikkin_kv = jikkin_from_values(wb, t, values)
+        source = xl_helper.save_with_cached_values(wb, values, shared=['実金'])
+    elif calculation == 'python':
+        wb = fill_jikkin_workbook(product_input, template_path)
+        calculated = schedule.calculate(wb, t)
+        jikkin_kv = schedule.input_kv(wb)
+        values = {'実金': calculated.values}
+    elif calculation not in {'excel', 'recalculate'}:
+        raise RuntimeError(f'実金シートの計算方法{calculation!r}には対応していません。')
+
+    if source is None:
+        try:
+            source = stream_jikkin_sheet(product_input, template_path, values.get('実金'))
+        except ValueError as e:
+            logger.warning(f'{template_path}を直接書き換えられないため、openpyxlで保存します: {e}')
+            wb = fill_jikkin_workbook(product_input, template_path)
+            source = xl_helper.save_with_cached_values(wb, values, shared=['実金'])
 
     product_name = product_input.product_kv['商品区分']
     product_state = product_input.product_kv['州国']
 
     logger.info(f'get jikkin sheet {config.get_jikkin_sheet_form_no}')
-    replace.replace(output_path, output_path,
-                    ChainMap(
-                        product_input.product_kv,
-                        config.get_kv_for_product(
-                            product_name,
-                            config.get_jikkin_sheet_form_no(product_name),
-                            product_state
-                        )
-                    ))
+    written = manifest.output_document(
+        source,
+        output_path,
+        ChainMap(
+            product_input.product_kv,
+            config.get_kv_for_product(
+                product_name,
+                config.get_jikkin_sheet_form_no(product_name),
+                product_state
+            )
+        ),
+        # Excelでの上書き保存や再計算の前は計算結果がないので、確認できるまで出力済みとしない
+        deferred=calculation in {'excel', 'recalculate'})
+
+    return ProductBuilder(product_input, output_path, jikkin_kv, calculated, written)
+
+
+def _relative_formula(v: Any, row: int, column: int) -> Optional[str]:
+    if isinstance(v, str) and len(v) > 1 and v.startswith('='):
+        return xl_helper.relative_formula(v[1:], row, column)
+    return None
 
-    return ProductBuilder(product_input, output_path)
+
+def stream_jikkin_sheet(product_input: ProductInput, template_path: str,
+                        values: Optional[Mapping[Tuple[int, int], Any]] = None) -> io.BytesIO:
+    """
+    実金シートのテンプレートのXMLに、入力シートの値と返済予定表の行を先頭から順に書き込んで出力する。
+
+    openpyxlでテンプレートのすべてのセルを読み込んで保存する代わりに、入力シートの値と
+    返済予定表の行の<c>だけを組み立て、見出しの行や列の幅、印刷の設定、休日・固定値のシートは
+    テンプレートのまま出力する。valuesには実金シートの計算結果((行, 列) -> 値)を渡す。
+    返済予定表の行は1行ずつ組み立てて出力するパートに書き込み、毎月の行の数式は共有数式にする。
+
+    テンプレートのXMLを書き換えられない場合はValueErrorを送出する
+    """
+    package = xl_helper.TemplatePackage(template_path)
+
+    # 入力シートのA列の項目名の値をB列に書き込む(`fill_jikkin_workbook`と同じ)
+    input_cells = {}
+    kv = {}
+    for row, row_xml in xl_helper.sheet_rows(package.sheet_xml('入力シート')):
+        cells = xl_helper.row_cells(row_xml)
+        label = package.value(cells.get(1))
+        if label is None:
+            continue
+        value = product_input.get(label)
+        if isinstance(label, str):
+            kv[label.rstrip()] = value
+        input_cells[(row, 2)] = package.cell_xml(f'B{row}', xl_helper.cell_style_id(cells.get(2)), value)
+    package.set_sheet_xml('入力シート', xl_helper.replace_cells(package.sheet_xml('入力シート'), input_cells))
+
+    table = jikkin_table(jikkin_type(product_input.product_kv['商品区分']), kv)
+    jikkin_xml = package.sheet_xml('実金')
+
+    # 見出しのセルと、表の行にスタイルをコピーする行のセル
+    header_rows = {coordinate_to_tuple(coordinate)[0] for coordinate in table.cells} | {table.style_row}
+    template_cells = {row: xl_helper.row_cells(row_xml)
+                      for row, row_xml in xl_helper.sheet_rows(jikkin_xml) if row in header_rows}
+    style_row = template_cells.get(table.style_row, {})
+    styles = [xl_helper.cell_style_id(style_row.get(column)) for column in range(1, table.max_col + 1)]
+    gold_styles = {}
+    for coordinate in table.gold_cells:
+        row, column = coordinate_to_tuple(coordinate)
+        gold_styles[(row, column)] = package.styles.derive(styles[column - 1], fill=gold_pattern_fill)
+
+    header_cells = {}
+    for coordinate, v in table.cells.items():
+        row, column = coordinate_to_tuple(coordinate)
+        style_id = xl_helper.cell_style_id(template_cells.get(row, {}).get(column))
+        header_cells[(row, column)] = package.cell_xml(coordinate, style_id, v)
+
+    # 毎月の行の数式は、列ごとに2回目の行を元にした共有数式にする(最終月の行も同じ数式ならそこまで)
+    last_month_row = table.end_row - 1
+    shared: Dict[int, Tuple[str, int, int]] = {}  # 列 -> (相対位置の数式, 末尾の行, 共有数式の番号)
+    if table.start_row < last_month_row:
+        first = table.row_values(table.start_row)
+        last = table.row_values(last_month_row)
+        for column, (v, last_v) in enumerate(zip(first, last), 1):
+            key = _relative_formula(v, table.start_row, column)
+            if key is None:
+                continue
+            end = last_month_row if _relative_formula(last_v, last_month_row, column) == key else last_month_row - 1
+            if end > table.start_row:
+                shared[column] = (key, end, len(shared))
+
+    def table_rows() -> Iterator[Tuple[int, List[str]]]:
+        letters = [get_column_letter(column) for column in range(1, table.max_col + 1)]
+        for row, src_row in table.iter_rows():
+            cells = []
+            for column, (letter, style_id, v) in enumerate(zip(letters, styles, src_row), 1):
+                ref = f'{letter}{row}'
+                style_id = gold_styles.get((row, column), style_id)
+                key, end, index = shared.get(column, (None, 0, 0))
+                if key is None or not table.start_row <= row <= end:
+                    cells.append(package.cell_xml(ref, style_id, v))
+                elif row == table.start_row:
+                    cells.append(package.cell_xml(ref, style_id, v, shared=(index, f'{ref}:{letter}{end}')))
+                elif _relative_formula(v, row, column) == key:
+                    cells.append(package.cell_xml(ref, style_id, v, shared=(index, None)))
+                else:
+                    raise ValueError(f'{ref}の数式が{letter}{table.start_row}の数式をコピーした関係になっていません')
+            yield row, cells
+
+    chunks = xl_helper.replace_cells(jikkin_xml, header_cells, table_rows(), (table.end_row, table.max_col))
+    if values:
+        chunks = (xl_helper.write_cached_values(chunk, values) for chunk in chunks)
+    package.set_sheet_xml('実金', chunks)
+
+    return package.save()
 
 
 def jikkin_type(product_name: str) -> str:
@@ -138,6 +304,14 @@ def get_keywords_for_each_products(ws: Worksheet) -> Iterable[ProductInput]:
         yield r
 
 
+def read_input_sheet(path: Union[str, BinaryIO]) -> List[ProductInput]:
+    """
+    入力シート.xlsx(パスまたはファイルオブジェクト)を読み込み、商品ごとの入力値を返す
+    """
+    wb = openpyxl.load_workbook(path, data_only=True)
+    return list(get_keywords_for_each_products(wb['入力シート']))
+
+
 def product_input(wb: Workbook) -> JikkinKV:
     """
     実金.xlsxの入力シートからkvを生成する。入力シート.xlsxに対しての処理でないことに注意
@@ -163,10 +337,112 @@ def write_table_to(wb: Workbook):
         return process_e(wb)
 
 
-def process_a_d(workbook: Workbook):
+@dataclass(frozen=True)
+class JikkinTable:
+    """
+    実金シートに書き込む返済予定表。
+
+    2回目の行から合計の行までの行の値と、最終月や合計の行を参照する見出しのセルの数式。
+    行の値は`iter_rows`で1行ずつ作るので、openpyxlのワークブックにも(`write_table`)、
+    テンプレートのXMLにも(`stream_jikkin_sheet`)弁済回数によらず同じように書き込める
+    """
+    start_row: int  # 2回目の行。1行上の行のスタイルを表のすべての行に適用する
+    repeat: int  # 弁済回数
+    max_col: int
+    rows: Mapping[str, Callable[..., Tuple[Any, ...]]]  # 毎月・最終月(行番号 -> A列からの値)、合計(先頭の行, 末尾の行 -> 値)
+    cells: Dict[str, Any]  # 最終月や合計の行に依存する見出しのセル
+    gold_cells: Tuple[str, ...] = ()  # 背景を黄色にするセル
+
+    @property
+    def style_row(self) -> int:
+        return self.start_row - 1
+
+    @property
+    def end_row(self) -> int:
+        """
+        合計の行
+        """
+        return self.start_row + self.repeat - 1
+
+    def row_values(self, row_idx: int) -> Tuple[Any, ...]:
+        if row_idx < self.end_row - 1:
+            src_row = self.rows['毎月'](row_idx)
+        elif row_idx == self.end_row - 1:
+            src_row = self.rows['最終月'](row_idx)
+        else:
+            src_row = self.rows['合計'](row_idx - 1 - self.repeat, row_idx - 1)
+
+        assert (len(src_row) == self.max_col)
+        return src_row
+
+    def iter_rows(self) -> Iterator[Tuple[int, Tuple[Any, ...]]]:
+        """
+        2回目から合計までの(行番号, 値)
+        """
+        for row_idx in range(self.start_row, self.end_row + 1):
+            yield row_idx, self.row_values(row_idx)
+
+
+gold_pattern_fill = PatternFill(patternType='solid', fgColor='fff2cc')
+
+
+def jikkin_table(t: str, kv: Mapping[str, Any], input_title: str = '入力シート') -> JikkinTable:
+    """
+    実金シートの種類と入力シートのkvから、返済予定表を作る
+    """
+    if t in {'A', 'D'}:
+        return table_a_d(kv, input_title)
+    if t == 'B':
+        return table_b(kv, input_title)
+    if t == 'C':
+        return table_c(kv, input_title)
+    if t == 'E':
+        return table_e(kv, input_title)
+    raise RuntimeError(f'実金シートの種類{t}には対応していません。')
+
+
+def write_table(workbook: Workbook, table: JikkinTable):
+    """
+    返済予定表を実金シートに書き込む
+    """
     jikkin_sheet = cast(Worksheet, workbook['実金'])
-    kv = product_input(workbook)
+    rows = list(jikkin_sheet.iter_rows(
+        min_row=table.start_row,
+        max_row=table.end_row,
+        min_col=1,
+        max_col=table.max_col))
+    for row, (_, src_row) in zip(rows, table.iter_rows()):
+        for cell, v in zip(row, src_row):
+            cell.value = v
+
+    # スタイルの適用。表のすべての行に、コピー元の行のスタイルのidを書き込む
+    style_row = next(jikkin_sheet.iter_rows(table.style_row, table.style_row))
+    xl_helper.copy_row_styles(style_row, rows)
+
+    # 最終月や合計に依存するセルを更新
+    for coordinate in table.gold_cells:
+        jikkin_sheet[coordinate].fill = gold_pattern_fill
+    for coordinate, v in table.cells.items():
+        jikkin_sheet[coordinate].value = v
+
 
+def process_a_d(workbook: Workbook):
+    write_table(workbook, table_a_d(product_input(workbook), workbook['入力シート'].title))
+
+
+def process_b(workbook: Workbook):
+    write_table(workbook, table_b(product_input(workbook), workbook['入力シート'].title))
+
+
+def process_c(workbook: Workbook):
+    write_table(workbook, table_c(product_input(workbook), workbook['入力シート'].title))
+
+
+def process_e(workbook: Workbook):
+    write_table(workbook, table_e(product_input(workbook), workbook['入力シート'].title))
+
+
+def table_a_d(kv: Mapping[str, Any], input_title: str) -> JikkinTable:
     rows = {
         "毎月": lambda idx: (
             f'=A{idx-1} + 1',
@@ -206,60 +482,29 @@ def process_a_d(workbook: Workbook):
     repeat_start_idx = 23
     repeat = kv['弁済回数']
     repeat_end_idx = repeat_start_idx + repeat - 3  # 二回目から最終回直前までなので、-3
-    min_col = 1
     max_col = 9  # I列
-    table = list(jikkin_sheet.iter_rows(
-        min_row=repeat_start_idx,
-        max_row=repeat_end_idx + 2,
-        min_col=min_col,
-        max_col=max_col))
-
-    style_row = next(jikkin_sheet.iter_rows(
-        repeat_start_idx-1, repeat_start_idx-1))
-
-    for row in table:
-        row_idx = row[0].row
-        if repeat_start_idx <= row_idx <= repeat_end_idx:
-            src_row = rows['毎月'](row_idx)
-        elif row_idx == repeat_end_idx + 1:
-            src_row = rows['最終月'](row_idx)
-        elif row_idx == repeat_end_idx + 2:
-            src_row = rows['合計'](row_idx - 1 - repeat, row_idx - 1)
-
-        assert (len(src_row) == max_col - min_col + 1)
-        for cell, v in zip(row, src_row):
-            cell.value = v
-
-        # スタイルの適用
-        for s, d in zip(style_row, row):
-            xl_helper.copy_style(s, d)
-
-    # 最終月や合計に依存するセルを更新
-
+    # 最終月や合計に依存するセル
     last_month_idx = repeat_end_idx + 1
     sum_idx = last_month_idx + 1
 
-    goldPatternFill = PatternFill(patternType='solid', fgColor='fff2cc')
-    jikkin_sheet[f'E{last_month_idx}'].fill = goldPatternFill
-    jikkin_sheet[f'H{sum_idx}'].fill = goldPatternFill
-
-    jikkin_sheet['E6'].value = f'=ROUNDDOWN(G6/H{sum_idx}, 5)'
-    jikkin_sheet['E7'].value = f'=D{sum_idx} + E{sum_idx}'
-
-    jikkin_sheet['E10'].value = f'=D{last_month_idx} + E{last_month_idx}'
-    jikkin_sheet['G6'].value = f'=C{sum_idx} + D{sum_idx}'
-    jikkin_sheet['G7'].value = f'=ABS(E{sum_idx})'
-
-
-def process_b(workbook: Workbook):
+    return JikkinTable(
+        repeat_start_idx,
+        repeat,
+        max_col,
+        rows,
+        {
+            'E6': f'=ROUNDDOWN(G6/H{sum_idx}, 5)',
+            'E7': f'=D{sum_idx} + E{sum_idx}',
+            'E10': f'=D{last_month_idx} + E{last_month_idx}',
+            'G6': f'=C{sum_idx} + D{sum_idx}',
+            'G7': f'=ABS(E{sum_idx})',
+        },
+        (f'E{last_month_idx}', f'H{sum_idx}'))
+
+def table_b(kv: Mapping[str, Any], input_title: str) -> JikkinTable:
     """
     端数処理ありバルーン
     """
-    input_sheet = cast(Worksheet, workbook['入力シート'])
-    jikkin_sheet = cast(Worksheet, workbook['実金'])
-
-    kv = product_input(workbook)
-
     rows = {
         "毎月": lambda idx: (
             f'=A{idx-1} + 1',
@@ -273,7 +518,7 @@ def process_b(workbook: Workbook):
             f'=IF(G{idx-1}>0, ROUNDDOWN(H{idx-1} * J{idx} / 365, 0), 0)',
             f'=DATEDIF(B{idx-1}, B{idx}, "d")',
             '',  # -------------------------------------------------------------
-            f'=IF(AND(B{idx}>={input_sheet.title}!$B$22, A{idx}<={input_sheet.title}!$B$40), IF(MONTH(B{idx})=F$5, 1, 0), 0)',
+            f'=IF(AND(B{idx}>={input_title}!$B$22, A{idx}<={input_title}!$B$40), IF(MONTH(B{idx})=F$5, 1, 0), 0)',
             f'=SUM(L$22:L{idx})',
         ),
         "最終月": lambda idx: (
@@ -288,7 +533,7 @@ def process_b(workbook: Workbook):
             f'=IF(G{idx-1}>0, ROUNDDOWN(H{idx-1} * J{idx} / 365, 0), 0)',
             f'=DATEDIF(B{idx-1}, B{idx}, "d")',
             '',  # -------------------------------------------------------------
-            f'=IF(AND(B{idx}>={input_sheet.title}!$B$22, A{idx}<={input_sheet.title}!$B$40), IF(MONTH(B{idx})=F$5, 1, 0), 0)',
+            f'=IF(AND(B{idx}>={input_title}!$B$22, A{idx}<={input_title}!$B$40), IF(MONTH(B{idx})=F$5, 1, 0), 0)',
             f'=SUM(L$22:L{idx})',
         ),
         "合計": lambda start, end: (
@@ -311,57 +556,31 @@ def process_b(workbook: Workbook):
     repeat_start_idx = 24
     repeat = kv['弁済回数']
     repeat_end_idx = repeat_start_idx + repeat - 3  # 二回目から最終回直前までなので、-3
-    min_col = 1
     max_col = 13  # M列(13)
-    table = list(jikkin_sheet.iter_rows(
-        min_row=repeat_start_idx,
-        max_row=repeat_end_idx + 2,
-        min_col=min_col,
-        max_col=max_col))
-
-    style_row = next(jikkin_sheet.iter_rows(
-        repeat_start_idx-1, repeat_start_idx-1))
-
-    for row in table:
-        row_idx = row[0].row
-        if repeat_start_idx <= row_idx <= repeat_end_idx:
-            src_row = rows['毎月'](row_idx)
-        elif row_idx == repeat_end_idx + 1:
-            src_row = rows['最終月'](row_idx)
-        elif row_idx == repeat_end_idx + 2:
-            src_row = rows['合計'](row_idx - 1 - repeat, row_idx - 1)
-
-        assert (len(src_row) == max_col - min_col + 1)
-        for cell, v in zip(row, src_row):
-            cell.value = v
-
-        # スタイルの適用
-        for s, d in zip(style_row, row):
-            xl_helper.copy_style(s, d)
-
-    # 最終月や合計に依存するセルを更新
-
+    # 最終月や合計に依存するセル
     last_month_idx = repeat_end_idx + 1
     sum_idx = last_month_idx + 1
 
-    jikkin_sheet['F7'].value = f'=ROUNDDOWN($H$7/$I${sum_idx}, 5)'
-    jikkin_sheet['F8'].value = f'=$E${sum_idx} + $F${sum_idx}'
-    jikkin_sheet['F11'].value = f'=$E${last_month_idx} + $F${last_month_idx}'
-    jikkin_sheet['F12'].value = f'=VLOOKUP(入力シート!$B$22,$B$22:$F{last_month_idx},5,0)'
-
-    jikkin_sheet['H5'].value = f'=F{last_month_idx}/($B$4 * $B$7)'
-    jikkin_sheet['H7'].value = f'=$D${sum_idx} + $E${sum_idx}'
-    jikkin_sheet['H8'].value = f'=ABS($F${sum_idx})'
-
-
-def process_c(workbook: Workbook):
+    return JikkinTable(
+        repeat_start_idx,
+        repeat,
+        max_col,
+        rows,
+        {
+            'F7': f'=ROUNDDOWN($H$7/$I${sum_idx}, 5)',
+            'F8': f'=$E${sum_idx} + $F${sum_idx}',
+            'F11': f'=$E${last_month_idx} + $F${last_month_idx}',
+            'F12': f'=VLOOKUP(入力シート!$B$22,$B$22:$F{last_month_idx},5,0)',
+            'H5': f'=F{last_month_idx}/($B$4 * $B$7)',
+            'H7': f'=$D${sum_idx} + $E${sum_idx}',
+            'H8': f'=ABS($F${sum_idx})',
+        })
+
+
+def table_c(kv: Mapping[str, Any], input_title: str) -> JikkinTable:
     """
     端数処理ありバルーン
     """
-    input_sheet = cast(Worksheet, workbook['入力シート'])
-    jikkin_sheet = cast(Worksheet, workbook['実金'])
-    kv = product_input(workbook)
-
     rows = {
         "毎月": lambda idx: (
             f'=A{idx-1} + 1',
@@ -375,7 +594,7 @@ def process_c(workbook: Workbook):
             f'=IF(G{idx-1}>0, ROUNDDOWN(H{idx-1} * J{idx} / 365, 0), 0)',
             f'=DATEDIF(B{idx-1}, B{idx}, "d")',
             '',  # -------------------------------------------------------------
-            f'=IF(AND(B{idx}>={input_sheet.title}!$B$22, A{idx}<={input_sheet.title}!$B$40), IF(MONTH(B{idx})=F$5, 1, 0), 0)',
+            f'=IF(AND(B{idx}>={input_title}!$B$22, A{idx}<={input_title}!$B$40), IF(MONTH(B{idx})=F$5, 1, 0), 0)',
             f'=SUM(L$22:L{idx})',
             f'=IF(N$22>=M{idx}, 1, 0)'
         ),
@@ -391,7 +610,7 @@ def process_c(workbook: Workbook):
             f'=IF(G{idx-1}>0, ROUNDDOWN(H{idx-1} * J{idx} / 365, 0), 0)',
             f'=DATEDIF(B{idx-1}, B{idx}, "d")',
             '',  # -------------------------------------------------------------
-            f'=IF(AND(B{idx}>={input_sheet.title}!$B$22, A{idx}<={input_sheet.title}!$B$40), IF(MONTH(B{idx})=F$5, 1, 0), 0)',
+            f'=IF(AND(B{idx}>={input_title}!$B$22, A{idx}<={input_title}!$B$40), IF(MONTH(B{idx})=F$5, 1, 0), 0)',
             f'=SUM(L$22:L{idx})',
             f'=IF(N$22>=M{idx}, 1, 0)'
         ),
@@ -416,57 +635,31 @@ def process_c(workbook: Workbook):
     repeat_start_idx = 24
     repeat = kv['弁済回数']
     repeat_end_idx = repeat_start_idx + repeat - 3  # 二回目から最終回直前までなので、-3
-    min_col = 1
     max_col = 14  # N列(14)
-    table = list(jikkin_sheet.iter_rows(
-        min_row=repeat_start_idx,
-        max_row=repeat_end_idx + 2,
-        min_col=min_col,
-        max_col=max_col))
-
-    style_row = next(jikkin_sheet.iter_rows(
-        repeat_start_idx-1, repeat_start_idx-1))
-    for row in table:
-        row_idx = row[0].row
-        if repeat_start_idx <= row_idx <= repeat_end_idx:
-            src_row = rows['毎月'](row_idx)
-        elif row_idx == repeat_end_idx + 1:
-            src_row = rows['最終月'](row_idx)
-        elif row_idx == repeat_end_idx + 2:
-            src_row = rows['合計'](row_idx - 1 - repeat, row_idx - 1)
-
-        assert (len(src_row) == max_col - min_col + 1)
-        for cell, v in zip(row, src_row):
-            cell.value = v
-
-        # スタイルの適用
-        for s, d in zip(style_row, row):
-            xl_helper.copy_style(s, d)
-
-    # 最終月や合計に依存するセルを更新
-
+    # 最終月や合計に依存するセル
     last_month_idx = repeat_end_idx + 1
     sum_idx = last_month_idx + 1
 
-    jikkin_sheet['F7'].value = f'=ROUNDDOWN($H$7/$I${sum_idx}, 5)'
-    jikkin_sheet['F8'].value = f'=$E${sum_idx} + $F${sum_idx}'
-    jikkin_sheet['F11'].value = f'=$E${last_month_idx} + $F${last_month_idx}'
-    jikkin_sheet['F12'].value = f'=VLOOKUP({input_sheet.title}!$B$22,$B$22:$F{last_month_idx},5,0)'
-
-    jikkin_sheet['H5'].value = f'=F{sum_idx}/($B$4 * $B$7)'
-    jikkin_sheet['H7'].value = f'=$D${sum_idx} + $E${sum_idx}'
-    jikkin_sheet['H8'].value = f'=ABS($F${sum_idx})'
-
-
-def process_e(workbook: Workbook):
+    return JikkinTable(
+        repeat_start_idx,
+        repeat,
+        max_col,
+        rows,
+        {
+            'F7': f'=ROUNDDOWN($H$7/$I${sum_idx}, 5)',
+            'F8': f'=$E${sum_idx} + $F${sum_idx}',
+            'F11': f'=$E${last_month_idx} + $F${last_month_idx}',
+            'F12': f'=VLOOKUP({input_title}!$B$22,$B$22:$F{last_month_idx},5,0)',
+            'H5': f'=F{sum_idx}/($B$4 * $B$7)',
+            'H7': f'=$D${sum_idx} + $E${sum_idx}',
+            'H8': f'=ABS($F${sum_idx})',
+        })
+
+
+def table_e(kv: Mapping[str, Any], input_title: str) -> JikkinTable:
     """
     端数処理ありバルーン
     """
-    input_sheet = cast(Worksheet, workbook['入力シート'])
-    jikkin_sheet = cast(Worksheet, workbook['実金'])
-
-    kv = product_input(workbook)
-
     rows = {
         "毎月": lambda idx: (
             f'=A{idx-1} + 1',
@@ -480,7 +673,7 @@ def process_e(workbook: Workbook):
             f'=IF(G{idx-1}>0, ROUNDDOWN(H{idx-1} * J{idx} / 365, 0), 0)',
             f'=DATEDIF(B{idx-1}, B{idx}, "d")',
             '',  # -------------------------------------------------------------
-            f'=IF(AND(B{idx}>={input_sheet.title}!$B$24, A{idx}<={input_sheet.title}!$B$42), IF(MONTH(B{idx})=F$5, 1, 0), 0)',
+            f'=IF(AND(B{idx}>={input_title}!$B$24, A{idx}<={input_title}!$B$42), IF(MONTH(B{idx})=F$5, 1, 0), 0)',
             f'=SUM(L$22:L{idx})',
         ),
         "最終月": lambda idx: (
@@ -495,7 +688,7 @@ def process_e(workbook: Workbook):
             f'=IF(G{idx-1}>0, ROUNDDOWN(H{idx-1} * J{idx} / 365, 0), 0)',
             f'=DATEDIF(B{idx-1}, B{idx}, "d")',
             '',  # -------------------------------------------------------------
-            f'=IF(AND(B{idx}>={input_sheet.title}!$B$24, A{idx}<={input_sheet.title}!$B$42), IF(MONTH(B{idx})=F$5, 1, 0), 0)',
+            f'=IF(AND(B{idx}>={input_title}!$B$24, A{idx}<={input_title}!$B$42), IF(MONTH(B{idx})=F$5, 1, 0), 0)',
             f'=SUM(L$22:L{idx})',
         ),
         "合計": lambda start, end: (
@@ -518,47 +711,41 @@ def process_e(workbook: Workbook):
     repeat_start_idx = 24
     repeat = kv['弁済回数']
     repeat_end_idx = repeat_start_idx + repeat - 3  # 二回目から最終回直前までなので、-3
-    min_col = 1
     max_col = 13  # M列(13)
-    table = list(jikkin_sheet.iter_rows(
-        min_row=repeat_start_idx,
-        max_row=repeat_end_idx + 2,
-        min_col=min_col,
-        max_col=max_col))
-
-    style_row = next(jikkin_sheet.iter_rows(
-        repeat_start_idx-1, repeat_start_idx-1))
-
-    for row in table:
-        row_idx = row[0].row
-        if repeat_start_idx <= row_idx <= repeat_end_idx:
-            src_row = rows['毎月'](row_idx)
-        elif row_idx == repeat_end_idx + 1:
-            src_row = rows['最終月'](row_idx)
-        elif row_idx == repeat_end_idx + 2:
-            src_row = rows['合計'](row_idx - 1 - repeat, row_idx - 1)
-
-        assert (len(src_row) == max_col - min_col + 1)
-        for cell, v in zip(row, src_row):
-            cell.value = v
-
-        # スタイルの適用
-        for s, d in zip(style_row, row):
-            xl_helper.copy_style(s, d)
-
-    # 最終月や合計に依存するセルを更新
-
+    # 最終月や合計に依存するセル
     last_month_idx = repeat_end_idx + 1
     sum_idx = last_month_idx + 1
 
-    jikkin_sheet['F7'].value = f'=ROUNDDOWN($H$7/$I${sum_idx}, 5)'
-    jikkin_sheet['F8'].value = f'=$E${sum_idx} + $F${sum_idx}'
-    jikkin_sheet['F11'].value = f'=$E${last_month_idx} + $F${last_month_idx}'
-    jikkin_sheet['F12'].value = f'=VLOOKUP({input_sheet.title}!$B$24,$B$22:$F{last_month_idx},5,0)'
+    return JikkinTable(
+        repeat_start_idx,
+        repeat,
+        max_col,
+        rows,
+        {
+            'F7': f'=ROUNDDOWN($H$7/$I${sum_idx}, 5)',
+            'F8': f'=$E${sum_idx} + $F${sum_idx}',
+            'F11': f'=$E${last_month_idx} + $F${last_month_idx}',
+            'F12': f'=VLOOKUP({input_title}!$B$24,$B$22:$F{last_month_idx},5,0)',
+            'H5': f'=F{last_month_idx}/($B$4 * $B$7)',
+            'H7': f'=$D${sum_idx} + $E${sum_idx}',
+            'H8': f'=ABS($F${sum_idx})',
+        })
+
+
+def jikkin_from_values(wb: Workbook, t: str, values: Mapping[str, Mapping[Tuple[int, int], Any]]) -> Tuple[schedule.Schedule, JikkinKV]:
+    """
+    `formula.evaluate`で計算した値から、計算結果の実金シートと入力シートのkvを返す
+    """
+    table_sheet = cast(Worksheet, wb['実金'])
+    number_formats = {key: cell.number_format
+                      for key, cell in table_sheet._cells.items() if cell.value is not None}
+
+    input_values = values['入力シート']
+    kv = {label.rstrip(): input_values.get((row, 2))
+          for (row, col), label in input_values.items()
+          if col == 1 and isinstance(label, str)}
 
-    jikkin_sheet['H5'].value = f'=F{last_month_idx}/($B$4 * $B$7)'
-    jikkin_sheet['H7'].value = f'=$D${sum_idx} + $E${sum_idx}'
-    jikkin_sheet['H8'].value = f'=ABS($F${sum_idx})'
+    return (schedule.from_values(t, values['実金'], number_formats), cast(JikkinKV, kv))
 
 
 def jikkin_to_kv(jikkin_path: str) -> Tuple[JikkinKV, TableKV]:
@@ -571,7 +758,14 @@ def table_kv(wb: Workbook) -> Dict[str, Any]:
     p = product_input(wb)
     t = jikkin_type(p['商品区分'])
 
-    table_sheet = cast(Worksheet, wb['実金'])
+    return table_kv_of(t, cast(Worksheet, wb['実金']))
+
+
+def table_kv_of(t: str, table_sheet: Union[Worksheet, schedule.Schedule]) -> Dict[str, Any]:
+    """
+    実金シートの表からkvを生成する。table_sheetにはExcelで計算済みのシートか、
+    Pythonで計算した`schedule.Schedule`を渡す
+    """
 
     if t in {'A', 'D'}:
         return {
@@ -0,0 +1,210 @@
+"""
+テンプレートが参照するキーワードの索引から、入力シートの変更の影響を受ける帳票を求めるモジュール
+"""
+
+from app import docx_helper, jikkin_sheet, replace, schedule, template_cache, xl_helper
+from app.chohyo_gen import ChohyoGenerator, OutputTarget, job_outputs
+from app.model import ProductInput
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Any, Dict, FrozenSet, Iterable, List, Mapping, Optional, Set
+import docx
+import functools
+import glob
+import openpyxl
+import os
+
+logger = getLogger(__name__)
+
+# 実金シートの返済予定表を表す項目名。大阪シートのように表をそのまま使う帳票が参照する
+jikkin_key = '実金シート'
+
+# 2054, 9054の請求書とDEEDで、直前の70Nの列と区別するために番号をつけて置換している項目
+numbered_keys = {
+    '商品名マスタ１': '商品名マスタ',
+    '商品名マスタ２': '商品名マスタ',
+    '請求額（円）１': '請求額（円）',
+    '請求額（円）２': '請求額（円）',
+    '金消契約日１': '金消契約日',
+    '金消契約日２': '金消契約日',
+    '最終弁済日１': '最終弁済日',
+    '最終弁済日２': '最終弁済日',
+}
+
+# 連帯保証人の入力項目
+guarantor_keys = frozenset({'連帯保証人名', '連帯保証人郵便番号', '連帯保証人住所', '連帯保証人住所出力'})
+
+# 出力先のファイル名やテンプレートの選択に使う項目。変更した場合はその商品の帳票をすべて出力し直す
+layout_keys = frozenset({
+    '商品区分', '州国', '担保明細－州国', '金消契約日', '顧客名', '法人名',
+    'ファイル名用住所', '配偶者名', '担保物件所有者区分（Ｃｈａｃｏｔ）',
+})
+
+# テンプレートの"●項目名●"のほかに、出力処理のコードが読む項目
+code_keys: Dict[int, FrozenSet[str]] = {
+    2: guarantor_keys,  # 依頼書の連帯保証人の表
+    26: guarantor_keys,
+    4: guarantor_keys,  # 金消の連帯保証人の表
+    19: guarantor_keys,
+    5: guarantor_keys,  # 事前説明書の連帯保証人の表
+    6: guarantor_keys,
+    24: guarantor_keys,
+    25: guarantor_keys,
+    10: frozenset({jikkin_key, '最終弁済時ＬＴＶ', '約定利率', '貸付元本額（￥）'}),  # 大阪シート
+    17: frozenset({'Ｐｒｏｐｅｒｔｙ　Ａｄｄ', '請求額合計（円）', '商品区分'}),  # 請求書合計
+    18: frozenset({'商品区分', '担保明細－物件名', '貸付元本額（円）'}),  # 貸付金額合計
+}
+
+# 連帯保証人ごとに出力する帳票で、連帯保証人の値で上書きする項目
+guarantor_override_keys: Dict[int, FrozenSet[str]] = {
+    3: frozenset({'郵便番号', '顧客住所'}),
+    15: frozenset({'連帯保証人名', '連帯保証人住所'}),
+    16: frozenset({'連帯保証人名', '連帯保証人住所'}),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _template_keys(path: str, size: int, mtime_ns: int) -> FrozenSet[str]:
+    template = template_cache.get(path)
+    keys = {slot.key for slot in template.slots}
+
+    if template.fragmented:
+        # コンパイルでまとめられなかったキーワードは、置換と同じように開いて探す
+        texts: Iterable[Any]
+        if template.ext == '.xlsx':
+            wb = openpyxl.load_workbook(template.open())
+            texts = [
+                *(cell.value for ws in wb for row in ws.iter_rows() for cell in row),
+                *(part.text for ws in wb for part in xl_helper.all_header_footer_parts(ws)),
+            ]
+        else:
+            texts = (paragraph.text for paragraph in docx_helper.all_paragraphs(
+                docx.Document(template.open())))
+        for text in texts:
+            if isinstance(text, str):
+                keys.update(key for key, _ in replace.replace_pattern.findall(text))
+
+    return frozenset(numbered_keys.get(key, key) for key in keys)
+
+
+def template_keys(path: str) -> Optional[FrozenSet[str]]:
+    """
+    テンプレートが参照する項目名。テンプレートは一度だけ読み込み、更新されるまで結果を使い回す。
+
+    出力処理で拡張子の前に文字を足したテンプレート(Chacot、別など)を選ぶことがあるので、
+    それらの派生のテンプレートの項目名も含める。テンプレートが見つからない場合はNone
+    """
+    stem, ext = os.path.splitext(path)
+    paths = [p for p in {path, *glob.glob(glob.escape(stem) + '*' + ext)} if os.path.exists(p)]
+    if not paths:
+        return None
+
+    keys: Set[str] = set()
+    for p in paths:
+        stat = os.stat(p)
+        keys.update(_template_keys(os.path.abspath(p), stat.st_size, stat.st_mtime_ns))
+    return frozenset(keys)
+
+
+@dataclass(frozen=True)
+class ColumnValues:
+    """
+    入力シートの列から計算される、帳票の置換に使う値
+    """
+    product_kv: Mapping[str, Any]  # 入力シートの値
+    jikkin_kv: Mapping[str, Any]  # 実金シートの入力シートの値
+    table_kv: Mapping[str, Any]  # 実金シートの表の値
+    table: Mapping[Any, Any]  # 実金シートの返済予定表のセルの値
+
+
+def column_values(generator: ChohyoGenerator, product_input: ProductInput) -> Optional[ColumnValues]:
+    """
+    実金シートをPythonで計算し、列の値を求める。計算できない場合はNone
+    """
+    try:
+        template_path, _ = generator.jikkin_path(product_input)
+        wb = jikkin_sheet.fill_jikkin_workbook(product_input, template_path)
+        t = jikkin_sheet.jikkin_type(product_input.name)
+        calculated = schedule.calculate(wb, t)
+        return ColumnValues(
+            dict(product_input.product_kv),
+            schedule.input_kv(wb),
+            jikkin_sheet.table_kv_of(t, calculated),
+            calculated.values)
+    except Exception as e:
+        logger.debug(f'{product_input.name}の実金シートを計算できません: {e}')
+        return None
+
+
+def changed_keys(old: Mapping[str, Any], new: Mapping[str, Any]) -> Set[str]:
+    """
+    値が異なる項目名
+    """
+    return {k for k in {*old.keys(), *new.keys()} if old.get(k) != new.get(k)}
+
+
+def column_changes(generator: ChohyoGenerator, old: ProductInput, new: ProductInput) -> Set[str]:
+    """
+    入力シートの列の変更によって値が変わる項目名。実金シートの計算結果が変わる場合は、
+    表の項目名と`jikkin_key`も含める
+    """
+    changes = changed_keys(old.product_kv, new.product_kv)
+    if not changes:
+        return changes
+
+    old_values = column_values(generator, old)
+    new_values = column_values(generator, new)
+    if old_values is None or new_values is None:
+        # 計算できない場合は、実金シートの値はすべて変わったものとする
+        return changes | {jikkin_key} | set().union(
+            *(values.table_kv.keys() for values in (old_values, new_values) if values is not None))
+
+    changes |= changed_keys(old_values.jikkin_kv, new_values.jikkin_kv)
+    changes |= changed_keys(old_values.table_kv, new_values.table_kv)
+    if old_values.table != new_values.table:
+        changes.add(jikkin_key)
+    return changes
+
+
+def affected_outputs(generator: ChohyoGenerator,
+                     old_inputs: List[ProductInput],
+                     new_inputs: List[ProductInput]) -> Optional[List[OutputTarget]]:
+    """
+    入力シートがold_inputsからnew_inputsに変わったときに、出力し直す必要がある帳票。
+    商品の数や並びが変わった場合はNone(すべて出力し直す)
+    """
+    if [p.name for p in old_inputs] != [p.name for p in new_inputs]:
+        return None
+
+    changes = [column_changes(generator, old, new)
+               for old, new in zip(old_inputs, new_inputs)]
+    old_guarantors = old_inputs[0].joint_guarantors
+    new_guarantors = new_inputs[0].joint_guarantors
+
+    def referenced(index: Optional[int], form_no: int) -> Optional[FrozenSet[str]]:
+        src, _ = generator.path_info(new_inputs[0 if index is None else index], form_no)
+        keys = template_keys(src)
+        return None if keys is None else keys | code_keys.get(form_no, frozenset())
+
+    targets: List[OutputTarget] = []
+    for job, indices in generator._render_jobs(new_inputs):
+        job_changes = set().union(*(changes[i] for i in indices))
+        for index, form_no in job_outputs(job):
+            keys = referenced(index, form_no)
+            touched = keys is None or bool(job_changes & (keys | layout_keys))
+
+            if form_no not in guarantor_override_keys:
+                if touched:
+                    targets.append(OutputTarget(index, form_no))
+                continue
+
+            # 連帯保証人ごとの帳票は、上書きする項目を除いた変更と、その連帯保証人の変更を見る
+            shared = keys is None or bool(
+                (job_changes - guarantor_override_keys[form_no] - guarantor_keys) & (keys | layout_keys))
+            for g, guarantor in enumerate(new_guarantors):
+                if shared or g >= len(old_guarantors) or old_guarantors[g] != guarantor:
+                    targets.append(OutputTarget(index, form_no, g))
+            if form_no == 3 and new_inputs[0].is_personal and touched:
+                targets.append(OutputTarget(index, form_no))
+
+    return targets
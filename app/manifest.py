@@ -0,0 +1,296 @@
+"""
+出力した帳票ごとに、出力に使った入力のハッシュを記録するマニフェストのモジュール。
+
+同じ入力から出力済みの帳票は、出力とPDFへの変換を省略する
+"""
+
+from app import replace
+from app.config import file_sha256
+from collections import ChainMap
+from docx.document import Document as DocxDocument
+from logging import getLogger
+from openpyxl.workbook.workbook import Workbook
+from typing import Any, Callable, Dict, Mapping, Optional
+import functools
+import glob
+import hashlib
+import io
+import json
+import os
+import threading
+import zipfile
+
+logger = getLogger(__name__)
+
+# 出力先のフォルダに置くマニフェストのファイル名
+manifest_file_name = '.manifest.json'
+
+# マニフェストの形式を変えた場合はこの値を変更すること
+manifest_version = 1
+
+# 保存するたびに書き換わり、内容の比較には使えないパート
+volatile_parts = {'docProps/core.xml'}
+
+
+@functools.lru_cache(maxsize=None)
+def generator_version() -> str:
+    """
+    帳票を生成するソースコードのハッシュ。コードを変更した場合はすべての帳票を出力し直す
+    """
+    h = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(__file__), '*.py'))):
+        h.update(os.path.basename(path).encode('utf-8'))
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+@functools.lru_cache(maxsize=256)
+def _template_sha256(path: str, size: int, mtime_ns: int) -> str:
+    return file_sha256(path)
+
+
+def template_sha256(path: str) -> str:
+    """
+    テンプレートファイルの中身のハッシュ。サイズと更新日時が同じ間は計算し直さない
+    """
+    stat = os.stat(path)
+    return _template_sha256(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def package_sha256(data: bytes) -> str:
+    """
+    docx, xlsxの中身のハッシュ。保存した日時などで変わらないように、zipのパートごとに計算する
+    """
+    h = hashlib.sha256()
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        for name in sorted(z.namelist()):
+            if name in volatile_parts:
+                continue
+            h.update(name.encode('utf-8'))
+            h.update(z.read(name))
+    return h.hexdigest()
+
+
+def resolved_keywords(replace_dict: Mapping[str, Any]) -> Dict[str, Any]:
+    """
+    置換に使うキーワードを、優先される値だけの辞書にする
+    """
+    if not isinstance(replace_dict, ChainMap):
+        # ProductInputはキーで反復できないので、元の辞書を使う
+        return dict(getattr(replace_dict, 'product_kv', replace_dict))
+
+    resolved: Dict[str, Any] = {}
+    for layer in reversed(replace_dict.maps):
+        resolved.update(resolved_keywords(layer))
+    return resolved
+
+
+def digest(template_sha256: str, replace_dict: Mapping[str, Any]) -> str:
+    """
+    出力に使うテンプレート、キーワード、生成器のバージョンをまとめたハッシュ
+    """
+    keywords = json.dumps(
+        sorted(resolved_keywords(replace_dict).items()),
+        ensure_ascii=False, default=repr)
+    h = hashlib.sha256()
+    for part in (generator_version(), template_sha256, keywords):
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class Manifest:
+    """
+    出力先のフォルダからの相対パスごとに、出力に使った入力のハッシュを持つ。
+
+    今回の出力はupdatesに記録し、`save`で前回までの記録と合わせて保存する。
+    出力を始めた帳票はいったんNoneにしておき、出力の途中で失敗したものを
+    出力済みとみなさないようにする。Excelでの上書き保存などを待つ帳票は、`confirm`するまで
+    pendingに置いておく
+    """
+
+    def __init__(self, root: str, entries: Optional[Dict[str, str]] = None):
+        self.root = root
+        self.entries = dict(entries or {})
+        self.updates: Dict[str, Optional[str]] = {}
+        self.pending: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        # プロセスプールのワーカーには前回までの記録だけを渡す
+        return (Manifest, (self.root, self.entries))
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.root, manifest_file_name)
+
+    @classmethod
+    def load(cls, root: str) -> 'Manifest':
+        """
+        出力先のフォルダのマニフェストを読み込む。読み込めない場合は空のマニフェストにする
+        """
+        manifest = cls(root)
+        try:
+            with open(manifest.path, encoding='utf-8') as f:
+                content = json.load(f)
+        except FileNotFoundError:
+            return manifest
+        except (OSError, ValueError) as e:
+            logger.warning(f'マニフェスト{manifest.path}を読み込めませんでした: {e}')
+            return manifest
+
+        if content.get('version') == manifest_version:
+            manifest.entries = dict(content.get('entries', {}))
+        return manifest
+
+    def save(self):
+        with self._lock:
+            entries = {**self.entries, **self.updates}
+        entries = {k: v for k, v in sorted(entries.items()) if v is not None}
+
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            # 書き込み途中のファイルを読まないように、一時ファイルに書いてから置き換える
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': manifest_version, 'entries': entries},
+                          f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f'マニフェスト{self.path}を保存できませんでした: {e}')
+
+    def _key(self, path: str) -> str:
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.root)).replace(os.sep, '/')
+
+    def up_to_date(self, digest: str, *paths: str) -> bool:
+        """
+        pathsのすべてが、digestと同じ入力から出力済みで、ファイルが残っているかどうか
+        """
+        with self._lock:
+            for path in paths:
+                key = self._key(path)
+                recorded = self.updates[key] if key in self.updates else self.entries.get(key)
+                if recorded != digest or not os.path.exists(path):
+                    return False
+        return True
+
+    def begin(self, *paths: str):
+        """
+        pathsの出力を始める。前回の出力は削除し、今回出力できなかったファイルが残らないようにする
+        """
+        with self._lock:
+            for path in paths:
+                self.updates[self._key(path)] = None
+                self.pending.pop(self._key(path), None)
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def record(self, digest: str, *paths: str):
+        with self._lock:
+            for path in paths:
+                self.updates[self._key(path)] = digest
+
+    def defer(self, digest: str, *paths: str):
+        """
+        pathsを出力したが、`confirm`するまでは出力済みとして記録しない
+        """
+        with self._lock:
+            for path in paths:
+                self.pending[self._key(path)] = digest
+
+    def confirm(self, *paths: str):
+        with self._lock:
+            for path in paths:
+                digest = self.pending.pop(self._key(path), None)
+                if digest is not None:
+                    self.updates[self._key(path)] = digest
+
+    def take_updates(self) -> Dict[str, Optional[str]]:
+        """
+        今回の出力の記録を取り出す。ワーカーの記録を親プロセスに返すのに使う
+        """
+        with self._lock:
+            updates, self.updates = self.updates, {}
+        return updates
+
+    def merge(self, updates: Mapping[str, Optional[str]]):
+        with self._lock:
+            self.updates.update(updates)
+
+
+# 出力に使うマニフェスト。Noneの場合は常に出力する
+_active: Optional[Manifest] = None
+
+
+def activate(manifest: Optional[Manifest]):
+    global _active
+    _active = manifest
+
+
+def active() -> Optional[Manifest]:
+    return _active
+
+
+def output_document(source: replace.Source,
+                    output_path: str,
+                    replace_dict: Mapping[str, Any],
+                    to_pdf: Optional[Callable[[str, str], None]] = None,
+                    deferred: bool = False) -> bool:
+    """
+    sourceのキーワードを置換してoutput_pathに出力し、to_pdfを指定した場合はPDFにも変換する。
+
+    マニフェストが有効で、前回と同じ入力から出力したファイルが残っている場合は何もしない。
+    deferredがTrueの場合は、出力したファイルを`confirm`するまで出力済みとして記録しない。
+    戻り値は出力したかどうか
+    """
+    manifest = _active
+    outputs = [output_path]
+    if to_pdf is not None:
+        outputs.append(os.path.splitext(output_path)[0] + '.pdf')
+
+    if manifest is None:
+        replace.replace(source, output_path, replace_dict)
+        if to_pdf is not None:
+            to_pdf(*outputs)
+        return True
+
+    if isinstance(source, (DocxDocument, Workbook)):
+        # 置換でも保存するので、ここで一度だけ保存してハッシュと置換の両方に使う
+        buffer = io.BytesIO()
+        source.save(buffer)
+        source = buffer
+
+    if isinstance(source, str):
+        source_sha256 = template_sha256(source)
+    else:
+        source.seek(0)
+        source_sha256 = package_sha256(source.read())
+        source.seek(0)
+
+    output_digest = digest(source_sha256, replace_dict)
+    if manifest.up_to_date(output_digest, *outputs):
+        logger.info(f'  変更なし    {output_path}')
+        return False
+
+    manifest.begin(*outputs)
+    replace.replace(source, output_path, replace_dict)
+    if to_pdf is not None:
+        to_pdf(*outputs)
+    written = [path for path in outputs if os.path.exists(path)]
+    if deferred:
+        manifest.defer(output_digest, *written)
+    else:
+        manifest.record(output_digest, *written)
+    return True
+
+
+def confirm(*paths: str):
+    """
+    `output_document`にdeferredを指定して出力したファイルを、出力済みとして記録する
+    """
+    if _active is not None:
+        _active.confirm(*paths)
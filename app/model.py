@@ -1,3 +1,4 @@
+from app.schedule import Schedule
 from dataclasses import dataclass
 from datetime import datetime
 from logging import getLogger
@@ -129,6 +130,7 @@ class Product:
     jikkin_kv: JikkinKV
     table_kv: TableKV
     jikkin_path: str
+    schedule: Optional[Schedule] = None  # Pythonで計算した場合の実金シート
 
     @property
     def name(self) -> str:
@@ -0,0 +1,130 @@
+"""
+帳票出力の処理を、依存関係を持つジョブのDAGとして組み立てて実行するモジュール
+"""
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+import graphlib
+import time
+
+logger = getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Task:
+    """
+    DAGのノード。funcには依存するジョブの結果がdepsの順に引数として渡される
+    """
+    name: str
+    func: Callable[..., Any]
+    deps: Tuple[str, ...] = ()
+
+
+@dataclass(frozen=True)
+class TaskResult:
+    """
+    ジョブの実行結果。時刻は`time.perf_counter`の値
+    """
+    name: str
+    value: Any
+    started: float
+    finished: float
+
+    @property
+    def elapsed(self) -> float:
+        return self.finished - self.started
+
+
+class Pipeline:
+    """
+    ジョブとその入力となるジョブを登録し、依存が解決したものから実行する。
+
+    依存先は登録済みのジョブに限るので、登録した順が常に実行可能な順になり、循環は起こらない
+    """
+
+    def __init__(self):
+        self.tasks: Dict[str, Task] = {}
+
+    def add(self, name: str, func: Callable[..., Any], deps: Iterable[str] = ()) -> str:
+        """
+        ジョブを登録し、その名前を返す
+        """
+        deps = tuple(deps)
+        if name in self.tasks:
+            raise RuntimeError(f'ジョブ{name!r}はすでに登録されています')
+        for dep in deps:
+            if dep not in self.tasks:
+                raise RuntimeError(f'ジョブ{name!r}の依存先{dep!r}が登録されていません')
+        self.tasks[name] = Task(name, func, deps)
+        return name
+
+    def run(self, workers: int = 1) -> Iterator[TaskResult]:
+        """
+        ジョブを実行し、終わったものから順に結果を返す。
+
+        workersが1の場合は登録した順に一つずつ実行する。2以上の場合はスレッドプールで
+        依存が解決したジョブを並列に実行する。いずれかのジョブが失敗した場合は、
+        実行中のジョブの終了を待ってから例外を送出し、以降のジョブは実行しない
+        """
+        values: Dict[str, Any] = {}
+
+        def call(task: Task) -> TaskResult:
+            started = time.perf_counter()
+            value = task.func(*(values[dep] for dep in task.deps))
+            return TaskResult(task.name, value, started, time.perf_counter())
+
+        if workers <= 1:
+            for task in self.tasks.values():
+                result = call(task)
+                values[task.name] = result.value
+                yield result
+            return
+
+        sorter = graphlib.TopologicalSorter(
+            {name: task.deps for name, task in self.tasks.items()})
+        sorter.prepare()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            running: Dict[Future, str] = {}
+            try:
+                while sorter.is_active():
+                    for name in sorter.get_ready():
+                        running[executor.submit(call, self.tasks[name])] = name
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name = running.pop(future)
+                        result = future.result()
+                        values[name] = result.value
+                        sorter.done(name)
+                        yield result
+            finally:
+                for future in running:
+                    future.cancel()
+
+    def critical_path(self, results: Dict[str, TaskResult]) -> List[TaskResult]:
+        """
+        実行時間の合計が最も長くなる依存の連なりを、最初のジョブから順に返す。
+        この連なりが短くならない限り、並列数を増やしても全体の時間は短くならない
+        """
+        # (そのジョブで終わる連なりの時間の合計, 直前のジョブ)
+        longest: Dict[str, Tuple[float, str]] = {}
+        for name, task in self.tasks.items():
+            if name not in results:
+                continue
+            prev = max((dep for dep in task.deps if dep in longest),
+                       key=lambda dep: longest[dep][0], default='')
+            longest[name] = (
+                results[name].elapsed + (longest[prev][0] if prev else 0), prev)
+
+        if not longest:
+            return []
+
+        path = []
+        name = max(longest, key=lambda name: longest[name][0])
+        while name:
+            path.append(results[name])
+            name = longest[name][1]
+        return path[::-1]
@@ -2,12 +2,18 @@
 キーワード置換をするための知識をもたせたモジュール
 """
 
-from app import docx_helper, time_helper, xl_helper
+from app import docx_helper, template_cache, time_helper, xl_helper
 from dataclasses import dataclass
+from docx.document import Document as DocxDocument
+from docx.text.paragraph import Paragraph
 from logging import getLogger
+from openpyxl.workbook.workbook import Workbook
 from openpyxl.worksheet.worksheet import Worksheet
-from typing import Any, Mapping, cast
+from typing import IO, Any, Callable, Mapping, Optional, Union, cast
+import bisect
 import docx
+import functools
+import io
 import itertools
 import mojimoji
 import openpyxl
@@ -35,62 +41,212 @@ class TemplateReplaceInfo:
     keywords: Mapping[str, Any]  # 置換キーワード
 
 
+def format_value(value: Any, format_str: Optional[str]) -> str:
+    """
+    置換する値に"○フォーマット"の指定を適用して文字列にする。
+    日付は`strftime`の書式、数値は`str.format`の書式として解釈する
+    """
+    if value is None:
+        return ''
+    if isinstance(value, (datetime.date, datetime.time)):
+        return time_helper.strftime(
+            value,
+            _han_format(format_str)
+            if format_str is not None else "%Y年%-m月%-d日").upper()
+    elif isinstance(value, (int, float)):
+        return (f"{{:{_han_format(format_str)}}}"
+                if format_str is not None else '{:,}').format(value)
+    return value if isinstance(value, str) else str(value)
+
+
+@functools.lru_cache(maxsize=None)
+def _han_format(format_str: str) -> str:
+    # テンプレートの書式は全角で書かれていることがあるので半角にする
+    return mojimoji.zen_to_han(format_str)
+
+
+def resolve_keyword(key: str, format_str: Optional[str], replace_dict: Mapping[str, Any], logging_input_file_path: str) -> str:
+    """
+    "●項目名○フォーマット●"ひとつ分の置換後の文字列を返す
+    """
+    value = replace_dict.get(key)
+
+    if value is None:
+        logger.debug(f'{logging_input_file_path}に含まれる、{key!r}は置換できません')
+
+    return format_value(value, format_str)
+
+
+def substitute(input_string: str, resolve: Callable[[str, Optional[str]], str]) -> str:
+    """
+    input_stringを一度だけ走査し、含まれているキーワードをresolve(項目名, フォーマット)の
+    戻り値で置き換える。キーワードが含まれていない場合はinput_stringをそのまま返す
+    """
+    out = []
+    last = 0
+    for matched in replace_pattern.finditer(input_string):
+        out.append(input_string[last:matched.start()])
+        out.append(resolve(*matched.groups()))
+        last = matched.end()
+
+    if not out:
+        return input_string
+
+    out.append(input_string[last:])
+    return ''.join(out)
+
+
 def replace_template_string(input_string: str, replace_dict: Mapping[str, Any], logging_input_file_path: str):
     """
     strに含まれているテンプレート文字列"●項目名○フォーマット●"のようなものを置換する。
+    置換が発生しなかった場合は引数の文字列をそのまま返す
+    """
+    if keyword_quoter not in input_string:
+        return input_string
+
+    return substitute(
+        input_string,
+        lambda key, format_str: resolve_keyword(
+            key, format_str, replace_dict, logging_input_file_path))
+
+
+def keyword_string(key: str, format_str: Optional[str] = None) -> str:
+    """
+    項目名とフォーマットからテンプレート文字列"●項目名○フォーマット●"を組み立てる
     """
-    output_string = input_string
+    if format_str is None:
+        return f'{keyword_quoter}{key}{keyword_quoter}'
+    return f'{keyword_quoter}{key}{format_separator}{format_str}{keyword_quoter}'
 
-    matched = replace_pattern.search(input_string)
-    if matched is None:
-        return output_string
-    
-    # プログラムの意味的にはwhileによるループでよいが、無限に回ってしまうのは問題があるので
-    # for文で数えながら置換を行い、20回以上置換が発生する場合はエラーを投げて終了する
-    for c in itertools.count():
 
-        matched = replace_pattern.search(output_string)
-        if matched is None:
-            break
+def substitute_paragraph(paragraph: Paragraph, resolve: Callable[[str, Optional[str]], str]) -> bool:
+    """
+    段落に含まれているキーワードを、複数のrunに分割されていても置換する。
 
-        if c >= 20:
-            logger.debug(output_string)
-            logger.debug(f'{matched}')
-            logger.debug(f'{replace_pattern.search(output_string)}')
-            raise RuntimeError('テキストの置換に失敗しました。')
+    runのテキストを連結して一度だけ走査し、キーワードにかかるrunだけを書き換える。
+    置換後の文字列はキーワードが始まるrunに入れるので、そのrunの書式が使われる。
+    戻り値は段落を書き換えたかどうか
+    """
+    runs = paragraph.runs
+    texts = [run.text for run in runs]
+    joined = ''.join(texts)
+    if keyword_quoter not in joined:
+        return False
 
-        key, format_str = matched.groups()
-        value = replace_dict.get(key)
+    matches = list(replace_pattern.finditer(joined))
+    if not matches:
+        return False
 
-        if value is None:
-            logger.debug(f'{logging_input_file_path}に含まれる、{key!r}は置換できません')
-            value = ''
-        # フォーマット適用
-        if isinstance(value, (datetime.date, datetime.time)):
-            value = time_helper.strftime(
-                value,
-                mojimoji.zen_to_han(format_str)
-                if format_str is not None else "%Y年%-m月%-d日").upper()
-        elif isinstance(value, (int, float)):
-            format_str = f"{{:{mojimoji.zen_to_han(format_str)}}}" \
-                if format_str is not None else '{:,}'
-            value = format_str.format(value)
+    starts = list(itertools.accumulate((len(t) for t in texts[:-1]), initial=0))
+    new_texts = list(texts)
 
-        output_string = replace_pattern.sub(value, output_string, 1)
+    # 後ろから置換すると、手前のrunの位置がずれない
+    for matched in reversed(matches):
+        first = bisect.bisect_right(starts, matched.start()) - 1
+        last = bisect.bisect_right(starts, matched.end() - 1) - 1
+        value = resolve(*matched.groups())
 
-    return output_string
+        head = new_texts[first][:matched.start() - starts[first]]
+        tail = new_texts[last][matched.end() - starts[last]:]
+        if first == last:
+            new_texts[first] = head + value + tail
+        else:
+            new_texts[first] = head + value
+            for idx in range(first + 1, last):
+                new_texts[idx] = ''
+            new_texts[last] = tail
 
+    for run, text, new_text in zip(runs, texts, new_texts):
+        # 画像などを含むrunを壊さないように、変更があったrunだけ書き換える
+        if text != new_text:
+            run.text = new_text
 
-def replace(input_file_path: str, output_file_path: str, replace_dict: Mapping[str, Any]):
+    return True
+
+
+def replace_paragraph(paragraph: Paragraph, replace_dict: Mapping[str, Any], logging_input_file_path: str) -> bool:
+    """
+    段落に含まれている"●項目名○フォーマット●"をreplace_dictの値で置換する
     """
-    replace_dictをもとにinput_file_pathのドキュメントに含まれるキーワードを置換し、output_file_pathに出力する
+    return substitute_paragraph(
+        paragraph,
+        lambda key, format_str: resolve_keyword(
+            key, format_str, replace_dict, logging_input_file_path))
+
+
+# ファイルパスを持たない入力をログに出すときの名前
+in_memory_name = '<memory>'
+
+# 置換の入力として受け付けるもの。ファイルパス、ファイルオブジェクト、読み込み済みのドキュメント
+Source = Union[str, IO[bytes], DocxDocument, Workbook]
+
+
+def replace(input_file: Source, output_file: Union[str, IO[bytes], None], replace_dict: Mapping[str, Any]):
+    """
+    replace_dictをもとにinput_fileのドキュメントに含まれるキーワードを置換し、output_fileに出力する
     対応フォーマットはxlsxおよびdocx
+
+    input_fileにはファイルパスのほか、BytesIOやpython-docxのDocument、openpyxlのWorkbookを
+    渡すことができる。生成した帳票を一度保存してから読み込み直さずに済むようにするためである。
+
+    output_fileを指定した場合は出力だけを行う。Document、Workbookを渡した場合も
+    シリアライズは一度だけで、置換はシリアライズ後のXMLに対して行う。
+    output_fileがNoneの場合は、Document、Workbookはその場で置換して返し、それ以外は
+    置換後のファイルの中身をBytesIOで返す
     """
 
-    if re.search(r'.xlsx$', input_file_path):
-        return replace_excel(input_file_path, output_file_path, replace_dict)
+    if isinstance(input_file, (DocxDocument, Workbook)):
+        if output_file is None:
+            if isinstance(input_file, Workbook):
+                replace_workbook(input_file, replace_dict, in_memory_name)
+            else:
+                replace_document(input_file, replace_dict, in_memory_name)
+            return input_file
+
+        buffer = io.BytesIO()
+        input_file.save(buffer)
+        buffer.seek(0)
+        input_file = buffer
+
+    if isinstance(input_file, str):
+        template = template_cache.get(input_file)
     else:
-        return replace_word(input_file_path, output_file_path, replace_dict)
+        template = template_cache.compile_template(
+            getattr(input_file, 'name', in_memory_name), input_file.read())
+
+    if output_file is None:
+        output = io.BytesIO()
+        render(template, output, replace_dict)
+        output.seek(0)
+        return output
+
+    render(template, output_file, replace_dict)
+
+
+def render(template: 'template_cache.CompiledTemplate', output_file: Union[str, IO[bytes]], replace_dict: Mapping[str, Any]):
+    """
+    コンパイル済みのテンプレートのキーワードを置換して出力する
+
+    キーワードはdocxであれば本文・ヘッダー・フッターのXML、xlsxであれば共有文字列と
+    ヘッダー・フッターのXMLを直接書き換えて置換する。
+    コンパイル時にまとめられなかったキーワードがある場合は、python-docxまたは
+    openpyxlで開いて置換する
+    """
+    if isinstance(output_file, str):
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+    if not template.fragmented:
+        template.render(replace_dict, output_file)
+        return
+
+    if template.ext == '.xlsx':
+        wb = openpyxl.load_workbook(template.open())
+        replace_workbook(wb, replace_dict, template.path)
+        wb.save(output_file)
+    else:
+        doc = docx.Document(docx=template.open())
+        replace_document(doc, replace_dict, template.path)
+        doc.save(output_file)
 
 
 def replace_word(input_file_path: str, output_file_path: str, replace_dict: Mapping[str, Any]):
@@ -98,14 +254,7 @@ def replace_word(input_file_path: str, output_file_path: str, replace_dict: Mapp
     wordの置換を行う関数
     特に理由がなければこちらの関数を直接呼び出さず、`replace`を使うべき
     """
-    doc = docx.Document(docx=input_file_path)
-    for run in docx_helper.all_runs(doc):
-        if isinstance(run.text, str):
-            replaced_str = replace_template_string(
-                run.text, replace_dict, input_file_path)
-            if run.text is not replaced_str:
-                run.text = replaced_str
-    doc.save(output_file_path)
+    render(template_cache.get(input_file_path), output_file_path, replace_dict)
 
 
 def replace_excel(input_file_path: str, output_file_path: str, replace_dict: Mapping[str, Any]):
@@ -113,9 +262,21 @@ def replace_excel(input_file_path: str, output_file_path: str, replace_dict: Map
     excelの置換を行う関数
     特に理由がなければこちらの関数を直接呼び出さず、`replace`を使うべき
     """
+    render(template_cache.get(input_file_path), output_file_path, replace_dict)
 
-    wb = openpyxl.load_workbook(input_file_path)
 
+def replace_document(doc: DocxDocument, replace_dict: Mapping[str, Any], logging_input_file_path: str):
+    """
+    python-docxのDocumentに含まれるキーワードを段落ごとにその場で置換する
+    """
+    for paragraph in docx_helper.all_paragraphs(doc):
+        replace_paragraph(paragraph, replace_dict, logging_input_file_path)
+
+
+def replace_workbook(wb: Workbook, replace_dict: Mapping[str, Any], logging_input_file_path: str):
+    """
+    openpyxlのWorkbookに含まれるキーワードをセルごとにその場で置換する
+    """
     for ws in wb:
         ws = cast(Worksheet, ws)
 
@@ -124,7 +285,7 @@ def replace_excel(input_file_path: str, output_file_path: str, replace_dict: Map
             if not isinstance(headerPart.text, str):
                 continue
             replace_txt = replace_template_string(
-                headerPart.text, replace_dict, input_file_path)
+                headerPart.text, replace_dict, logging_input_file_path)
             if headerPart.text is not replace_txt:
                 headerPart.text = replace_txt
 
@@ -134,9 +295,6 @@ def replace_excel(input_file_path: str, output_file_path: str, replace_dict: Map
             for cell in row:
                 if (isinstance(cell.value, str)):
                     replaced_str = replace_template_string(
-                        cell.value, replace_dict, input_file_path)
+                        cell.value, replace_dict, logging_input_file_path)
                     if cell.value is not replaced_str:
                         cell.value = replaced_str
-
-    os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
-    wb.save(output_file_path)
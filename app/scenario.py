@@ -0,0 +1,209 @@
+"""
+一つの商品について、約定利率・弁済回数・貸付元本額・金消契約日を変えた場合の返済予定表を
+まとめて計算し、利息の総額や最終回の弁済額などを表にするモジュール。
+
+実金シートのテンプレートは一度だけ読み込み、条件ごとの計算は`schedule.calculate_columns`で
+入力シートの値から行う。条件ごとにワークブックを作ったり保存したりはしない
+"""
+
+from app import jikkin_sheet, schedule
+from app.chohyo_gen import ChohyoGenerator
+from app.model import ProductInput
+from datetime import datetime
+from logging import getLogger
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, TextIO, cast
+import csv
+import itertools
+import math
+
+logger = getLogger(__name__)
+
+# 変えることができる項目。貸付元本額は借入希望金額(＄)で指定する
+axes = ('約定利率', '弁済回数', '貸付元本額', '金消契約日')
+
+# 結果の表の列(条件の項目のあとに並べる)
+metric_keys = (
+    '貸付元本額（￥）',
+    '融資手数料（税込）',
+    '利息の総額',
+    '将来支払う返済金額の合計額',
+    '実質利率（年率）',
+    '各回利息',
+    '最終回（元利金）',
+    '最終回元金',
+    '最終弁済時ＬＴＶ',
+)
+
+# 実金シートの種類ごとの見出しのセル (TTSレート, 融資手数料, 実行日に支払う手数料等)
+_header_cells = {
+    'A': ('B6', 'B15', 'C21'),
+    'D': ('B6', 'B15', 'C21'),
+    'B': ('B7', 'B16', 'D22'),
+    'C': ('B7', 'B16', 'D22'),
+    'E': ('B7', 'B16', 'D22'),
+}
+
+
+def _parse_date(s: str) -> datetime:
+    return datetime.strptime(s.strip(), '%Y-%m-%d')
+
+
+_parsers: Dict[str, Callable[[str], Any]] = {
+    '約定利率': float,
+    '弁済回数': int,
+    '貸付元本額': float,
+    '金消契約日': _parse_date,
+}
+
+
+def parse_axis(arg: str) -> Sequence[Any]:
+    """
+    コマンドラインの"項目=値"を、項目の値のリストにする。
+
+    値はカンマ区切りで並べるか、"開始:終了:刻み"で範囲を指定する(終了を含む)。
+    金消契約日はYYYY-MM-DDで指定し、範囲の刻みは月数にする
+
+        約定利率=0.030:0.035:0.001
+        弁済回数=120,60
+        金消契約日=2021-05-01:2021-10-01:1
+    """
+    key, _, values = arg.partition('=')
+    key = key.strip()
+    if key not in _parsers:
+        raise ValueError(f'{key}は変えることができません。{"、".join(axes)}のいずれかを指定してください')
+    parse = _parsers[key]
+
+    if values.count(':') == 2:
+        start_s, stop_s, step_s = values.split(':')
+        start, stop = parse(start_s), parse(stop_s)
+        if key == '金消契約日':
+            step = int(step_s)
+            if step <= 0:
+                raise ValueError(f'{key}の刻みには1以上の月数を指定してください')
+            return list(itertools.takewhile(
+                lambda d: d <= stop, (schedule.edate(start, i * step) for i in itertools.count())))
+        step = parse(step_s)
+        if step <= 0:
+            raise ValueError(f'{key}の刻みには正の値を指定してください')
+        # 刻みを足していくと誤差が溜まるので、何番目の値かから計算する
+        count = math.floor((stop - start) / step + 1e-9) + 1
+        return [round(start + i * step, 10) for i in range(max(count, 0))]
+
+    return [parse(v) for v in values.split(',') if v.strip()]
+
+
+def grid_variants(grid: Mapping[str, Sequence[Any]]) -> List[Dict[str, Any]]:
+    """
+    項目ごとの値のリストから、すべての組み合わせの条件を作る
+    """
+    keys = [key for key in axes if key in grid]
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def apply_variant(kv: Mapping[str, Any], variant: Mapping[str, Any]) -> Dict[str, Any]:
+    """
+    実金シートの入力シートの値(`schedule.input_kv`の形)を、条件に合わせて変えた値
+    """
+    kv = dict(kv)
+    if '約定利率' in variant:
+        kv['約定利率'] = variant['約定利率']
+    if '弁済回数' in variant:
+        kv['弁済回数'] = variant['弁済回数']
+    if '貸付元本額' in variant:
+        # 実金シートの融資比率は 借入希望金額 / 物件価格 で求めている
+        kv['ＵＳＤ借入希望金額'] = variant['貸付元本額']
+        kv['融資比率'] = variant['貸付元本額'] / kv['物件価格']
+    if '金消契約日' in variant:
+        # 借入日は金消契約日との間隔を保ち、初回元金弁済日は借入日と同じ月数だけずらす
+        contract_date = variant['金消契約日']
+        old_borrowing_date = kv['借入日']
+        kv['借入日'] = old_borrowing_date + (contract_date - kv['金消契約日'])
+        kv['金消契約日'] = contract_date
+        if isinstance(kv.get('初回元金弁済日'), datetime):
+            months = (kv['借入日'].year - old_borrowing_date.year) * 12 \
+                + kv['借入日'].month - old_borrowing_date.month
+            kv['初回元金弁済日'] = schedule.edate(kv['初回元金弁済日'], months)
+    return kv
+
+
+def metrics(calculated: schedule.Schedule, kv: Mapping[str, Any]) -> Dict[str, Any]:
+    """
+    見出しのセルと返済予定表の列から求める、条件ごとの結果
+    """
+    c = cast(schedule.ScheduleColumns, calculated.columns)
+    tts_cell, fee_cell, upfront_cell = _header_cells[calculated.jikkin_type]
+
+    interest = int(c.interest.sum())
+    accrual = int(c.accrual.sum())
+    final_principal = int(c.principal[-1])
+    property_value = kv['物件価格'] * calculated.value(tts_cell)
+    return {
+        '貸付元本額（￥）': int(c.balance[0]),
+        '融資手数料（税込）': calculated.value(fee_cell),
+        '利息の総額': interest,
+        '将来支払う返済金額の合計額': interest + int(c.principal.sum()),
+        '実質利率（年率）': schedule.excel_rounddown(
+            (calculated.value(upfront_cell) + interest) / accrual, 5) if accrual else None,
+        '各回利息': int(c.interest[2]) if len(c.interest) > 2 else None,
+        '最終回（元利金）': int(c.interest[-1]) + final_principal,
+        '最終回元金': final_principal,
+        '最終弁済時ＬＴＶ': final_principal / property_value if property_value else None,
+    }
+
+
+def sweep(generator: ChohyoGenerator, product_input: ProductInput,
+          grid: Mapping[str, Sequence[Any]]) -> List[Dict[str, Any]]:
+    """
+    商品の入力値について、gridの値のすべての組み合わせの返済予定表を計算し、
+    条件と結果を1行とする表を返す。
+
+    gridは`axes`の項目名 -> 値のリスト。計算できない条件(弁済回数が0など)の行は、
+    結果の代わりに"エラー"の列に理由を入れる
+    """
+    template_path, _ = generator.jikkin_path(product_input)
+    wb = jikkin_sheet.fill_jikkin_workbook(product_input, template_path, write_table=False)
+    jikkin_type = jikkin_sheet.jikkin_type(product_input.name)
+    base_kv = schedule.input_kv(wb)
+    holidays = schedule.holidays_of(wb)
+
+    variants = grid_variants(grid)
+    logger.info(f'{product_input.name}の{len(variants)}通りの条件を計算します')
+
+    rows = [dict(variant) for variant in variants]
+    kvs = [apply_variant(base_kv, variant) for variant in variants]
+
+    # 計算できない条件があってもほかの条件は計算できるように、まとめて計算できなかった場合は一つずつ計算する
+    try:
+        results: List[Optional[schedule.Schedule]] = list(schedule.calculate_columns(
+            [(kv, holidays, jikkin_type) for kv in kvs]))
+    except Exception:
+        results = []
+        for row, kv in zip(rows, kvs):
+            try:
+                results.append(schedule.calculate_columns([(kv, holidays, jikkin_type)])[0])
+            except Exception as e:
+                row['エラー'] = str(e) or type(e).__name__
+                results.append(None)
+
+    for row, kv, calculated in zip(rows, kvs, results):
+        if calculated is not None:
+            row.update(metrics(calculated, kv))
+    return rows
+
+
+def write_csv(rows: Iterable[Mapping[str, Any]], stream: TextIO):
+    """
+    sweepの結果をCSVで書き出す
+    """
+    rows = list(rows)
+    keys = [key for key in axes if any(key in row for row in rows)]
+    keys += list(metric_keys)
+    if any('エラー' in row for row in rows):
+        keys.append('エラー')
+
+    writer = csv.DictWriter(stream, keys, extrasaction='ignore')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({
+            k: v.strftime('%Y-%m-%d') if isinstance(v, datetime) else v
+            for k, v in row.items()})
@@ -0,0 +1,718 @@
+"""
+実金シートの計算をExcelを使わずに行うモジュール
+
+テンプレートの実金シートにあらかじめ入っている数式と、`jikkin_sheet.process_*`が書き込む
+返済予定表の数式を、Pythonで同じ順序・同じ端数処理で計算する。
+Excelで開いて上書き保存しなくても、table_kvや返済予定表の各行の値を得ることができる。
+
+テンプレートの数式を変更した場合は、このモジュールの計算も合わせて変更すること。
+"""
+
+from dataclasses import dataclass, fields
+from datetime import date, datetime, timedelta
+from decimal import Decimal, ROUND_DOWN, ROUND_HALF_UP
+from openpyxl.utils.cell import column_index_from_string, coordinate_to_tuple, range_boundaries
+from openpyxl.workbook.workbook import Workbook
+from openpyxl.worksheet.worksheet import Worksheet
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Sequence, Tuple, cast
+import calendar
+import math
+import numpy as np
+
+
+class CellValue(NamedTuple):
+    """
+    計算結果のセル。openpyxlのCellと同じく`.value`と`.number_format`で読めるようにしてある
+    """
+    value: Any
+    number_format: str = 'General'
+
+
+@dataclass(frozen=True)
+class ScheduleColumns:
+    """
+    返済予定表の列。0番目が実行日の行、以降が各回の行。
+
+    `calculate_many`の計算中は商品×行の2次元配列で、`split`で商品ごとの1次元配列に分ける
+    """
+    number: np.ndarray  # 回
+    dates: np.ndarray  # 日付 (datetime64[us])
+    days: np.ndarray  # 前回からの日数。実行日の行は0
+    interest: np.ndarray  # 利息
+    principal: np.ndarray  # 元金弁済額
+    balance: np.ndarray  # 残元金
+    accrual: np.ndarray  # 前回の残元金の日割。実質年率の計算に使う
+    repayment: np.ndarray  # 約定弁済月の行は1 (実金シートB, C, EのL列。A, Dは0)
+    repayments: np.ndarray  # 約定弁済月の累計 (実金シートB, C, EのM列。A, Dは0)
+    paid: np.ndarray  # 元金を定額弁済する行 (実金シートB, C, EのC列が空でない行)
+
+    def split(self, rows: Sequence[int]) -> List['ScheduleColumns']:
+        return [ScheduleColumns(**{f.name: getattr(self, f.name)[i, :r] for f in fields(self)})
+                for i, r in enumerate(rows)]
+
+
+@dataclass(frozen=True)
+class Schedule:
+    """
+    計算済みの実金シート。
+
+    openpyxlのWorksheetの代わりに`table_kv`や大阪シートの出力に渡せるように、
+    `ws['A3:B15']`のような範囲指定と`iter_rows`に対応している
+    """
+    jikkin_type: str  # 実金シートの種類 (A〜E)
+    values: Mapping[Tuple[int, int], Any]  # (行, 列) -> 値
+    number_formats: Mapping[Tuple[int, int], str]  # (行, 列) -> 表示形式
+    last_month_row: int  # 最終回の行
+    sum_row: int  # 合計の行
+    columns: Optional[ScheduleColumns] = None  # Pythonで計算した場合の返済予定表の列
+
+    @property
+    def max_row(self) -> int:
+        return self.sum_row
+
+    def cell(self, row: int, column: int) -> CellValue:
+        return CellValue(self.values.get((row, column)),
+                         self.number_formats.get((row, column), 'General'))
+
+    def iter_rows(self, min_row: int, max_row: int, min_col: int, max_col: int) -> Iterator[Tuple[CellValue, ...]]:
+        for row in range(min_row, max_row + 1):
+            yield tuple(self.cell(row, col) for col in range(min_col, max_col + 1))
+
+    def __getitem__(self, range_string: str) -> Tuple[Tuple[CellValue, ...], ...]:
+        min_col, min_row, max_col, max_row = range_boundaries(range_string)
+        return tuple(self.iter_rows(min_row, max_row, min_col, max_col))
+
+    def __contains__(self, coordinate: str) -> bool:
+        return coordinate_to_tuple(coordinate) in self.values
+
+    def value(self, coordinate: str) -> Any:
+        return self.values.get(coordinate_to_tuple(coordinate))
+
+
+# VLOOKUPで値が見つからない場合のエラー値(formula.errorsと同じ表記)
+na_error = '#N/A'
+
+
+# ---- Excel関数 --------------------------------------------------------------
+
+
+def excel_int(x: float) -> int:
+    """INT: 小さい方の整数に切り捨てる"""
+    return math.floor(_significant(x))
+
+
+def _significant(x: float) -> float:
+    # Excelは有効桁数15桁で計算するので、799404.9999999998 は 799405 として扱われる
+    return float(f'{x:.15g}')
+
+
+def excel_round(x: float, digits: int = 0):
+    """ROUND: 0から遠い方に四捨五入する"""
+    return _quantize(x, digits, ROUND_HALF_UP)
+
+
+def excel_rounddown(x: float, digits: int = 0):
+    """ROUNDDOWN: 0に近い方に切り捨てる"""
+    return _quantize(x, digits, ROUND_DOWN)
+
+
+def _quantize(x: float, digits: int, rounding: str):
+    # 浮動小数点の誤差で 0.5 が 0.4999... にならないように、有効桁数15桁の10進数から丸める
+    q = Decimal(f'{x:.15g}').quantize(Decimal(1).scaleb(-digits), rounding=rounding)
+    return int(q) if digits <= 0 else float(q)
+
+
+def edate(d: datetime, months: int) -> datetime:
+    """EDATE: monthsか月後の同じ日。存在しない日は月末にする"""
+    month_index = d.year * 12 + d.month - 1 + months
+    year, month = divmod(month_index, 12)
+    day = min(d.day, calendar.monthrange(year, month + 1)[1])
+    return d.replace(year=year, month=month + 1, day=day)
+
+
+def excel_date(year: int, month: int, day: int) -> datetime:
+    """DATE: 月と日のはみ出しを繰り上げ・繰り下げする"""
+    year, month = divmod(year * 12 + month - 1, 12)
+    return datetime(year, month + 1, 1) + timedelta(days=day - 1)
+
+
+def datedif_days(start: datetime, end: datetime) -> int:
+    """DATEDIF(start, end, "d")"""
+    return (end - start).days
+
+
+def workday(start: datetime, days: int, holidays: Iterable[date]) -> datetime:
+    """WORKDAY: 土日と休日を除いてdays営業日後(負なら前)の日付"""
+    holiday_set = {h.date() if isinstance(h, datetime) else h for h in holidays}
+    step = 1 if days >= 0 else -1
+    d = start
+    remaining = abs(days)
+    while remaining > 0:
+        d += timedelta(days=step)
+        if d.weekday() < 5 and d.date() not in holiday_set:
+            remaining -= 1
+    return d
+
+
+def days_to_month_end(d: Optional[datetime]):
+    """DATE(YEAR(d),MONTH(d)+1,0)-d+1 : dから月末までの日数(dを含む)"""
+    if d is None or d == '':
+        return ''
+    return datedif_days(d, excel_date(d.year, d.month + 1, 0)) + 1
+
+
+def excel_text(v: Any) -> str:
+    """&で文字列に連結したときの表記"""
+    v = normalize_number(v)
+    return '' if v is None else str(v)
+
+
+def normalize_number(v: Any) -> Any:
+    """
+    Excelは整数値の数値を整数として保存するので、openpyxlで読み込んだときと同じ型にする
+    """
+    if isinstance(v, float) and v.is_integer():
+        return int(v)
+    return v
+
+
+def excel_int_array(x: np.ndarray) -> np.ndarray:
+    """配列の各要素にINTを行う"""
+    return _floor_array(x, np.floor, excel_int)
+
+
+def excel_rounddown_array(x: np.ndarray) -> np.ndarray:
+    """配列の各要素にROUNDDOWN(x, 0)を行う"""
+    return _floor_array(x, np.trunc, excel_rounddown)
+
+
+def _floor_array(x: np.ndarray, floor: Callable[[np.ndarray], np.ndarray], scalar: Callable[[float], int]) -> np.ndarray:
+    result = floor(x)
+    # 有効桁数15桁に丸めると整数に繰り上がる値だけは、スカラーの関数で1つずつ計算する
+    nearest = np.rint(x)
+    near = (np.abs(x - nearest) <= np.abs(x) * 1e-13) & (x != nearest)
+    if near.any():
+        result[near] = [scalar(v) for v in x[near].tolist()]
+    return result.astype(np.int64)
+
+
+# ---- 実金シートの計算 ---------------------------------------------------------
+
+
+def input_kv(wb: Workbook) -> Dict[str, Any]:
+    """
+    実金シートの入力シートの 項目名 -> 値
+    """
+    input_sheet = cast(Worksheet, wb['入力シート'])
+    return {k.value.rstrip(): v.value
+            for k, v in input_sheet.iter_rows(min_col=1, max_col=2)
+            if isinstance(k.value, str)}
+
+
+def holidays_of(wb: Workbook) -> List[datetime]:
+    holiday_sheet = cast(Worksheet, wb['休日'])
+    return [cell.value for (cell, ) in holiday_sheet['A2:A51']
+            if isinstance(cell.value, (datetime, date))]
+
+
+class _Sheet:
+    """
+    計算中の実金シート。セル番地で値を読み書きする
+    """
+
+    def __init__(self, ws: Optional[Worksheet] = None):
+        self.values: Dict[Tuple[int, int], Any] = {}
+        self.number_formats: Dict[Tuple[int, int], str] = {}
+        self._ws = ws
+        if ws is None:
+            # 計算した値だけを持つ(テンプレートの値と表示形式を読まない)
+            return
+
+        # 見出しなどの定数はテンプレートの値をそのまま使う
+        for row in ws.iter_rows():
+            for cell in row:
+                if cell.value is None:
+                    continue
+                if isinstance(cell.value, str) and cell.value.startswith('='):
+                    continue
+                self.values[(cell.row, cell.column)] = cell.value
+
+    def __getitem__(self, coordinate: str) -> Any:
+        return self.values.get(coordinate_to_tuple(coordinate))
+
+    def __setitem__(self, coordinate: str, value: Any):
+        self.set(*coordinate_to_tuple(coordinate), value)
+
+    def set(self, row: int, column: int, value: Any):
+        self.values[(row, column)] = normalize_number(value)
+        if self._ws is not None:
+            self.number_formats[(row, column)] = self._ws.cell(row, column).number_format
+
+    def set_column(self, column: str, start: int, values: Iterable[Any]):
+        """
+        column列のstart行から下にvaluesを書き込む
+        """
+        col = column_index_from_string(column)
+        for row, value in enumerate(values, start):
+            self.set(row, col, value)
+
+    def column_sum(self, column: str, start: int, end: int):
+        # SUMは文字列と空のセルを無視する
+        col = column_index_from_string(column)
+        return normalize_number(sum(
+            v for row in range(start, end + 1)
+            if isinstance(v := self.values.get((row, col)), (int, float))
+            and not isinstance(v, bool)))
+
+
+def _if_positive(x):
+    return x if x > 0 else 0
+
+
+def calculate(wb: Workbook, jikkin_type: str) -> Schedule:
+    """
+    `jikkin_sheet.write_table_to`で返済予定表を書き込んだ実金シートを計算する。
+    jikkin_typeは`jikkin_sheet.jikkin_type`の戻り値
+    """
+    return calculate_many([(wb, jikkin_type)])[0]
+
+
+class _Prepared(NamedTuple):
+    jikkin_type: str
+    sheet: '_Sheet'
+    params: Any  # _BulletParams または _BalloonParams
+
+
+def calculate_many(workbooks: Sequence[Tuple[Workbook, str]]) -> List[Schedule]:
+    """
+    (実金シート, jikkin_type)の組をまとめて計算する。
+
+    入力シートの値から求める見出しのセルは商品ごとに計算し、返済予定表の列は
+    元金最終一括弁済(A, D)と元金定額弁済(B, C, E)ごとに、すべての商品の分を
+    商品×回の配列で一度に計算する
+    """
+    prepared = [_prepare(_Sheet(cast(Worksheet, wb['実金'])), input_kv(wb), holidays_of(wb), jikkin_type)
+                for wb, jikkin_type in workbooks]
+
+    schedules = []
+    for (jikkin_type, sheet, params), columns in zip(prepared, _columns_of(prepared)):
+        fill = _fill_a_d if jikkin_type in {'A', 'D'} else _fill_b_c_e
+        last_month_row, sum_row = fill(sheet, params, columns)
+        schedules.append(Schedule(jikkin_type, sheet.values, sheet.number_formats,
+                                  last_month_row, sum_row, columns))
+    return schedules
+
+
+def calculate_columns(inputs: Sequence[Tuple[Mapping[str, Any], List[datetime], str]]) -> List[Schedule]:
+    """
+    (入力シートの値, 休日, jikkin_type)の組から、見出しのセルと返済予定表の列だけを計算する。
+
+    入力シートの値は`input_kv`と同じ形で渡す。ワークブックを使わず、返済予定表の行のセルも
+    書き込まないので、入力の値を変えて何度も計算する場合に使う。返すScheduleのvaluesには
+    見出しと実行日の行だけが含まれ、表示形式は空になる
+    """
+    prepared = [_prepare(_Sheet(), kv, holidays, jikkin_type) for kv, holidays, jikkin_type in inputs]
+    return [
+        Schedule(jikkin_type, sheet.values, sheet.number_formats,
+                 *_table_rows(jikkin_type, params.repeat), columns)
+        for (jikkin_type, sheet, params), columns in zip(prepared, _columns_of(prepared))]
+
+
+def _prepare(sheet: _Sheet, kv: Mapping[str, Any], holidays: List[datetime], jikkin_type: str) -> _Prepared:
+    if not isinstance(kv.get('借入日'), datetime):
+        raise RuntimeError('実金シートの計算には借入日が必要です。入力シートを確認してください')
+
+    if jikkin_type in {'A', 'D'}:
+        params: Any = _prepare_a_d(sheet, kv, holidays, jikkin_type)
+    elif jikkin_type in {'B', 'C', 'E'}:
+        params = _prepare_b_c_e(sheet, kv, holidays, jikkin_type)
+    else:
+        raise RuntimeError(f'実金シート{jikkin_type}は計算することができません。')
+    return _Prepared(jikkin_type, sheet, params)
+
+
+def _columns_of(prepared: Sequence[_Prepared]) -> List[ScheduleColumns]:
+    """
+    元金最終一括弁済(A, D)と元金定額弁済(B, C, E)ごとに、返済予定表の列をまとめて計算する
+    """
+    columns: Dict[int, ScheduleColumns] = {}
+    for types, compute in (({'A', 'D'}, _bullet_columns), ({'B', 'C', 'E'}, _balloon_columns)):
+        indices = [i for i, p in enumerate(prepared) if p.jikkin_type in types]
+        if not indices:
+            continue
+        batch, rows = compute([prepared[i].params for i in indices])
+        for i, product_columns in zip(indices, batch.split(rows)):
+            columns[i] = product_columns
+    return [columns[i] for i in range(len(prepared))]
+
+
+def _table_rows(jikkin_type: str, repeat: int) -> Tuple[int, int]:
+    """
+    `jikkin_sheet.process_*`が書き込む返済予定表の(最終回の行, 合計の行)
+    """
+    repeat_start_idx = 23 if jikkin_type in {'A', 'D'} else 24
+    last_month_idx = repeat_start_idx + repeat - 2
+    return (last_month_idx, last_month_idx + 1)
+
+
+def from_values(jikkin_type: str, values: Mapping[Tuple[int, int], Any], number_formats: Mapping[Tuple[int, int], str]) -> Schedule:
+    """
+    計算済みの実金シートのすべてのセルの値からScheduleを作る。
+    合計の行は`jikkin_sheet.process_*`が"合計"と書き込んだ行から探す
+    """
+    sum_row = next(
+        (row for (row, col), v in sorted(values.items())
+         if col == 1 and row >= 23 and isinstance(v, str) and '合計' in v),
+        None)
+    if sum_row is None:
+        raise RuntimeError(f'実金シート{jikkin_type}の合計の行が見つかりません。')
+
+    return Schedule(jikkin_type, values, number_formats, sum_row - 1, sum_row)
+
+
+def _schedule_dates(borrowing_dates: Sequence[datetime], k: np.ndarray) -> np.ndarray:
+    """
+    返済予定表の日付。実行日の次は借入日の翌々月1日で、以降は1か月ごと(EDATE)の1日
+    """
+    start = np.array(borrowing_dates, dtype='datetime64[us]')[:, None]
+    dates = (start.astype('datetime64[M]') + (k + 1)).astype('datetime64[us]')
+    dates[:, 0] = start[:, 0]
+    return dates
+
+
+def _schedule_days(dates: np.ndarray) -> np.ndarray:
+    """DATEDIF(前回の日付, 日付, "d")。実行日の行は0"""
+    days = np.zeros(dates.shape, dtype=np.int64)
+    days[:, 1:] = (dates[:, 1:] - dates[:, :-1]) // np.timedelta64(1, 'D')
+    return days
+
+
+def _column(values: Sequence[Any], dtype: Any = np.int64) -> np.ndarray:
+    """商品ごとの値を、商品×回の配列と計算できる列ベクトルにする"""
+    return np.array(values, dtype=dtype)[:, None]
+
+
+def _shift(a: np.ndarray) -> np.ndarray:
+    """前回の行の値。実行日の行は0"""
+    shifted = np.zeros_like(a)
+    shifted[:, 1:] = a[:, :-1]
+    return shifted
+
+
+class _BulletParams(NamedTuple):
+    borrowing_date: datetime
+    repeat: int  # 弁済回数
+    rate: float  # 約定利率
+    principal: int  # 実行日の残元金 (F21)
+    first_accrual: int  # 初回に加える日割利息 (H18)
+
+
+def _prepare_a_d(s: _Sheet, kv: Mapping[str, Any], holidays: List[datetime], jikkin_type: str) -> _BulletParams:
+    """
+    元金最終一括弁済 (実金シートA, D) の見出しと実行日の行
+    """
+    borrowing_date = kv.get('借入日')
+
+    s['A1'] = f"{excel_text(kv.get('商品区分'))} 実質年率計算シート（{excel_text(kv.get('弁済期間'))} 毎月利息弁済 元金最終一括弁済）"
+    s['B3'] = kv.get('顧客名' if jikkin_type == 'A' else '法人名')
+    s['E3'] = kv.get('Ｐｒｏｐｅｒｔｙ　Ａｄｄ')
+    s['B4'] = kv.get('物件価格')
+    s['B5'] = s['B4'] * kv.get('融資比率')
+    s['B8'] = kv.get('優遇レート')
+    s['B6'] = s['B8'] + 0.99
+    s['B7'] = excel_round(s['B5'] * s['B6'], 0)
+    s['B9'] = excel_int(s['B5'] * s['B8'])
+    s['B10'] = s['B7'] - s['B9']
+    s['B11'] = kv.get('送金手数料')
+    s['B13'] = kv.get('約定利率')
+    s['D15'] = kv.get('手数料率')
+    s['D16'] = kv.get('消費税率')
+    s['B15'] = excel_int(excel_int(s['B7'] * s['D15']) * (1 + s['D16']))
+    s['F16'] = workday(borrowing_date, -3, holidays)
+    s['H16'] = days_to_month_end(borrowing_date)
+    s['H18'] = excel_int(s['B7'] * s['B13'] * s['H16'] / 365)
+
+    # 実行日
+    s['A21'] = 0
+    s['B21'] = borrowing_date
+    s['C21'] = s['B15'] + s['B10'] + s['B11']
+    s['D21'] = 0
+    s['E21'] = 0
+    s['F21'] = s['B7'] - s['E21']
+    s['G21'] = _if_positive(s['F21'])
+
+    return _BulletParams(borrowing_date, kv['弁済回数'], s['B13'], s['F21'], s['H18'])
+
+
+def _bullet_columns(params: Sequence[_BulletParams]) -> Tuple[ScheduleColumns, List[int]]:
+    """
+    元金最終一括弁済の返済予定表の列。残元金は最終回まで変わらず、最終回に一括で弁済する
+    """
+    repeat = _column([p.repeat for p in params])
+    # 実行日と初回の行は弁済回数によらず計算する
+    rows = np.maximum(repeat, 1) + 1
+    k = np.arange(int(rows.max()))[None, :]
+    # 最終回の行 (jikkin_sheet.process_a_d が書き込む行のうち最後の行)
+    last = (k == repeat) & (k >= 2)
+
+    principal = _column([p.principal for p in params])
+    rate = _column([p.rate for p in params], float)
+    dates = _schedule_dates([p.borrowing_date for p in params], k)
+    days = _schedule_days(dates)
+
+    balance = np.where(last, 0, principal)
+    interest = np.where(k >= 1, excel_int_array(principal * rate / 12), 0) \
+        + np.where(k == 1, _column([p.first_accrual for p in params]), 0)
+    accrual = np.where((k >= 1) & (principal > 0),
+                       excel_rounddown_array(np.maximum(principal, 0) * days / 365), 0)
+    zeros = np.zeros(k.shape, dtype=np.int64)
+
+    return ScheduleColumns(
+        number=np.broadcast_to(k, balance.shape),
+        dates=dates,
+        days=days,
+        interest=interest,
+        principal=np.where(last, np.abs(principal), 0),
+        balance=balance,
+        accrual=accrual,
+        repayment=np.broadcast_to(zeros, balance.shape),
+        repayments=np.broadcast_to(zeros, balance.shape),
+        paid=last,
+    ), rows[:, 0].tolist()
+
+
+def _fill_a_d(s: _Sheet, params: _BulletParams, c: ScheduleColumns) -> Tuple[int, int]:
+    """
+    元金最終一括弁済の返済予定表と、合計から求める見出しのセルを書き込む
+    """
+    # jikkin_sheet.process_a_d と同じ行番号
+    repeat = params.repeat
+    repeat_start_idx = 23
+    repeat_end_idx = repeat_start_idx + repeat - 3
+    last_month_idx = repeat_end_idx + 1
+    sum_idx = last_month_idx + 1
+
+    # 初回の行(22行目)から下。実行日の行は_prepare_a_dで書き込み済み
+    first = 22
+    balance = c.balance[1:]
+    s.set_column('A', first, c.number[1:].tolist())
+    s.set_column('B', first, c.dates[1:].tolist())
+    s.set_column('C', first + 1, [''] * (len(balance) - 1))
+    s.set_column('D', first, c.interest[1:].tolist())
+    s.set_column('E', first, c.principal[1:].tolist())
+    s.set_column('F', first, balance.tolist())
+    s.set_column('G', first, np.maximum(balance, 0).tolist())
+    s.set_column('I', first, c.days[1:].tolist())
+    accrual: List[Any] = c.accrual[1:].tolist()
+    if params.principal <= 0 and last_month_idx >= repeat_start_idx:
+        # 最終月の数式にはIFの偽の場合の値がない
+        accrual[last_month_idx - first] = False
+    s.set_column('H', first, accrual)
+
+    start = sum_idx - 1 - repeat
+    end = sum_idx - 1
+    s[f'A{sum_idx}'] = '合計'
+    s[f'B{sum_idx}'] = ''
+    for column in 'CDEHI':
+        s[f'{column}{sum_idx}'] = s.column_sum(column, start, end)
+    s[f'F{sum_idx}'] = ''
+    s[f'G{sum_idx}'] = ''
+
+    s['E9'] = s['D23']
+    s['G6'] = s[f'C{sum_idx}'] + s[f'D{sum_idx}']
+    s['E6'] = excel_rounddown(s['G6'] / s[f'H{sum_idx}'], 5)
+    s['E7'] = s[f'D{sum_idx}'] + s[f'E{sum_idx}']
+    s['E10'] = s[f'D{last_month_idx}'] + s[f'E{last_month_idx}']
+    s['G7'] = abs(s[f'E{sum_idx}'])
+
+    return (last_month_idx, sum_idx)
+
+
+class _BalloonParams(NamedTuple):
+    jikkin_type: str
+    borrowing_date: datetime
+    first_principal_date: datetime  # 初回元金弁済日
+    repeat: int  # 弁済回数
+    rate: float  # 約定利率
+    principal: int  # 借入額 (B8)
+    installment: int  # 定額弁済額 (H10)
+    balloon_count: Any  # バルーン回数 (F4)
+    repayment_month: Any  # 約定弁済月 (F5)
+    first_accrual: int  # 初回に加える日割利息 (I19)
+    remainder: Any  # 実金シートCのN22。B, EはNone
+
+
+def _prepare_b_c_e(s: _Sheet, kv: Mapping[str, Any], holidays: List[datetime], jikkin_type: str) -> _BalloonParams:
+    """
+    毎年の約定弁済月に元金定額弁済・最終残元金弁済 (実金シートB, C, E) の見出し
+    """
+    borrowing_date = kv.get('借入日')
+    first_principal_date = kv.get('初回元金弁済日')
+    if not isinstance(first_principal_date, datetime):
+        raise RuntimeError('実金シートの計算には初回元金弁済日が必要です。入力シートを確認してください')
+
+    s['F2'] = kv.get('Ｐｒｏｐｅｒｔｙ　Ａｄｄ')
+    s['B3'] = kv.get('法人名' if jikkin_type == 'E' else '顧客名')
+    if jikkin_type == 'C':
+        s['F3'] = kv.get('弁済期間')
+    s['B4'] = kv.get('物件価格')
+    s['F4'] = kv.get('バルーン回数（＝返済年数）')
+    s['H4'] = kv.get('最終弁済時ＬＴＶ')
+    s['B5'] = kv.get('融資比率')
+    s['F5'] = kv.get('約定弁済月')
+    s['B6'] = s['B4'] * s['B5'] if jikkin_type == 'E' \
+        else kv.get('ＵＳＤ借入希望金額')
+    s['B9'] = kv.get('優遇レート')
+    s['B7'] = s['B9'] + 0.99
+    s['B8'] = excel_round(s['B6'] * s['B7'], 0)
+    s['B10'] = excel_int(s['B6'] * s['B9'])
+    s['B11'] = s['B8'] - s['B10']
+    s['B12'] = kv.get('送金手数料')
+    s['B14'] = kv.get('約定利率')
+    s['H10'] = excel_int(s['B4'] * s['B7'] * ((s['B5'] - s['H4']) / s['F4']))
+    s['E16'] = kv.get('手数料率')
+    s['E17'] = kv.get('消費税率')
+    s['B16'] = excel_int(excel_int(s['B8'] * s['E16']) * (1 + s['E17']))
+    s['G17'] = workday(borrowing_date, -3, holidays)
+    s['I17'] = days_to_month_end(borrowing_date)
+    s['I19'] = excel_int(s['B8'] * s['B14'] * s['I17'] / 365)
+
+    title = f"{excel_text(kv.get('商品区分'))} 実質年率計算シート（{excel_text(kv.get('弁済期間'))}"
+    if jikkin_type == 'C':
+        s['A1'] = f"{title} 毎月利息弁済・{excel_text(s['F5'])}月定額元金弁済）"
+    else:
+        s['A1'] = f"{title} 毎月利息弁済 毎年{excel_text(s['F5'])}月元金定額弁済・最終残元金弁済）"
+
+    # 実行日に支払う手数料等
+    s['D22'] = s['B16'] + s['B11'] + (0 if jikkin_type == 'C' else s['B12'])
+
+    if jikkin_type == 'C':
+        s['N22'] = s['B8'] % s['F4']
+
+    return _BalloonParams(
+        jikkin_type, borrowing_date, first_principal_date, kv['弁済回数'], s['B14'], s['B8'], s['H10'],
+        s['F4'], s['F5'], s['I19'], s['N22'] if jikkin_type == 'C' else None)
+
+
+def _balloon_columns(params: Sequence[_BalloonParams]) -> Tuple[ScheduleColumns, List[int]]:
+    """
+    元金定額弁済の返済予定表の列。約定弁済月ごとに定額を弁済し、最終回に残元金を弁済する
+    """
+    repeat = _column([p.repeat for p in params])
+    rows = np.maximum(repeat, 0) + 1
+    k = np.arange(int(rows.max()))[None, :]
+    last = (k == repeat) & (k >= 1)
+
+    dates = _schedule_dates([p.borrowing_date for p in params], k)
+    days = _schedule_days(dates)
+    months = dates.astype('datetime64[M]').astype(np.int64) % 12 + 1
+
+    # L列とM列: 返済開始月以降の約定弁済月か、約定弁済回数の累計
+    # テンプレートの22,23行目のB,Eは弁済回数未満、process_*の書き込む行は弁済回数以下
+    reduced = _column([p.jikkin_type == 'C' for p in params], bool)
+    within = np.where((k >= 2) | reduced, k <= repeat, k < repeat)
+    repayment_month = _column([
+        p.repayment_month if isinstance(p.repayment_month, (int, float)) else np.nan
+        for p in params], float)
+    first_principal_date = _column([p.first_principal_date for p in params], 'datetime64[us]')
+    repayment = ((months == repayment_month) & (dates >= first_principal_date) & within).astype(np.int64)
+    repayments = np.cumsum(repayment, axis=1)
+    paid = (repayment == 1) & (_column([p.balloon_count for p in params], float) >= repayments)
+
+    # 最終回より前は約定弁済月に定額を弁済し、最終回に残元金をすべて弁済する
+    installment = np.where(paid & ~last, _column([p.installment for p in params]), 0)
+    balance = _column([p.principal for p in params]) - np.cumsum(installment, axis=1)
+    principal = np.where(last, _shift(balance), installment)
+    balance = np.where(last, 0, balance)
+
+    previous = _shift(balance)
+    rate = _column([p.rate for p in params], float)
+    interest = np.where(k >= 1, excel_int_array(previous * rate / 12), 0) \
+        + np.where(k == 1, _column([p.first_accrual for p in params]), 0)
+    accrual = np.where((k >= 1) & (previous > 0),
+                       excel_rounddown_array(np.maximum(previous, 0) * days / 365), 0)
+
+    return ScheduleColumns(
+        number=np.broadcast_to(k, balance.shape),
+        dates=dates,
+        days=days,
+        interest=interest,
+        principal=principal,
+        balance=balance,
+        accrual=accrual,
+        repayment=repayment,
+        repayments=repayments,
+        paid=paid,
+    ), rows[:, 0].tolist()
+
+
+def _fill_b_c_e(s: _Sheet, params: _BalloonParams, c: ScheduleColumns) -> Tuple[int, int]:
+    """
+    元金定額弁済の返済予定表と、合計から求める見出しのセルを書き込む
+    """
+    jikkin_type = params.jikkin_type
+
+    # jikkin_sheet.process_b などと同じ行番号
+    repeat = params.repeat
+    repeat_start_idx = 24
+    repeat_end_idx = repeat_start_idx + repeat - 3
+    last_month_idx = repeat_end_idx + 1
+    sum_idx = last_month_idx + 1
+
+    # 実行日の行(22行目)から下
+    first = 22
+    rows = len(c.balance)
+    repayments = c.repayments.tolist()
+    s.set_column('A', first, c.number.tolist())
+    s.set_column('B', first, [params.borrowing_date, *c.dates[1:].tolist()])
+    s.set_column('L', first, c.repayment.tolist())
+    s.set_column('M', first, repayments)
+    s.set_column('C', first, [m if paid else '' for m, paid in zip(repayments, c.paid.tolist())])
+    if jikkin_type == 'C':
+        s.set_column('N', first + 1, [1 if params.remainder >= m else 0 for m in repayments[1:]])
+    s.set_column('D', first + 2, [''] * (rows - 2))
+    s.set_column('K', first + 2, [''] * (rows - 2))
+    s.set_column('E', first, c.interest.tolist())
+    s.set_column('F', first, c.principal.tolist())
+    s.set_column('G', first, c.balance.tolist())
+    s.set_column('H', first, np.maximum(c.balance, 0).tolist())
+    s.set_column('J', first + 1, c.days[1:].tolist())
+    s.set_column('I', first + 1, c.accrual[1:].tolist())
+
+    start = sum_idx - 1 - repeat
+    end = sum_idx - 1
+    summed_columns = 'DEFIJ' if jikkin_type == 'C' else 'DEFGHIJ'
+    s[f'A{sum_idx}'] = '合計'
+    for column in 'BCDEFGHIJKLM' + ('N' if jikkin_type == 'C' else ''):
+        if column in summed_columns:
+            s[f'{column}{sum_idx}'] = s.column_sum(column, start, end)
+        else:
+            s[f'{column}{sum_idx}'] = ''
+
+    first_principal_date = params.first_principal_date
+    s['F10'] = s['E24']
+    s['F12'] = _vlookup_principal(s, first_principal_date, 22, last_month_idx)
+    s['H7'] = s[f'D{sum_idx}'] + s[f'E{sum_idx}']
+    s['F7'] = excel_rounddown(s['H7'] / s[f'I{sum_idx}'], 5)
+    s['F8'] = s[f'E{sum_idx}'] + s[f'F{sum_idx}']
+    s['F11'] = s[f'E{last_month_idx}'] + s[f'F{last_month_idx}']
+    s['H8'] = abs(s[f'F{sum_idx}'])
+    s['H5'] = s[f'F{sum_idx if jikkin_type == "C" else last_month_idx}'] / \
+        (s['B4'] * s['B7'])
+    if jikkin_type == 'C':
+        if s['F12'] == na_error:
+            # 初回元金弁済日が表にない場合は、Excelと同じくF12のエラーがそのまま伝わる
+            s['H12'] = s['F12']
+        else:
+            s['H12'] = 'OK' if s['B8'] == s['F12'] * s['F4'] \
+                else s['B8'] - s['F12'] * s['F4']
+
+    return (last_month_idx, sum_idx)
+
+
+def _vlookup_principal(s: _Sheet, key: Any, start: int, end: int):
+    """VLOOKUP(key, B{start}:F{end}, 5, 0)"""
+    for idx in range(start, end + 1):
+        if s[f'B{idx}'] == key:
+            return s[f'F{idx}']
+    return na_error
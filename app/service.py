@@ -0,0 +1,313 @@
+"""
+帳票生成をローカルのHTTPサービスとして常駐させるモジュール。
+
+設定情報、コンパイル済みのテンプレート、変換バックエンドと帳票出力のワーカーを起動時に用意し、
+リクエストごとに入力シートから帳票を生成して、出力したファイルをzipで返す。
+
+- POST /render  本文に入力シート(xlsx)またはJSONを渡す。出力した帳票のzipを返す
+- GET  /health  待機中のリクエストの数などを返す
+
+gen_all_docはモジュールの状態(chacot_flg、マニフェスト)を使うので、帳票の生成は一つのスレッドで
+順に行い、待機できるリクエストの数を制限する
+"""
+
+from app import jikkin_sheet, template_cache
+from app.chohyo_gen import ChohyoGenerator, Renderer
+from app.model import ProductInput
+from collections import ChainMap
+from datetime import datetime
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+from typing import Any, Dict, List, Optional
+import dataclasses
+import glob
+import io
+import json
+import os
+import queue
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+
+logger = getLogger(__name__)
+
+# リクエストの本文の上限(バイト)
+max_body_size = 32 * 1024 * 1024
+
+# JSONの値のうち日付として扱う文字列
+iso_date_pattern = re.compile(r'^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?$')
+
+
+def product_inputs_from_json(data: Any) -> List[ProductInput]:
+    """
+    JSONの入力を商品ごとの入力値にする。
+
+    入力シートの列と同じく、商品ごとの項目名と値の辞書のリスト(または{"products": [...]})を受け取る。
+    入力シートと同じように、値のない項目は直前の列の値を使う。日付はISO 8601の文字列で指定する
+    """
+    if isinstance(data, dict):
+        data = data.get('products')
+    if not isinstance(data, list) or not data or not all(isinstance(p, dict) for p in data):
+        raise ValueError('商品ごとの項目名と値の辞書のリストを指定してください')
+
+    def normalize(v: Any):
+        if isinstance(v, str):
+            v = v.rstrip()
+            if len(v) == 0:
+                return None
+            if iso_date_pattern.match(v):
+                return datetime.fromisoformat(v)
+        return v
+
+    acc: ChainMap = ChainMap({k.rstrip(): normalize(v) for k, v in data[0].items()})
+    product_inputs = []
+    for values in data:
+        record = {k.rstrip(): value for k, v in values.items() if (value := normalize(v)) is not None}
+        if str(record.get('商品区分', '')).strip() == '':
+            continue
+        acc = ChainMap(record, acc)
+        product_inputs.append(ProductInput(acc))
+
+    if not product_inputs:
+        raise ValueError('商品区分が入力された商品がありません')
+    return product_inputs
+
+
+def product_inputs_from_body(body: bytes) -> List[ProductInput]:
+    """
+    リクエストの本文(xlsxまたはJSON)から商品ごとの入力値を読み込む
+    """
+    if body.startswith(b'PK'):
+        return jikkin_sheet.read_input_sheet(io.BytesIO(body))
+    return product_inputs_from_json(json.loads(body.decode('utf-8')))
+
+
+def write_zip(directory: str, stream: Any):
+    """
+    directory以下のファイルを、directoryからの相対パスでzipにしてstreamに書き出す
+    """
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as z:
+        for root, _, files in os.walk(directory):
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                arcname = os.path.relpath(path, directory).replace(os.sep, '/')
+                if arcname.startswith('.manifest'):
+                    continue
+                z.write(path, arcname)
+
+
+class RenderRequest:
+    """
+    リクエスト一つ分の帳票の生成。
+
+    タイムアウトしたリクエストは、待機中であれば生成せず、生成中であれば
+    生成が終わったときに、出力先のフォルダを生成するスレッドが削除する
+    """
+
+    def __init__(self, product_inputs: List[ProductInput]):
+        self.product_inputs = product_inputs
+        self.output_path = tempfile.mkdtemp(prefix='ibnet_contract_')
+        self.error: Optional[Exception] = None
+        self.elapsed = 0.0
+        self.done = threading.Event()
+        self._abandoned = False
+        self._running = False
+        self._lock = threading.Lock()
+
+    def start(self) -> bool:
+        """
+        生成を始める。タイムアウトしたリクエストの場合はFalse
+        """
+        with self._lock:
+            self._running = not self._abandoned
+            return self._running
+
+    def finish(self):
+        with self._lock:
+            self._running = False
+            self.done.set()
+            if self._abandoned:
+                self.cleanup()
+
+    def abandon(self):
+        """
+        リクエストがタイムアウトしたので、生成した帳票を使わない
+        """
+        with self._lock:
+            self._abandoned = True
+            if not self._running:
+                self.cleanup()
+
+    def cleanup(self):
+        shutil.rmtree(self.output_path, ignore_errors=True)
+
+
+class RenderService:
+    """
+    帳票を生成するスレッドと、リクエストの待ち行列
+    """
+
+    def __init__(self, generator: ChohyoGenerator, jikkin_calculation: str = 'python',
+                 render_workers: int = 1, queue_size: int = 8, timeout: float = 120):
+        if jikkin_calculation == 'excel':
+            raise RuntimeError(
+                'サービスではExcelで上書き保存する手順を待てないため、JIKKIN_CALCULATIONにexcel以外を指定してください。')
+        self.generator = generator
+        self.jikkin_calculation = jikkin_calculation
+        self.timeout = timeout
+        self.renderer = Renderer(generator, render_workers)
+        self.requests: 'queue.Queue[Optional[RenderRequest]]' = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._run, name='render', daemon=True)
+
+    def preload(self):
+        """
+        テンプレートをすべてコンパイルしておき、最初のリクエストから読み込みを省く
+        """
+        started = time.perf_counter()
+        paths = [p for ext in ('docx', 'xlsx')
+                 for p in glob.glob(os.path.join(glob.escape(self.generator.template_root_path), '**', f'*.{ext}'),
+                                    recursive=True)
+                 if not os.path.basename(p).startswith('~$')]
+        for path in paths:
+            try:
+                template_cache.get(path)
+            except Exception as e:
+                logger.debug(f'テンプレート{path}を読み込めませんでした: {e}')
+        logger.info(f'テンプレート{len(paths)}件を読み込みました ({time.perf_counter() - started:.2f}秒)')
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.requests.put(None)
+        self.thread.join()
+        self.renderer.close()
+
+    def submit(self, request: RenderRequest):
+        """
+        リクエストを待ち行列に入れる。待ち行列がいっぱいの場合はqueue.Fullを送出する
+        """
+        self.requests.put_nowait(request)
+
+    def _run(self):
+        while (request := self.requests.get()) is not None:
+            if not request.start():
+                continue
+            started = time.perf_counter()
+            try:
+                generator = dataclasses.replace(self.generator, output_root_path=request.output_path)
+                generator.gen_all_doc(
+                    request.product_inputs, self.jikkin_calculation,
+                    incremental=False, renderer=self.renderer)
+            except Exception as e:
+                logger.error(f'帳票の生成に失敗しました: {e}', exc_info=True)
+                request.error = e
+            finally:
+                request.elapsed = time.perf_counter() - started
+                request.finish()
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP/1.0で応答し、zipは生成しながら送って接続を閉じる
+    """
+
+    server: 'RenderServer'
+
+    def log_message(self, format: str, *args: Any):
+        logger.info(f'{self.address_string()} {format % args}')
+
+    def send_json(self, status: HTTPStatus, content: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+        body = json.dumps(content, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_json(HTTPStatus.NOT_FOUND, {'error': f'{self.path}はありません'})
+            return
+        service = self.server.service
+        self.send_json(HTTPStatus.OK, {
+            'status': 'ok',
+            'queued': service.requests.qsize(),
+            'queue_size': service.requests.maxsize,
+        })
+
+    def do_POST(self):
+        if self.path != '/render':
+            self.send_json(HTTPStatus.NOT_FOUND, {'error': f'{self.path}はありません'})
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if not 0 < length <= max_body_size:
+            self.send_json(HTTPStatus.BAD_REQUEST, {'error': f'本文は1バイト以上{max_body_size}バイト以下にしてください'})
+            return
+
+        try:
+            product_inputs = product_inputs_from_body(self.rfile.read(length))
+        except Exception as e:
+            self.send_json(HTTPStatus.BAD_REQUEST, {'error': f'入力シートを読み込めません: {e}'})
+            return
+
+        service = self.server.service
+        request = RenderRequest(product_inputs)
+        try:
+            service.submit(request)
+        except queue.Full:
+            request.cleanup()
+            self.send_json(HTTPStatus.SERVICE_UNAVAILABLE, {'error': '処理待ちのリクエストが多すぎます'},
+                           {'Retry-After': '5'})
+            return
+
+        if not request.done.wait(service.timeout):
+            request.abandon()
+            self.send_json(HTTPStatus.GATEWAY_TIMEOUT, {'error': f'{service.timeout}秒以内に生成が終わりませんでした'})
+            return
+
+        try:
+            if request.error is not None:
+                self.send_json(HTTPStatus.UNPROCESSABLE_ENTITY, {'error': str(request.error)})
+                return
+
+            self.send_response(HTTPStatus.OK)
+            self.send_header('Content-Type', 'application/zip')
+            self.send_header('Content-Disposition', 'attachment; filename="output.zip"')
+            self.send_header('X-Render-Seconds', f'{request.elapsed:.3f}')
+            self.end_headers()
+            write_zip(request.output_path, self.wfile)
+        finally:
+            request.cleanup()
+
+
+class RenderServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address: Any, service: RenderService):
+        super().__init__(address, RenderRequestHandler)
+        self.service = service
+
+
+def serve(service: RenderService, host: str = '127.0.0.1', port: int = 8080):
+    """
+    サービスを起動し、Ctrl+Cで止めるまでリクエストを受け付ける
+    """
+    service.preload()
+    service.start()
+    with RenderServer((host, port), service) as server:
+        logger.info(f'http://{host}:{server.server_port}/render でリクエストを受け付けます (Ctrl+Cで終了)')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.stop()
@@ -0,0 +1,430 @@
+"""
+テンプレートを一度だけ解析して置換可能な形にコンパイルし、プロセス内にキャッシュするモジュール
+
+同じテンプレートが商品の列や連帯保証人の数だけ何度も出力されるので、テンプレートの読み込みと
+キーワードの探索はテンプレートごとに一度だけ行い、以降はコンパイル済みの形から出力する。
+"""
+
+from app import docx_helper, replace
+from collections import OrderedDict
+from dataclasses import dataclass
+from logging import getLogger
+from typing import IO, Any, Callable, Dict, List, Mapping, Optional, Pattern, Tuple, Union
+from xml.sax.saxutils import escape
+import docx
+import io
+import os
+import re
+import struct
+import threading
+import zipfile
+
+logger = getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Slot:
+    """
+    テンプレート内のキーワードの位置と内容
+    """
+    key: str  # 項目名
+    format_str: Optional[str]  # ○以降のフォーマット
+    source: str  # テンプレート上の"●項目名○フォーマット●"
+    offset: int  # パート内でのテキストノードの位置
+
+
+@dataclass(frozen=True)
+class CompiledPart:
+    """
+    キーワードを含むXMLのパート。置換しない部分(chunks)とキーワード(slots)が交互に並ぶ
+    """
+    name: str
+    chunks: Tuple[str, ...]  # len(slots) + 1 個
+    slots: Tuple[Slot, ...]
+    escape: Callable[[str], str]  # 置換後の値をXMLに埋め込むための関数
+
+    def render(self, resolve: Callable[[Slot], str]) -> str:
+        out = [self.chunks[0]]
+        for slot, chunk in zip(self.slots, self.chunks[1:]):
+            out.append(self.escape(resolve(slot)))
+            out.append(chunk)
+        return ''.join(out)
+
+
+@dataclass(frozen=True)
+class CompiledTemplate:
+    """
+    コンパイル済みのテンプレート
+    """
+    path: str
+    ext: str  # '.docx' または '.xlsx'
+    data: bytes  # テンプレートファイルの中身
+    parts: Mapping[str, CompiledPart]  # キーワードを含むパート
+    fragmented: bool  # 複数のテキストノードに分割されたキーワードが含まれている
+
+    @property
+    def slots(self) -> Tuple[Slot, ...]:
+        return tuple(slot for part in self.parts.values() for slot in part.slots)
+
+    def open(self) -> io.BytesIO:
+        """
+        python-docxやopenpyxlで開くためのファイルオブジェクトを返す
+        """
+        return io.BytesIO(self.data)
+
+    def render(self, replace_dict: Mapping[str, Any], output: Union[str, IO[bytes]]):
+        """
+        replace_dictをもとにキーワードを置換し、outputに出力する。
+
+        書き換えるのはキーワードを含むパートだけで、画像やフォントなどそれ以外のパートは
+        展開せずに圧縮済みのデータをそのまま出力先にコピーする。
+        outputがパスの場合は同じフォルダの一時ファイルに書いてから置き換え、置換に失敗しても
+        前回の出力を壊さないようにする
+        """
+
+        def resolve(slot: Slot) -> str:
+            return replace.resolve_keyword(
+                slot.key, slot.format_str, replace_dict, self.path)
+
+        if isinstance(output, str):
+            tmp_path = f'{output}.{os.getpid()}.{threading.get_ident()}.tmp'
+            try:
+                self._write(resolve, tmp_path)
+                os.replace(tmp_path, output)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        else:
+            self._write(resolve, output)
+
+    def _write(self, resolve: Callable[[Slot], str], output: Union[str, IO[bytes]]):
+        with zipfile.ZipFile(self.open()) as src, \
+                zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as dst:
+            for info in src.infolist():
+                part = self.parts.get(info.filename)
+                if part is not None:
+                    dst.writestr(info, part.render(resolve).encode('utf-8'))
+                else:
+                    copy_member(src, info, dst)
+
+
+# copy_memberが使うzipfileの非公開の属性。公開APIではないので、Pythonのバージョンによって
+# なくなっていれば展開・再圧縮してコピーする
+_raw_copy_module_attributes = ('structFileHeader', 'sizeFileHeader', 'stringFileHeader',
+                               '_FH_SIGNATURE', '_FH_FILENAME_LENGTH', '_FH_EXTRA_FIELD_LENGTH')
+_raw_copy_zipfile_attributes = ('fp', 'filelist', 'NameToInfo', 'start_dir', '_didModify')
+
+
+def _can_copy_raw(src: zipfile.ZipFile, dst: zipfile.ZipFile) -> bool:
+    return all(hasattr(zipfile, name) for name in _raw_copy_module_attributes) \
+        and all(hasattr(dst, name) for name in _raw_copy_zipfile_attributes) \
+        and hasattr(src, 'fp')
+
+
+def copy_member(src: zipfile.ZipFile, info: zipfile.ZipInfo, dst: zipfile.ZipFile):
+    """
+    zipのメンバーを展開・再圧縮せずに、圧縮済みのデータのままdstへコピーする
+
+    zipfileにはこの操作の公開APIがないので、ローカルファイルヘッダーを読み飛ばして
+    圧縮済みのデータを取り出し、新しいヘッダーとともに書き込む。
+    zipfileの非公開の属性が使えない場合は`ZipFile.writestr`でコピーする
+    """
+    if info.flag_bits & 0x1 or not _can_copy_raw(src, dst):
+        # 暗号化されている場合や、非公開の属性が使えない場合は通常の方法でコピーする
+        dst.writestr(info, src.read(info))
+        return
+
+    src.fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader,
+                           src.fp.read(zipfile.sizeFileHeader))
+    if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        # ヘッダーの形式が想定と異なる場合も通常の方法でコピーする
+        dst.writestr(info, src.read(info))
+        return
+    src.fp.seek(header[zipfile._FH_FILENAME_LENGTH] +
+                header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+    raw = src.fp.read(info.compress_size)
+
+    new_info = zipfile.ZipInfo(info.filename, info.date_time)
+    new_info.compress_type = info.compress_type
+    new_info.external_attr = info.external_attr
+    new_info.create_system = info.create_system
+    new_info.CRC = info.CRC
+    new_info.compress_size = info.compress_size
+    new_info.file_size = info.file_size
+    new_info.header_offset = dst.fp.tell()
+
+    dst.fp.write(new_info.FileHeader())
+    dst.fp.write(raw)
+    dst.filelist.append(new_info)
+    dst.NameToInfo[new_info.filename] = new_info
+    dst.start_dir = dst.fp.tell()
+    dst._didModify = True
+
+
+def docx_text_escape(text: str) -> str:
+    """
+    w:tの中に埋め込めるように文字列をエスケープする。
+    改行とタブはpython-docxのRun.textと同じくw:br, w:tabに変換する
+    """
+    text = escape(text)
+    text = re.sub(r'\r\n|\r|\n',
+                  '</w:t><w:br/><w:t xml:space="preserve">', text)
+    return text.replace('\t', '</w:t><w:tab/><w:t xml:space="preserve">')
+
+
+def _preserve_space(open_tag: str) -> str:
+    if 'xml:space' in open_tag:
+        return open_tag
+    return open_tag[:-1] + ' xml:space="preserve">'
+
+
+@dataclass(frozen=True)
+class PartRule:
+    """
+    キーワードを探索するパートと、そのパートのテキストノードの扱い
+    """
+    name_pattern: Pattern  # 対象のパート名
+    text_node_pattern: Pattern  # (開始タグ, テキスト, 終了タグ) の3グループ。キーワードはテキストに収まっている必要がある
+    escape: Callable[[str], str]  # 置換後の値をテキストノードに埋め込むための関数
+    open_tag: Callable[[str], str] = lambda tag: tag  # キーワードを含むテキストノードの開始タグの書き換え
+
+
+# 単純な要素のテキスト (docPropsなど)
+simple_text_node_pattern = re.compile(r'(<[^/?!>][^>]*>)([^<]*)(</[^>]+>)')
+
+docx_part_rules = [
+    PartRule(re.compile(r'^word/(document|header\d*|footer\d*)\.xml$'),
+             re.compile(r'(<w:t(?:\s[^>]*)?>)([^<]*)(</w:t>)'),
+             docx_text_escape,
+             _preserve_space),
+    PartRule(re.compile(r'^docProps/(core|app|custom)\.xml$'),
+             simple_text_node_pattern,
+             escape),
+]
+
+xlsx_part_rules = [
+    # 共有文字列。同じ文字列を使うセルがいくつあっても置換は一度で済む
+    PartRule(re.compile(r'^xl/sharedStrings\.xml$'),
+             re.compile(r'(<t(?:\s[^>]*)?>)([^<]*)(</t>)'),
+             escape,
+             _preserve_space),
+    # シートのインライン文字列とヘッダー・フッター
+    PartRule(re.compile(r'^xl/worksheets/sheet\d+\.xml$'),
+             re.compile(r'(<(?:t|(?:odd|even|first)(?:Header|Footer))(?:\s[^>]*)?>)([^<]*)'
+                        r'(</(?:t|(?:odd|even|first)(?:Header|Footer))>)'),
+             escape,
+             lambda tag: _preserve_space(tag) if tag.startswith('<t') else tag),
+]
+
+# 拡張子ごとのキーワードを探索するパート
+part_rules: Dict[str, List[PartRule]] = {
+    '.docx': docx_part_rules,
+    '.xlsx': xlsx_part_rules,
+}
+
+xlsx_workbook_part = 'xl/workbook.xml'
+
+
+def full_calc_on_load(name: str, xml: str) -> CompiledPart:
+    """
+    excelで開いたときに数式を再計算させる。
+
+    文字列を書き換えるとテンプレートに保存されている数式の計算結果が古くなるので、
+    openpyxlで保存したときと同じく開いたときに計算し直すようにする
+    """
+    calc_pr = re.search(r'<calcPr(?:\s[^>]*?)?(/?)>', xml)
+    if calc_pr is None:
+        xml = xml.replace('</workbook>', '<calcPr fullCalcOnLoad="1"/></workbook>')
+    elif 'fullCalcOnLoad=' not in calc_pr.group(0):
+        pos = calc_pr.start(1) if calc_pr.group(1) else calc_pr.end() - 1
+        xml = xml[:pos] + ' fullCalcOnLoad="1"' + xml[pos:]
+    return CompiledPart(name, (xml,), (), escape)
+
+
+_xml_reference_pattern = re.compile(r'&(#x[0-9a-fA-F]+|#[0-9]+|lt|gt|amp|quot|apos);')
+_xml_entities = {'lt': '<', 'gt': '>', 'amp': '&', 'quot': '"', 'apos': "'"}
+
+
+def xml_text(text: str) -> str:
+    """
+    XMLのテキストに含まれる実体参照と文字参照をデコードする
+    """
+    def decode(m: 're.Match[str]') -> str:
+        ref = m.group(1)
+        if ref.startswith('#x'):
+            return chr(int(ref[2:], 16))
+        if ref.startswith('#'):
+            return chr(int(ref[1:]))
+        return _xml_entities[ref]
+
+    return _xml_reference_pattern.sub(decode, text)
+
+
+def compile_part(name: str, xml: str, rule: PartRule) -> Tuple[Optional[CompiledPart], bool]:
+    """
+    パートのXMLをキーワードの位置で分割する。
+
+    戻り値は(コンパイルしたパート, 分割されたキーワードを含むか)。キーワードを含まない場合は
+    パートはNoneになる
+    """
+    chunks = ['']
+    slots = []
+    fragmented = False
+    last = 0
+    for node in rule.text_node_pattern.finditer(xml):
+        open_tag, text, _ = node.groups()
+        if '&' in text:
+            # openpyxlは日本語を文字参照で書き出すので、デコードしてからキーワードを探す
+            text = xml_text(text)
+        matches = list(replace.replace_pattern.finditer(text))
+
+        if text.count(replace.keyword_quoter) != 2 * len(matches):
+            fragmented = True
+        if not matches:
+            continue
+
+        # 置換後の値の前後の空白が消えないようにする
+        chunks[-1] += xml[last:node.start()] + rule.open_tag(open_tag)
+        last_in_text = 0
+        for m in matches:
+            chunks[-1] += escape(text[last_in_text:m.start()])
+            key, format_str = m.groups()
+            slots.append(Slot(
+                key=key,
+                format_str=format_str,
+                source=m.group(0),
+                offset=node.start(2)))
+            chunks.append('')
+            last_in_text = m.end()
+        chunks[-1] += escape(text[last_in_text:])
+        last = node.start(3)
+
+    if not slots:
+        return (None, fragmented)
+
+    chunks[-1] += xml[last:]
+    return (CompiledPart(name, tuple(chunks), tuple(slots), rule.escape), fragmented)
+
+
+def compile_parts(data: bytes, rules: List[PartRule]) -> Tuple[Dict[str, CompiledPart], bool]:
+    """
+    rulesに該当するパートをコンパイルする
+    """
+    parts: Dict[str, CompiledPart] = {}
+    fragmented = False
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        for name in z.namelist():
+            rule = next(
+                (rule for rule in rules if rule.name_pattern.match(name)), None)
+            if rule is None:
+                continue
+            part, part_fragmented = compile_part(
+                name, z.read(name).decode('utf-8'), rule)
+            fragmented = fragmented or part_fragmented
+            if part is not None:
+                parts[name] = part
+    return (parts, fragmented)
+
+
+def join_split_keywords(data: bytes) -> bytes:
+    """
+    複数のrunに分割されたキーワードを、段落ごとに先頭のrunにまとめたdocxを返す
+    """
+    doc = docx.Document(io.BytesIO(data))
+    for paragraph in docx_helper.all_paragraphs(doc):
+        replace.substitute_paragraph(paragraph, replace.keyword_string)
+    out = io.BytesIO()
+    doc.save(out)
+    return out.getvalue()
+
+
+def package_ext(data: bytes) -> str:
+    """
+    zipの中身からdocxかxlsxかを判定し、拡張子を返す
+    """
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        names = set(z.namelist())
+    if 'word/document.xml' in names:
+        return '.docx'
+    if xlsx_workbook_part in names:
+        return '.xlsx'
+    raise RuntimeError('docxまたはxlsxのファイルではありません。')
+
+
+def compile_template(path: str, data: Optional[bytes] = None) -> CompiledTemplate:
+    """
+    テンプレートファイルをコンパイルする。キャッシュを通したい場合は`get`を使うこと
+
+    dataを渡した場合はファイルを読まずにdataをコンパイルする。このときpathはログに使う名前で、
+    拡張子がなければ中身から種類を判定する
+    """
+    if data is None:
+        with open(path, 'rb') as f:
+            data = f.read()
+
+    ext = os.path.splitext(path)[1]
+    if ext not in part_rules:
+        ext = package_ext(data)
+
+    rules = part_rules[ext]
+    parts, fragmented = compile_parts(data, rules)
+
+    if fragmented and ext == '.docx':
+        # Wordが分割してしまったキーワードは、コンパイル時に一度だけまとめておく
+        logger.debug(f'{path}には複数のrunに分割されたキーワードが含まれています')
+        data = join_split_keywords(data)
+        parts, fragmented = compile_parts(data, rules)
+
+    if parts and ext == '.xlsx':
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            parts[xlsx_workbook_part] = full_calc_on_load(
+                xlsx_workbook_part, z.read(xlsx_workbook_part).decode('utf-8'))
+
+    return CompiledTemplate(path, ext, data, parts, fragmented)
+
+
+class TemplateCache:
+    """
+    パスと更新日時をキーにしたコンパイル済みテンプレートのLRUキャッシュ
+    """
+
+    def __init__(self, maxsize: int = 64):
+        self.maxsize = maxsize
+        self._items: 'OrderedDict[Tuple[str, int, int], CompiledTemplate]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> CompiledTemplate:
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            template = self._items.get(key)
+            if template is not None:
+                self._items.move_to_end(key)
+                return template
+
+        template = compile_template(path)
+        logger.debug(f'{path}をコンパイルしました (キーワード数: {len(template.slots)})')
+
+        with self._lock:
+            self._items[key] = template
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+        return template
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+cache = TemplateCache(int(os.environ.get('TEMPLATE_CACHE_SIZE', '64')))
+
+
+def get(path: str) -> CompiledTemplate:
+    """
+    キャッシュからコンパイル済みテンプレートを取得する。キャッシュにない場合はコンパイルする
+    """
+    return cache.get(path)
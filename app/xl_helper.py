@@ -3,11 +3,30 @@ openpyxlのヘルパー関数
 """
 
 
+from app import formula
+from array import array
 from copy import copy
-from typing import Iterable
-from openpyxl.cell.cell import Cell
+from datetime import date, datetime, time
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple, cast
+from openpyxl.cell.cell import TIME_FORMATS, Cell
+from openpyxl.formula.translate import Translator
+from openpyxl.styles.fills import Fill
+from openpyxl.styles.numbers import BUILTIN_FORMATS, FORMAT_DATE_DATETIME, FORMAT_GENERAL, is_date_format
+from openpyxl.styles.cell_style import StyleArray
+from openpyxl.utils.cell import column_index_from_string, coordinate_to_tuple, get_column_letter
+from openpyxl.utils.datetime import to_excel
+from openpyxl.workbook.workbook import Workbook
 from openpyxl.worksheet.header_footer import _HeaderFooterPart
 from openpyxl.worksheet.worksheet import Worksheet
+from openpyxl.xml.functions import tostring
+from xml.sax.saxutils import escape
+import heapq
+import html
+import io
+import itertools
+import posixpath
+import re
+import zipfile
 
 
 def copy_style(src: Cell, dst: Cell):
@@ -22,6 +41,58 @@ def copy_style(src: Cell, dst: Cell):
     dst.alignment = copy(src.alignment)
 
 
+# StyleArrayのうち`copy_style`がコピーする要素 (fontId, fillId, borderId, numFmtId, protectionId, alignmentId)
+_copied_style_ids = slice(0, 6)
+
+
+def _style_array(cell: Cell) -> StyleArray:
+    # スタイルを一度も参照していないセルはNoneのことがある
+    return cell._style or StyleArray()
+
+
+class StyleInterner:
+    """
+    セルのスタイルをまとめてコピーする。
+
+    `copy_style`はセルごとにフォントなどのオブジェクトを複製し、openpyxlがそれをブックの
+    スタイルの一覧から探し直す。コピー元のスタイルとコピー先のブックの組ごとに、一度だけ
+    `copy_style`でスタイルのidを求めておき、以降のセルにはidだけを書き込む。
+    結果は`copy_style`でコピーした場合と同じになる
+    """
+
+    def __init__(self):
+        self._ids: Dict[Tuple[Any, Any, Tuple[int, ...]], Tuple[int, ...]] = {}
+
+    def copy(self, src: Cell, dst: Cell):
+        """
+        `src`のセルのスタイルで`dst`のスタイルを上書きする
+        """
+        key = (src.parent.parent, dst.parent.parent, tuple(_style_array(src)[_copied_style_ids]))
+        ids = self._ids.get(key)
+        if ids is None:
+            copy_style(src, dst)
+            self._ids[key] = tuple(dst._style[_copied_style_ids])
+            return
+        style = StyleArray(_style_array(dst))
+        style[_copied_style_ids] = array('i', ids)
+        dst._style = style
+
+    def copy_rows(self, style_row: Sequence[Cell], rows: Iterable[Sequence[Cell]]):
+        """
+        `style_row`の各セルのスタイルを、`rows`の各行の同じ列のセルにコピーする
+        """
+        for row in rows:
+            for src, dst in zip(style_row, row):
+                self.copy(src, dst)
+
+
+def copy_row_styles(style_row: Sequence[Cell], rows: Iterable[Sequence[Cell]]):
+    """
+    `style_row`の各セルのスタイルを、`rows`の各行の同じ列のセルにコピーする
+    """
+    StyleInterner().copy_rows(style_row, rows)
+
+
 def all_header_footer_parts(ws: Worksheet) -> Iterable[_HeaderFooterPart]:
     wsprops = [a + b for
                a in ['first', 'odd', 'even']
@@ -29,3 +100,561 @@ def all_header_footer_parts(ws: Worksheet) -> Iterable[_HeaderFooterPart]:
     position_names = ['left', 'center', 'right']
 
     return [ws.__getattribute__(h).__getattribute__(pos) for h in wsprops for pos in position_names]
+
+
+_sheet_pattern = re.compile(r'<sheet\b[^>]*>')
+_relationship_pattern = re.compile(r'<Relationship\b[^>]*>')
+_attribute_pattern = re.compile(r'([\w:]+)="([^"]*)"')
+
+
+def _attributes(tag: str) -> Dict[str, str]:
+    return {k: html.unescape(v) for k, v in _attribute_pattern.findall(tag)}
+
+
+def worksheet_parts(package: zipfile.ZipFile) -> Dict[str, str]:
+    """
+    xlsxのシート名 -> ワークシートのXMLのパート名
+    """
+    targets = {}
+    for tag in _relationship_pattern.findall(
+            package.read('xl/_rels/workbook.xml.rels').decode('utf-8')):
+        attrs = _attributes(tag)
+        target = attrs.get('Target', '')
+        targets[attrs.get('Id')] = target.lstrip('/') if target.startswith('/') \
+            else posixpath.normpath(posixpath.join('xl', target))
+
+    parts = {}
+    for tag in _sheet_pattern.findall(package.read('xl/workbook.xml').decode('utf-8')):
+        attrs = _attributes(tag)
+        if attrs.get('r:id') in targets:
+            parts[attrs['name']] = targets[attrs['r:id']]
+    return parts
+
+
+# 数式のセル。openpyxlは計算結果の入っていない<v></v>を出力する
+_formula_cell_pattern = re.compile(
+    r'<c r="(?P<ref>[A-Z]+[0-9]+)"(?P<attrs>[^>]*)>'
+    r'(?P<formula><f[^>]*/>|<f[^>]*>[^<]*</f>)(?P<value><v\s*/>|<v>[^<]*</v>)?</c>')
+_type_attribute_pattern = re.compile(r'\st="[^"]*"')
+# 属性のない(共有数式や配列数式でない)数式
+_plain_formula_pattern = re.compile(r'<f>([^<]*)</f>')
+_shared_index_pattern = re.compile(r'<f\b[^>]*\bsi="([0-9]+)"')
+# 数式の文字列リテラルとセルの参照。関数名(LOG10()や名前の一部は参照としない
+_string_literal_pattern = re.compile(r'("(?:[^"]|"")*")')
+_reference_pattern = re.compile(r'(?<![\w.])(\$?)([A-Z]{1,3})(\$?)([0-9]+)(?![\w(.])', re.IGNORECASE)
+_bare_range_pattern = re.compile(r'(?<!\0):|:(?!\0)')
+
+
+def cached_value_xml(value: Any) -> Tuple[str, str]:
+    """
+    計算結果を<c>のt属性と<v>の中身にする。t属性が空の場合は数値
+    """
+    if isinstance(value, bool):
+        return ('b', '1' if value else '0')
+    if isinstance(value, (datetime, date, time)):
+        return ('', repr(to_excel(value)))
+    if isinstance(value, (int, float)):
+        return ('', repr(value))
+    if isinstance(value, str) and value in formula.errors:
+        return ('e', value)
+    return ('str', escape(str(value)))
+
+
+def write_cached_values(xml: str, values: Mapping[Tuple[int, int], Any]) -> str:
+    """
+    ワークシートのXMLの数式のセルに、計算結果を<v>として書き込む
+    """
+    def cell(matched: 're.Match[str]') -> str:
+        key = coordinate_to_tuple(matched.group('ref'))
+        if key not in values or values[key] is None:
+            return matched.group(0)
+        t, v = cached_value_xml(values[key])
+        attrs = _type_attribute_pattern.sub('', matched.group('attrs'))
+        if t:
+            attrs += f' t="{t}"'
+        return f'<c r="{matched.group("ref")}"{attrs}>{matched.group("formula")}<v>{v}</v></c>'
+
+    return _formula_cell_pattern.sub(cell, xml)
+
+
+def relative_formula(formula: str, row: int, column: int) -> Optional[str]:
+    """
+    数式のセルの参照を、数式のあるセルからの相対位置(R1C1形式)に書き換えた文字列。
+
+    相対参照の数式をコピーしたセル同士は同じ文字列になる。行全体・列全体の範囲(1:1、A:A)を
+    含む場合など、参照を書き換えられない場合はNone
+    """
+    def reference(matched: 're.Match[str]') -> str:
+        col_absolute, col, row_absolute, ref_row = matched.groups()
+        col_index = column_index_from_string(col.upper())
+        r = f'R{ref_row}' if row_absolute else f'R[{int(ref_row) - row}]'
+        c = f'C{col_index}' if col_absolute else f'C[{col_index - column}]'
+        return f'\0{r}{c}\0'
+
+    segments = _string_literal_pattern.split(formula)
+    for i in range(0, len(segments), 2):
+        segments[i] = _reference_pattern.sub(reference, segments[i])
+        if _bare_range_pattern.search(segments[i]):
+            return None
+    return ''.join(segments)
+
+
+def share_formulas(xml: str) -> str:
+    """
+    ワークシートのXMLで、同じ列の連続する行にある、コピーした関係の数式を共有数式にする。
+
+    先頭のセルに数式と範囲を書き、以降のセルには共有数式の番号だけを書く。
+    返済予定表のように同じ数式が何百行も続くシートでは、XMLが数分の一になり、
+    Excelで開くときの数式の解析も一度で済む
+    """
+    formulas: Dict[Tuple[int, int], Tuple[str, str]] = {}  # (列, 行) -> (数式, 相対位置の数式)
+    for matched in _formula_cell_pattern.finditer(xml):
+        plain = _plain_formula_pattern.fullmatch(matched.group('formula'))
+        if plain is None:
+            continue
+        row, column = coordinate_to_tuple(matched.group('ref'))
+        key = relative_formula(html.unescape(plain.group(1)), row, column)
+        if key is not None:
+            formulas[(column, row)] = (plain.group(1), key)
+
+    shared: Dict[str, str] = {}  # セル番地 -> 書き換えた<f>
+    index = max((int(i) for i in _shared_index_pattern.findall(xml)), default=-1) + 1
+
+    def share(column: int, first: int, last: int):
+        nonlocal index
+        if last == first:
+            return
+        letter = get_column_letter(column)
+        shared[f'{letter}{first}'] = \
+            f'<f t="shared" ref="{letter}{first}:{letter}{last}" si="{index}">{formulas[(column, first)][0]}</f>'
+        for row in range(first + 1, last + 1):
+            shared[f'{letter}{row}'] = f'<f t="shared" si="{index}"/>'
+        index += 1
+
+    run: Optional[Tuple[int, int, int]] = None  # (列, 先頭の行, 末尾の行)
+    for (column, row), (_, key) in sorted(formulas.items()):
+        if run is not None and run[0] == column and run[2] == row - 1 and formulas[(column, run[1])][1] == key:
+            run = (column, run[1], row)
+            continue
+        if run is not None:
+            share(*run)
+        run = (column, row, row)
+    if run is not None:
+        share(*run)
+
+    if not shared:
+        return xml
+
+    def cell(matched: 're.Match[str]') -> str:
+        formula = shared.get(matched.group('ref'))
+        if formula is None:
+            return matched.group(0)
+        return f'<c r="{matched.group("ref")}"{matched.group("attrs")}>{formula}{matched.group("value") or ""}</c>'
+
+    return _formula_cell_pattern.sub(cell, xml)
+
+
+def save_with_cached_values(wb: Workbook, values: Mapping[str, Mapping[Tuple[int, int], Any]],
+                            shared: Iterable[str] = ()) -> io.BytesIO:
+    """
+    Workbookを保存し、数式のセルにvalues(シート名 -> (行, 列) -> 値)の計算結果を書き込む。
+
+    openpyxlは数式だけを保存するので、そのままではExcelで再計算して保存するまで
+    `data_only=True`で読み込んだときの値がNoneになる。計算結果を書き込んでおくと、
+    Excelを使わずに読み込んでも計算済みの値が得られる。
+    sharedに指定したシートは、コピーした関係の数式を`share_formulas`で共有数式にする
+    """
+    saved = io.BytesIO()
+    wb.save(saved)
+    saved.seek(0)
+
+    shared = set(shared)
+    output = io.BytesIO()
+    with zipfile.ZipFile(saved) as src, \
+            zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as dst:
+        parts = {part: name for name, part in worksheet_parts(src).items()
+                 if name in values or name in shared}
+        for info in src.infolist():
+            data = src.read(info)
+            if info.filename in parts:
+                name = parts[info.filename]
+                xml = data.decode('utf-8')
+                if name in values:
+                    xml = write_cached_values(xml, values[name])
+                if name in shared:
+                    xml = share_formulas(xml)
+                data = xml.encode('utf-8')
+            dst.writestr(info, data)
+
+    output.seek(0)
+    return output
+
+
+# ワークシートのXMLの行とセル。テンプレートはExcelなどが保存したものなので、r属性があるものとする
+_row_pattern = re.compile(r'<row\b[^>]*?(?:/>|>.*?</row>)', re.DOTALL)
+_cell_pattern = re.compile(r'<c\b[^>]*?(?:/>|>.*?</c>)', re.DOTALL)
+_cell_ref_pattern = re.compile(r'<c\b[^>]*?\sr="([A-Z]+)([0-9]+)"')
+_style_attribute_pattern = re.compile(r'<c\b[^>]*?\ss="([0-9]+)"')
+_dimension_pattern = re.compile(r'<dimension ref="([^"]*)"\s*/>')
+_spans_attribute_pattern = re.compile(r'\sspans="[^"]*"')
+_shared_string_pattern = re.compile(r'<si>(.*?)</si>', re.DOTALL)
+_phonetic_pattern = re.compile(r'<rPh\b.*?</rPh>', re.DOTALL)
+_text_pattern = re.compile(r'<t\b[^>]*?(?:/>|>([^<]*)</t>)')
+_value_pattern = re.compile(r'<v>([^<]*)</v>')
+_xf_pattern = re.compile(r'<xf\b[^>]*?(?:/>|>.*?</xf>)', re.DOTALL)
+
+
+def _set_attribute(tag: str, name: str, value: str) -> str:
+    """
+    開始タグの属性を書き換える(なければ追加する)
+    """
+    replaced, n = re.subn(rf'\s{name}="[^"]*"', f' {name}="{value}"', tag, count=1)
+    if n:
+        return replaced
+    end = tag.index('>')
+    if tag[end - 1] == '/':
+        end -= 1
+    return f'{tag[:end]} {name}="{value}"{tag[end:]}'
+
+
+def _count_up(xml: str, tag: str, added: int) -> str:
+    """
+    `<tag count="N">`のNにaddedを足す
+    """
+    return re.sub(rf'<{tag} count="([0-9]+)"',
+                  lambda m: f'<{tag} count="{int(m.group(1)) + added}"', xml, count=1)
+
+
+def reset_formulas(xml: str) -> str:
+    """
+    ワークシートのXMLの数式を、openpyxlで読み込んで保存した場合と同じ形にする。
+
+    共有数式はセルごとの数式に展開し、数式のセルの計算済みの値を削除する。
+    入力シートを書き換えたブックに、テンプレートの古い計算結果が残らないようにする
+    """
+    masters: Dict[str, Translator] = {}
+    for matched in _formula_cell_pattern.finditer(xml):
+        attrs = _attributes(re.match(r'<f\b[^>]*', matched.group('formula')).group(0))
+        text = re.search(r'>([^<]*)</f>', matched.group('formula'))
+        if attrs.get('t') == 'shared' and 'ref' in attrs and text is not None:
+            masters[attrs['si']] = Translator('=' + html.unescape(text.group(1)), origin=matched.group('ref'))
+
+    def cell(matched: 're.Match[str]') -> str:
+        f = matched.group('formula')
+        attrs = _attributes(re.match(r'<f\b[^>]*', f).group(0))
+        if attrs.get('t') == 'shared' and attrs.get('si') in masters:
+            translated = masters[attrs['si']].translate_formula(matched.group('ref'))
+            f = f'<f>{escape(translated[1:])}</f>'
+        return f'<c r="{matched.group("ref")}"{_type_attribute_pattern.sub("", matched.group("attrs"))}>{f}</c>'
+
+    return _formula_cell_pattern.sub(cell, xml)
+
+
+def sheet_rows(xml: str) -> Iterator[Tuple[int, str]]:
+    """
+    ワークシートのXMLの行番号と<row>
+    """
+    for matched in _row_pattern.finditer(xml):
+        row = re.match(r'<row\b[^>]*?\sr="([0-9]+)"', matched.group(0))
+        if row is None:
+            raise ValueError('行番号のない行があります')
+        yield int(row.group(1)), matched.group(0)
+
+
+def row_cells(row_xml: str) -> Dict[int, str]:
+    """
+    <row>の列番号 -> <c>
+    """
+    cells = {}
+    for matched in _cell_pattern.finditer(row_xml):
+        ref = _cell_ref_pattern.match(matched.group(0))
+        if ref is None:
+            raise ValueError('セル番地のないセルがあります')
+        cells[column_index_from_string(ref.group(1))] = matched.group(0)
+    return cells
+
+
+def cell_style_id(cell_xml: Optional[str]) -> int:
+    """
+    <c>のスタイルのid。セルがない場合は0
+    """
+    matched = _style_attribute_pattern.match(cell_xml or '')
+    return int(matched.group(1)) if matched else 0
+
+
+def _merged_row(row: int, template: Optional[str], cells: Dict[int, str]) -> str:
+    if not cells:
+        return cast(str, template)
+    if template is None:
+        return f'<row r="{row}">' + ''.join(cells[c] for c in sorted(cells)) + '</row>'
+    start = re.match(r'<row\b[^>]*?/?>', template).group(0)
+    merged = {**row_cells(template), **cells}
+    start = _spans_attribute_pattern.sub('', start)
+    if start.endswith('/>'):
+        start = start[:-2] + '>'
+    return start + ''.join(merged[c] for c in sorted(merged)) + '</row>'
+
+
+def replace_cells(xml: str, cells: Mapping[Tuple[int, int], str],
+                  rows: Iterable[Tuple[int, Sequence[str]]] = (),
+                  extent: Tuple[int, int] = (0, 0)) -> Iterator[str]:
+    """
+    ワークシートのXMLのセルを置き換えたXMLを、先頭から順に返す。
+
+    cellsは(行, 列) -> 置き換える<c>。rowsは行番号の昇順の(行番号, A列から並べた<c>)で、
+    テンプレートの行の同じ列のセルを置き換える。テンプレートにない行やセルは追加する。
+    extentにはrowsで書き込む最後の(行, 列)を指定し、シートの範囲(<dimension>)を広げる。
+    <sheetData>以外(列の幅、結合したセル、印刷の設定など)はテンプレートのまま出力する
+    """
+    start = xml.index('<sheetData')
+    if xml.startswith('<sheetData/>', start):
+        head, body, tail = xml[:start], '', xml[start + len('<sheetData/>'):]
+    else:
+        end = xml.index('</sheetData>')
+        body_start = xml.index('>', start) + 1
+        head, body, tail = xml[:start], xml[body_start:end], xml[end + len('</sheetData>'):]
+
+    def dimension(matched: 're.Match[str]') -> str:
+        first, _, last = matched.group(1).partition(':')
+        last_row, last_column = coordinate_to_tuple(last or first)
+        last_row, last_column = max(last_row, extent[0]), max(last_column, extent[1])
+        return f'<dimension ref="{first}:{get_column_letter(last_column)}{last_row}"/>'
+
+    yield _dimension_pattern.sub(dimension, head, count=1)
+    yield '<sheetData>'
+
+    by_row: Dict[int, Dict[int, str]] = {}
+    for (row, column), cell in cells.items():
+        by_row.setdefault(row, {})[column] = cell
+
+    # (行番号, 0:テンプレートの行 1:rowsの行 2:cellsの行, 内容)を行番号の順に並べて、同じ行をまとめる
+    sources = heapq.merge(
+        ((row, 0, template) for row, template in sheet_rows(body)),
+        ((row, 1, dict(enumerate(row_xml, 1))) for row, row_xml in rows),
+        ((row, 2, by_row[row]) for row in sorted(by_row)),
+        key=lambda source: source[:2])
+    for row, group in itertools.groupby(sources, key=lambda source: source[0]):
+        template = None
+        replaced: Dict[int, str] = {}
+        for _, kind, content in group:
+            if kind == 0:
+                template = content
+            else:
+                replaced.update(content)
+        yield _merged_row(row, template, replaced)
+
+    yield '</sheetData>'
+    yield tail
+
+
+class StyleSheet:
+    """
+    xl/styles.xmlのセルの書式(cellXfs)。既存の書式の塗りつぶしや表示形式だけを変えた書式を追加する
+    """
+
+    def __init__(self, xml: str):
+        self._xml = xml
+        cell_xfs = re.search(r'<cellXfs\b[^>]*>(.*?)</cellXfs>', xml, re.DOTALL)
+        self._xfs = _xf_pattern.findall(cell_xfs.group(1)) if cell_xfs else ['<xf numFmtId="0"/>']
+        self._formats = {int(attrs['numFmtId']): attrs['formatCode'] for attrs in
+                         (_attributes(tag) for tag in re.findall(r'<numFmt\b[^>]*>', xml))}
+        fills = re.search(r'<fills count="([0-9]+)"', xml)
+        self._fill_count = int(fills.group(1)) if fills else 0
+        self._added_fills: List[str] = []
+        self._added_formats: Dict[str, int] = {}
+        self._added_xfs: List[str] = []
+        self._derived: Dict[Tuple[int, Optional[str], Optional[str]], int] = {}
+
+    @property
+    def changed(self) -> bool:
+        return bool(self._added_xfs)
+
+    def _xf(self, xf_id: int) -> str:
+        xfs = self._xfs + self._added_xfs
+        return xfs[xf_id] if xf_id < len(xfs) else xfs[0]
+
+    def number_format(self, xf_id: int) -> str:
+        num_fmt_id = int(_attributes(re.match(r'<xf\b[^>]*', self._xf(xf_id)).group(0)).get('numFmtId', 0))
+        for code, added_id in self._added_formats.items():
+            if added_id == num_fmt_id:
+                return code
+        return self._formats.get(num_fmt_id) or BUILTIN_FORMATS.get(num_fmt_id, FORMAT_GENERAL)
+
+    def _number_format_id(self, code: str) -> int:
+        for num_fmt_id, builtin in BUILTIN_FORMATS.items():
+            if builtin == code:
+                return num_fmt_id
+        for num_fmt_id, custom in self._formats.items():
+            if custom == code:
+                return num_fmt_id
+        if code not in self._added_formats:
+            # ユーザー定義の表示形式は164から
+            self._added_formats[code] = max([163, *self._formats, *self._added_formats.values()]) + 1
+        return self._added_formats[code]
+
+    def derive(self, xf_id: int, fill: Optional[Fill] = None, number_format: Optional[str] = None) -> int:
+        """
+        xf_idの書式の塗りつぶしや表示形式を変えた書式のid
+        """
+        fill_xml = tostring(fill.to_tree()).decode('utf-8') if fill is not None else None
+        key = (xf_id, fill_xml, number_format)
+        if key in self._derived:
+            return self._derived[key]
+
+        xf = self._xf(xf_id)
+        start = re.match(r'<xf\b[^>]*>', xf).group(0)
+        if fill_xml is not None:
+            if fill_xml not in self._added_fills:
+                self._added_fills.append(fill_xml)
+            start = _set_attribute(start, 'fillId', str(self._fill_count + self._added_fills.index(fill_xml)))
+            start = _set_attribute(start, 'applyFill', '1')
+        if number_format is not None:
+            start = _set_attribute(start, 'numFmtId', str(self._number_format_id(number_format)))
+            start = _set_attribute(start, 'applyNumberFormat', '1')
+
+        self._added_xfs.append(start + xf[len(re.match(r'<xf\b[^>]*>', xf).group(0)):])
+        self._derived[key] = len(self._xfs) + len(self._added_xfs) - 1
+        return self._derived[key]
+
+    def to_xml(self) -> str:
+        xml = self._xml
+        if self._added_formats:
+            num_fmts = ''.join(f'<numFmt numFmtId="{i}" formatCode="{escape(code, {chr(34): "&quot;"})}"/>'
+                               for code, i in self._added_formats.items())
+            if '</numFmts>' in xml:
+                xml = _count_up(xml.replace('</numFmts>', num_fmts + '</numFmts>', 1), 'numFmts', len(self._added_formats))
+            else:
+                head = re.search(r'<styleSheet\b[^>]*>', xml).end()
+                xml = f'{xml[:head]}<numFmts count="{len(self._added_formats)}">{num_fmts}</numFmts>{xml[head:]}'
+        if self._added_fills:
+            xml = _count_up(xml.replace('</fills>', ''.join(self._added_fills) + '</fills>', 1), 'fills', len(self._added_fills))
+        if self._added_xfs:
+            xml = _count_up(xml.replace('</cellXfs>', ''.join(self._added_xfs) + '</cellXfs>', 1), 'cellXfs', len(self._added_xfs))
+        return xml
+
+
+class TemplatePackage:
+    """
+    xlsxのテンプレートを、openpyxlでセルを読み込まずにワークシートのXMLを書き換えて保存する。
+
+    openpyxlで読み込んで保存した場合と同じく、数式の計算済みの値と計算チェーン(calcChain.xml)を削除し、
+    開いたときに再計算させる。書き換えないパートはそのままコピーする
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with zipfile.ZipFile(path) as package:
+            self._parts = {info.filename: (info, package.read(info)) for info in package.infolist()}
+            self.sheet_parts = worksheet_parts(package)
+        self.styles = StyleSheet(self._text('xl/styles.xml'))
+        self.shared_strings = [
+            html.unescape(''.join(t or '' for t in _text_pattern.findall(_phonetic_pattern.sub('', si))))
+            for si in _shared_string_pattern.findall(self._text('xl/sharedStrings.xml'))]
+        self._sheets: Dict[str, str] = {}
+        self._written: Dict[str, Iterable[str]] = {}
+
+    def _text(self, part: str) -> str:
+        return self._parts[part][1].decode('utf-8') if part in self._parts else ''
+
+    def sheet_xml(self, name: str) -> str:
+        """
+        テンプレートのシートのXML(`reset_formulas`済み)
+        """
+        if name not in self._sheets:
+            self._sheets[name] = reset_formulas(self._text(self.sheet_parts[name]))
+        return self._sheets[name]
+
+    def set_sheet_xml(self, name: str, chunks: Iterable[str]):
+        """
+        保存するシートのXML。`save`で先頭から順に出力するパートに書き込む
+        """
+        self._written[name] = chunks
+
+    def value(self, cell_xml: Optional[str]) -> Any:
+        """
+        <c>の値。数式はopenpyxlと同じく"="から始まる文字列にする
+        """
+        if cell_xml is None:
+            return None
+        f = re.search(r'<f\b[^>]*>([^<]*)</f>', cell_xml)
+        if f is not None:
+            return '=' + html.unescape(f.group(1))
+        t = re.match(r'<c\b[^>]*?\st="([^"]*)"', cell_xml)
+        t = t.group(1) if t else 'n'
+        if t == 'inlineStr':
+            return html.unescape(''.join(v or '' for v in _text_pattern.findall(cell_xml)))
+        v = _value_pattern.search(cell_xml)
+        if v is None:
+            return None
+        text = html.unescape(v.group(1))
+        if t == 's':
+            return self.shared_strings[int(text)]
+        if t == 'b':
+            return text == '1'
+        if t in {'str', 'e'}:
+            return text
+        return float(text) if any(c in text for c in '.eE') else int(text)
+
+    def cell_xml(self, ref: str, style_id: int, value: Any, shared: Optional[Tuple[int, Optional[str]]] = None) -> str:
+        """
+        値を書き込んだ<c>。openpyxlと同じく"="から始まる文字列は数式、日付は日付の表示形式の数値にする。
+
+        sharedには数式を共有数式にする場合の(番号, 範囲)を渡す。範囲は先頭のセルだけに指定し、
+        以降のセルはNoneにする
+        """
+        if isinstance(value, (datetime, date, time)):
+            if not is_date_format(self.styles.number_format(style_id)):
+                style_id = self.styles.derive(
+                    style_id, number_format=TIME_FORMATS.get(type(value), FORMAT_DATE_DATETIME))
+            value = to_excel(value)
+        s = f' s="{style_id}"' if style_id else ''
+        if value is None or value == '':
+            return f'<c r="{ref}"{s}/>'
+        if isinstance(value, bool):
+            return f'<c r="{ref}"{s} t="b"><v>{int(value)}</v></c>'
+        if isinstance(value, (int, float)):
+            return f'<c r="{ref}"{s}><v>{value!r}</v></c>'
+        value = str(value)
+        if len(value) > 1 and value.startswith('='):
+            if shared is None:
+                return f'<c r="{ref}"{s}><f>{escape(value[1:])}</f></c>'
+            index, shared_ref = shared
+            if shared_ref is None:
+                return f'<c r="{ref}"{s}><f t="shared" si="{index}"/></c>'
+            return f'<c r="{ref}"{s}><f t="shared" ref="{shared_ref}" si="{index}">{escape(value[1:])}</f></c>'
+        if value in formula.errors:
+            return f'<c r="{ref}"{s} t="e"><v>{escape(value)}</v></c>'
+        space = ' xml:space="preserve"' if value != value.strip() else ''
+        return f'<c r="{ref}"{s} t="inlineStr"><is><t{space}>{escape(value)}</t></is></c>'
+
+    def save(self) -> io.BytesIO:
+        """
+        書き換えたシートと書式で保存する。ほかのシートも`reset_formulas`で計算済みの値を削除する
+        """
+        sheet_names = {part: name for name, part in self.sheet_parts.items()}
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as dst:
+            for part, (info, data) in self._parts.items():
+                if part == 'xl/calcChain.xml':
+                    continue
+                if sheet_names.get(part) in self._written:
+                    with dst.open(info, 'w') as stream:
+                        for chunk in self._written[sheet_names[part]]:
+                            stream.write(chunk.encode('utf-8'))
+                    continue
+                if part in sheet_names:
+                    data = self.sheet_xml(sheet_names[part]).encode('utf-8')
+                elif part == 'xl/styles.xml' and self.styles.changed:
+                    data = self.styles.to_xml().encode('utf-8')
+                elif part == '[Content_Types].xml':
+                    data = re.sub(rb'<Override\b[^>]*?PartName="/xl/calcChain.xml"[^>]*>', b'', data)
+                elif part == 'xl/_rels/workbook.xml.rels':
+                    data = re.sub(rb'<Relationship\b[^>]*?Target="(?:/xl/)?calcChain.xml"[^>]*>', b'', data)
+                elif part == 'xl/workbook.xml':
+                    data = re.sub(rb'<calcPr\b[^>]*?/?>',
+                                  lambda m: _set_attribute(m.group(0).decode('utf-8'), 'fullCalcOnLoad', '1').encode('utf-8'),
+                                  data, count=1)
+                dst.writestr(info, data)
+
+        output.seek(0)
+        return output
@@ -0,0 +1,55 @@
+"""
+template_cache.copy_memberの回帰チェック
+
+すべてのテンプレートのメンバーを圧縮済みのデータのままコピーしたzipと、zipfileの非公開の属性が
+使えない場合の`ZipFile.writestr`でコピーしたzipが、`ZipFile.testzip`を通り、
+メンバーの中身がテンプレートと一致することを確認する。
+コンパイルしたテンプレートから出力したファイルも`ZipFile.testzip`を通ることを確認する。
+
+    python -m benchmarks.check_copy_member
+"""
+
+from app import template_cache
+from unittest import mock
+import glob
+import io
+import os
+import zipfile
+
+template_root = os.path.join(os.path.dirname(__file__), '..', 'templates')
+
+
+def check_zip(data: io.BytesIO, template_path: str):
+    with zipfile.ZipFile(data) as copied, zipfile.ZipFile(template_path) as src:
+        assert copied.testzip() is None, template_path
+        assert copied.namelist() == src.namelist(), template_path
+        for name in src.namelist():
+            assert copied.read(name) == src.read(name), (template_path, name)
+
+
+def copy_all(template_path: str) -> io.BytesIO:
+    out = io.BytesIO()
+    with zipfile.ZipFile(template_path) as src, zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as dst:
+        for info in src.infolist():
+            template_cache.copy_member(src, info, dst)
+    return out
+
+
+def main():
+    paths = sorted(glob.glob(os.path.join(template_root, '*.docx')) + glob.glob(os.path.join(template_root, '*.xlsx')))
+    cache = template_cache.TemplateCache()
+    for path in paths:
+        check_zip(copy_all(path), path)
+        with mock.patch.object(template_cache, '_can_copy_raw', return_value=False):
+            check_zip(copy_all(path), path)
+
+        compiled = cache.get(path)
+        out = io.BytesIO()
+        compiled.render({}, out)
+        with zipfile.ZipFile(out) as rendered:
+            assert rendered.testzip() is None, path
+    print(f'{len(paths)}件のテンプレート OK')
+
+
+if __name__ == '__main__':
+    main()
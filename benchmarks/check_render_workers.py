@@ -0,0 +1,67 @@
+"""
+帳票を並列に出力するワーカー(`RENDER_WORKERS`)の起動のチェック
+
+実金シートの出力と同じく、設定情報の置換キーワードを一度引いた後にプロセスプールを起動し、
+ワーカーが同じ設定情報で帳票のジョブを実行できることを確認する。
+
+    python -m benchmarks.check_render_workers
+"""
+
+from app import chohyo_gen
+from app.chohyo_gen import ChohyoGenerator, RenderJob
+from app.config import Config, RepByProductRecord, RepByStateRecord
+from typing import List
+import dataclasses
+import logging
+
+product_name = 'コバルト70'
+state = 'CA'
+form_no = 7
+
+
+@dataclasses.dataclass(frozen=True)
+class KeywordGenerator(ChohyoGenerator):
+    """
+    帳票の代わりに、置換キーワードをログに出力する
+    """
+
+    def _gen_product_doc(self, products: List[chohyo_gen.Product], index: int, form_no: int):
+        keywords = self.config.get_kv_for_product(product_name, form_no, state)
+        chohyo_gen.logger.info(f'{index}列目 様式{form_no} {dict(keywords)}')
+
+
+def sample_config() -> Config:
+    return Config(
+        [(product_name, form_no, '実金シート', None)],
+        [RepByStateRecord(form_no, '実金シート', '州名', state, 'California')],
+        [RepByProductRecord(product_name, form_no, '実金シート', '商品名', 'Cobalt 70')],
+        [('会社名', 'IBNet')])
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(processName)s %(message)s')
+    cfg = sample_config()
+    expected = dict(cfg.get_kv_for_product(product_name, form_no, state))
+
+    generator = KeywordGenerator(cfg, '.', '.')
+    records = []
+
+    class Collect(logging.Handler):
+        def emit(self, record: logging.LogRecord):
+            records.append(record.getMessage())
+
+    handler = Collect()
+    chohyo_gen.logger.addHandler(handler)
+    try:
+        with chohyo_gen.Renderer(generator, 2) as renderer:
+            for index in range(2):
+                renderer.render(generator, RenderJob('_gen_product_doc', index, form_no), [0, 0, 0, 0], 2, (index,), None)
+    finally:
+        chohyo_gen.logger.removeHandler(handler)
+
+    assert records == [f'{index}列目 様式{form_no} {expected}' for index in range(2)], records
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+xl_helper.copy_styleとStyleInternerのマイクロベンチマーク
+
+実金シートの返済予定表と同じく、1行分のスタイルを420行×14列にコピーする。
+セルごとにスタイルのオブジェクトを複製する方式と、スタイルのidを一度だけ求めて使い回す方式を比較し、
+保存したブックが一致することも確認する。
+
+    python -m benchmarks.copy_style
+"""
+
+from app import xl_helper
+import io
+import openpyxl
+import os
+import time
+import zipfile
+
+template_path = os.path.join(os.path.dirname(__file__), '..', 'templates', '01_実金シートC.xlsx')
+
+rows = 420
+columns = 14
+
+
+def legacy_copy_row_styles(style_row, table):
+    """
+    置き換え前の実装。比較のためだけに残してある
+    """
+    for row in table:
+        for s, d in zip(style_row, row):
+            xl_helper.copy_style(s, d)
+
+
+def run(copy_row_styles):
+    wb = openpyxl.load_workbook(template_path)
+    ws = wb['実金']
+    style_row = next(ws.iter_rows(23, 23, 1, columns))
+    table = list(ws.iter_rows(24, 24 + rows - 1, 1, columns))
+
+    started = time.perf_counter()
+    copy_row_styles(style_row, table)
+    elapsed = time.perf_counter() - started
+
+    saved = io.BytesIO()
+    wb.save(saved)
+    with zipfile.ZipFile(saved) as z:
+        parts = {name: z.read(name) for name in z.namelist() if not name.startswith('docProps/')}
+    return elapsed, parts
+
+
+def main():
+    legacy, expected = run(legacy_copy_row_styles)
+    current, actual = run(xl_helper.copy_row_styles)
+    assert expected == actual
+
+    print(f'{rows}行×{columns}列  旧 {legacy * 1e3:8.1f}ms  新 {current * 1e3:8.1f}ms  x{legacy / current:.1f}')
+
+
+if __name__ == '__main__':
+    main()
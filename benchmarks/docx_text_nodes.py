@@ -0,0 +1,69 @@
+"""
+docx_helperのrunの走査(python-docxのオブジェクトモデル)と、XPathによるテキストノードの走査の比較
+
+連帯保証人の表を探して"●連帯保証人住所●"を集める処理と、文書全体から"●"を含む箇所を集める処理を
+それぞれの方法で実行する。runの走査は結合セルを列の数だけ繰り返し返すが、XPathは各ノードを一度だけ返す。
+
+    python -m benchmarks.docx_text_nodes
+"""
+
+from app import docx_helper
+import docx
+import more_itertools
+import os
+import timeit
+
+template_root = os.path.join(os.path.dirname(__file__), '..', 'templates')
+
+templates = [
+    '03_金銭消費貸借契約証書4.docx',
+    '05_NOTE(アモチ無)_HI.docx',
+    '06_DEED(債権1)_HI.docx',
+    '06_DEED(債権1)_GA_Chacot別.docx',
+]
+
+keyword = '●連帯保証人住所●'
+
+
+def guarantor_runs(doc):
+    table = more_itertools.first_true(
+        doc.tables,
+        pred=lambda table: any(
+            keyword in run.text for run in docx_helper.run_in_table(table)))
+    if table is None:
+        return []
+    return [run for run in docx_helper.run_in_table(table) if keyword in run.text]
+
+
+def guarantor_nodes(doc):
+    table = docx_helper.first_table_containing(doc, keyword)
+    if table is None:
+        return []
+    return list(docx_helper.text_nodes(table._tbl, keyword))
+
+
+def keyword_runs(doc):
+    return [run for run in docx_helper.all_runs(doc) if '●' in run.text]
+
+
+def keyword_nodes(doc):
+    return list(docx_helper.all_text_nodes(doc, '●'))
+
+
+def main():
+    for name in templates:
+        doc = docx.Document(os.path.join(template_root, name))
+        for label, old, new in [('連帯保証人の表', guarantor_runs, guarantor_nodes),
+                                ('文書全体の●', keyword_runs, keyword_nodes)]:
+            # 結合セルはrunの走査では何度も現れるので、w:r要素の集合で比較する
+            assert {run._r for run in old(doc)} == \
+                {node.element.getparent() for node in new(doc)}, (name, label)
+            number = 20
+            t_old = timeit.timeit(lambda: old(doc), number=number) / number
+            t_new = timeit.timeit(lambda: new(doc), number=number) / number
+            print(f'{name:<32} {label:<10} run {t_old * 1e3:7.2f}ms  '
+                  f'XPath {t_new * 1e3:6.2f}ms  x{t_old / t_new:.0f}')
+
+
+if __name__ == '__main__':
+    main()
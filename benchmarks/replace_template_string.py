@@ -0,0 +1,82 @@
+"""
+replace.replace_template_stringのマイクロベンチマーク
+
+以前の実装(search と sub(..., 1) を繰り返す方式)と、一度の走査で置換する現在の実装を
+ヘッダー・フッターやセルにありがちな長い文字列で比較する。出力が一致することも確認する。
+
+    python -m benchmarks.replace_template_string
+"""
+
+from app import replace, time_helper
+from typing import Any, Mapping
+import datetime
+import itertools
+import mojimoji
+import timeit
+
+
+def legacy_replace_template_string(input_string: str, replace_dict: Mapping[str, Any]):
+    """
+    置き換え前の実装。比較のためだけに残してある
+    """
+    output_string = input_string
+    for c in itertools.count():
+        matched = replace.replace_pattern.search(output_string)
+        if matched is None:
+            break
+        if c >= 20:
+            raise RuntimeError('テキストの置換に失敗しました。')
+
+        key, format_str = matched.groups()
+        value = replace_dict.get(key)
+        if value is None:
+            value = ''
+        if isinstance(value, (datetime.date, datetime.time)):
+            value = time_helper.strftime(
+                value,
+                mojimoji.zen_to_han(format_str)
+                if format_str is not None else "%Y年%-m月%-d日").upper()
+        elif isinstance(value, (int, float)):
+            format_str = f"{{:{mojimoji.zen_to_han(format_str)}}}" \
+                if format_str is not None else '{:,}'
+            value = format_str.format(value)
+
+        output_string = replace.replace_pattern.sub(value, output_string, 1)
+    return output_string
+
+
+replace_dict = {
+    '顧客名': '田中　太郎',
+    '金消契約日': datetime.date(2021, 4, 28),
+    '貸付元本額（円）': 12345678,
+    '約定利率': 0.033,
+    '担保明細－物件名': 'H 2104 Dalhart',
+}
+
+cases = {
+    'ヘッダー・フッター': '&L●顧客名● 様&C●金消契約日○%B %-d, %Y●&R' + '　' * 200 + '●担保明細－物件名●',
+    'セル(長文)': ('本契約は●金消契約日●に●顧客名●と締結し、貸付元本額は金●貸付元本額（円）●円、'
+                  '約定利率は年●約定利率○．２％●とする。' * 5),
+    '条項(長文)': ('借主は本契約に基づく債務を履行するものとする。' * 10 + '●顧客名●') * 20,
+    'セル(置換なし)': '借主は本契約に基づく債務を履行するものとする。' * 20,
+}
+
+
+def main():
+    for name, text in cases.items():
+        expected = legacy_replace_template_string(text, replace_dict)
+        actual = replace.replace_template_string(text, replace_dict, 'benchmark')
+        assert expected == actual, name
+
+        number = 2000
+        legacy = timeit.timeit(
+            lambda: legacy_replace_template_string(text, replace_dict), number=number)
+        current = timeit.timeit(
+            lambda: replace.replace_template_string(text, replace_dict, 'benchmark'), number=number)
+        print(f'{name:<12} 文字数 {len(text):>5}  '
+              f'旧 {legacy / number * 1e6:8.1f}us  新 {current / number * 1e6:8.1f}us  '
+              f'x{legacy / current:.1f}')
+
+
+if __name__ == '__main__':
+    main()
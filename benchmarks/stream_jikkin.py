@@ -0,0 +1,78 @@
+"""
+jikkin_sheet.stream_jikkin_sheetのベンチマーク
+
+実金シートのテンプレートをopenpyxlで読み込んで返済予定表を書き込み、保存する方式と、
+テンプレートのXMLに行を順に書き込む方式を、弁済回数を変えて比較する。
+時間とメモリの最大使用量(tracemalloc)を表示し、保存したブックのセルが一致することも確認する。
+
+    python -m benchmarks.stream_jikkin
+"""
+
+from app import jikkin_sheet, xl_helper
+from app.model import ProductInput
+import io
+import openpyxl
+import os
+import time
+import tracemalloc
+
+template_root = os.path.join(os.path.dirname(__file__), '..', 'templates')
+
+repeats = (120, 420, 1200)
+
+
+def legacy_output(product_input: ProductInput, template_path: str) -> io.BytesIO:
+    """
+    置き換え前の実装。比較のためだけに残してある
+    """
+    wb = jikkin_sheet.fill_jikkin_workbook(product_input, template_path)
+    return xl_helper.save_with_cached_values(wb, {}, shared=['実金'])
+
+
+def template_product_input(template_path: str, repeat: int) -> ProductInput:
+    """
+    テンプレートの入力シートに保存されている値を、弁済回数だけ変えた商品の入力値
+    """
+    wb = openpyxl.load_workbook(template_path, data_only=True)
+    kv = {}
+    for k, v in zip(*wb['入力シート'].iter_cols(1, 2)):
+        if isinstance(k.value, str):
+            kv.setdefault(k.value.rstrip(), v.value)
+    kv['連帯保証人住所出力'] = 'しない'
+    kv['弁済回数'] = repeat
+    return ProductInput(kv)
+
+
+def measure(output, product_input, template_path):
+    started = time.perf_counter()
+    output(product_input, template_path)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    saved = output(product_input, template_path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, saved
+
+
+def cells(saved: io.BytesIO):
+    wb = openpyxl.load_workbook(saved)
+    return {(ws.title, cell.coordinate): (cell.value, cell.number_format)
+            for ws in wb for row in ws.iter_rows() for cell in row if cell.value is not None}
+
+
+def main():
+    for name in ('A', 'C'):
+        template_path = os.path.join(template_root, f'01_実金シート{name}.xlsx')
+        for repeat in repeats:
+            product_input = template_product_input(template_path, repeat)
+            legacy, legacy_peak, expected = measure(legacy_output, product_input, template_path)
+            current, current_peak, actual = measure(jikkin_sheet.stream_jikkin_sheet, product_input, template_path)
+            assert cells(expected) == cells(actual)
+
+            print(f'{name} {repeat:5}回  旧 {legacy * 1e3:8.1f}ms {legacy_peak / 2**20:6.1f}MB'
+                  f'  新 {current * 1e3:8.1f}ms {current_peak / 2**20:6.1f}MB  x{legacy / current:.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,8 @@
-from app import jikkin_sheet, config, chohyo_gen
+from app import batch, jikkin_sheet, config, chohyo_gen, file_watch, keyword_index, scenario, service
 from logging import getLogger, basicConfig
-from typing import Any, Mapping
+from typing import Any, List, Mapping
 import logging
-import openpyxl
 import os
-import re
 import sys
 import time
 
@@ -20,21 +18,40 @@ def logging_keywords(title: str, kv: Mapping[str, Any]):
     logger.debug('')
 
 
-def busy_wait_excel_open_and_close(filename: str, duration: int = 1):
+def busy_wait_excel_open_and_close(filename: str):
     """
-    duration(default: 1)秒間隔でexcelで開いたときのロックファイルの存在を確認し、
+    excelで開いたときのロックファイルの作成と削除を監視し、
     excelで開いて閉じるまでこの関数の呼び出しがスレッドをブロックします。
     """
-    lockfile_name = re.sub(r"(?=[^\/]+?\.\w+$)", "~$", filename, count=1)
+    file_watch.wait_opened_and_closed(filename)
 
-    opened = False
-    while True:
-        time.sleep(duration)
-        isopen = os.path.exists(lockfile_name)
 
-        if opened and not isopen:
-            break
-        opened = isopen
+def run_scenario(generator: chohyo_gen.ChohyoGenerator, input_file_path: str, args: List[str], output_path: str):
+    """
+    入力シートの商品(商品=2 のように何列目かを指定する。省略した場合は最初の商品)について、
+    項目=値 で指定した条件のすべての組み合わせを計算し、CSVに出力する
+    """
+    product_inputs = jikkin_sheet.read_input_sheet(input_file_path)
+    number = 1
+    grid = {}
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if key.strip() == '商品':
+            number = int(value)
+        else:
+            grid[key.strip()] = scenario.parse_axis(arg)
+    if not 1 <= number <= len(product_inputs):
+        raise RuntimeError(f'入力シートには{len(product_inputs)}件の商品しかありません。({number}列目)')
+    product_input = product_inputs[number - 1]
+
+    started = time.perf_counter()
+    rows = scenario.sweep(generator, product_input, grid)
+    os.makedirs(output_path, exist_ok=True)
+    csv_path = os.path.join(output_path, f'シナリオ_{product_input.name}.csv')
+    # Excelで開けるようにBOMをつける
+    with open(csv_path, 'w', encoding='utf-8-sig', newline='') as f:
+        scenario.write_csv(rows, f)
+    logger.info(f'{len(rows)}通りの条件を{time.perf_counter() - started:.2f}秒で計算し、{csv_path}に出力しました')
 
 
 def main():
@@ -46,15 +63,40 @@ def main():
         raise RuntimeError(
             '入力シートが引数に渡されておりません。引数に入力シートのパスを指定する必要があります。詳しくはREADME.mdをご参照ください。')
 
-    input_file_path = os.path.normpath(sys.argv[1])
+    # --batch: 続けて指定した入力シート、フォルダ、ワイルドカードをすべて処理する
+    # --serve: HTTPサービスとして常駐し、リクエストごとに帳票を生成する
+    # --scenario: 入力シートの商品の約定利率などを変えた返済予定表を計算し、結果の表を出力する
+    batch_mode = sys.argv[1] == '--batch'
+    serve_mode = sys.argv[1] == '--serve'
+    scenario_mode = sys.argv[1] == '--scenario'
+    if batch_mode and len(sys.argv) <= 2:
+        raise RuntimeError(
+            '--batchの後ろに入力シートのパス、フォルダ、またはワイルドカードを指定してください。')
+    if scenario_mode and len(sys.argv) <= 3:
+        raise RuntimeError(
+            '--scenarioの後ろに入力シートのパスと、変える項目の値(約定利率=0.03,0.031 など)を指定してください。')
+    input_file_path = None if batch_mode or serve_mode or scenario_mode else os.path.normpath(sys.argv[1])
+    # 前回の入力シート。指定した場合は、変更された項目を参照する帳票だけを出力する
+    previous_file_path = os.path.normpath(sys.argv[2]) if input_file_path is not None and len(sys.argv) > 2 else None
     config_file_path = os.path.normpath(os.environ.get(
         'CONFIG_FILE_PATH', './workdir/設定情報.xlsx'))
     template_path = os.path.normpath(
         os.environ.get('TEMPLATE_FOLDER_PATH', './templates'))
     output_path = os.path.normpath(
         os.environ.get('OUTPUT_FOLDER_PATH', './workdir/output'))
+    # excel: Excelで開いて計算・保存する / python, formula: 実金シートをPythonで計算する
+    # recalculate: 変換バックエンド(CONVERTER_BACKEND)で再計算して保存する
+    # サービスはExcelでの上書き保存を待てないので、既定値をpythonにする
+    jikkin_calculation = os.environ.get('JIKKIN_CALCULATION', 'python' if serve_mode else 'excel').lower()
+    if jikkin_calculation not in {'excel', 'python', 'formula', 'recalculate'}:
+        raise RuntimeError(
+            f'JIKKIN_CALCULATIONには excel, python, formula, recalculate のいずれかを指定してください。({jikkin_calculation!r})')
+    # 帳票を並列に出力するプロセス数。1の場合は順に出力する
+    render_workers = int(os.environ.get('RENDER_WORKERS', '1'))
+    # 0を指定した場合は、前回と同じ入力から出力済みの帳票も出力し直す
+    incremental = os.environ.get('INCREMENTAL_BUILD', '1') != '0'
 
-    cfg = config.load_config_from_workbook(config_file_path)
+    cfg = config.load_config(config_file_path)
 
     chohyo_generator = chohyo_gen.ChohyoGenerator(
         cfg,
@@ -67,17 +109,59 @@ def main():
     logger.debug(f'  設定情報.xlsxの場所 {config_file_path}')
     logger.debug(f'  テンプレートが格納されているパス: {template_path}')
     logger.debug(f'  出力先のパス: {output_path}')
+    logger.debug(f'  実金シートの計算: {jikkin_calculation}')
+    logger.debug(f'  帳票を出力するプロセス数: {render_workers}')
+    logger.debug(f'  変更のない帳票の出力を省略: {incremental}')
+    logger.debug(f'  前回の入力シート: {previous_file_path}')
     logger.debug('')
 
-    input_workbook = openpyxl.load_workbook(input_file_path, data_only=True)
-
-    product_inputs = list(jikkin_sheet.get_keywords_for_each_products(
-        input_workbook['入力シート']))
+    if serve_mode:
+        render_service = service.RenderService(
+            chohyo_generator,
+            jikkin_calculation,
+            render_workers,
+            int(os.environ.get('SERVICE_QUEUE_SIZE', '8')),
+            float(os.environ.get('SERVICE_TIMEOUT', '120')))
+        service.serve(
+            render_service,
+            os.environ.get('SERVICE_HOST', '127.0.0.1'),
+            int(os.environ.get('SERVICE_PORT', '8080')))
+        return
+
+    if scenario_mode:
+        run_scenario(chohyo_generator, os.path.normpath(sys.argv[2]), sys.argv[3:], output_path)
+        return
+
+    if input_file_path is None:
+        input_file_paths = batch.expand_inputs(sys.argv[2:])
+        logger.info(f'{len(input_file_paths)}件の入力シートを処理します')
+        results = batch.run_batch(
+            chohyo_generator, input_file_paths, jikkin_calculation, render_workers, incremental)
+        batch.logging_summary(results)
+        logger.info('Enterキーを押してプログラムを終了します。')
+        sys.stdin.flush()
+        input()
+        return
+
+    product_inputs = jikkin_sheet.read_input_sheet(input_file_path)
 
     for i, p in enumerate(product_inputs):
         logging_keywords(f'{i}列目の入力値', p.product_kv)
 
-    chohyo_generator.gen_all_doc(product_inputs)
+    targets = None
+    if previous_file_path is not None:
+        previous_inputs = jikkin_sheet.read_input_sheet(previous_file_path)
+        targets = keyword_index.affected_outputs(
+            chohyo_generator, previous_inputs, product_inputs)
+        if targets is None:
+            logger.info('商品の列が前回の入力シートと異なるため、すべての帳票を出力します')
+        else:
+            logger.info(f'前回の入力シートから変更された項目を参照する帳票: {len(targets)}件')
+            for target in targets:
+                logger.debug(f'  {target}')
+
+    chohyo_generator.gen_all_doc(
+        product_inputs, jikkin_calculation, render_workers, incremental, targets)
 
     logger.info('')
     logger.info('すべてのファイルの出力が完了しました。Enterキーを押してプログラムを終了します。')